@@ -0,0 +1,328 @@
+"""
+asyncio counterpart of lickometer.Lickometer.
+
+Every exchange with the Lickometer is a coroutine, so an experiment can wait for licks while it plays feedback sounds
+and polls the touchscreen in other tasks. Requires pyserial-asyncio (pip install pyserial-asyncio).
+"""
+
+import asyncio
+import struct
+
+try:
+    import serial_asyncio
+except ImportError:
+    serial_asyncio = None
+
+import tracing
+from lickometer import Protocol, RewardAmount, find_arduino_port
+from tracing import tracer
+
+
+class AsyncLickometer(RewardAmount):
+    Order = Protocol.Order
+
+    def __init__(self, port=None, rate=19200, timeout=1, contingency_percent=80, rew_size=1, contingency_window=None):
+        super(AsyncLickometer, self).__init__(contingency_percent=contingency_percent, rew_size=rew_size,
+                                              contingency_window=contingency_window)
+        self.port = port
+        self.rate = rate
+        self.timeout = timeout
+        self.command = {i.name.lower(): i for i in self.Order}
+        self.allowed_pumps = ['up', 'left', 'right']
+        self.version = None
+        self.initial_values = None
+        self._reader = None
+        self._writer = None
+        self._lock = None
+
+    async def connect(self):
+        """
+        Open the serial connection and read the version and initial values sent by the Lickometer.
+        """
+        if serial_asyncio is None:
+            raise ImportError('AsyncLickometer requires pyserial-asyncio (pip install pyserial-asyncio)')
+        if self.port is None:
+            self.port = find_arduino_port()
+        if self.port is None:
+            raise ConnectionError('No Arduino found')
+
+        self._lock = asyncio.Lock()
+        self._reader, self._writer = await serial_asyncio.open_serial_connection(url=self.port, baudrate=self.rate)
+        self.version = await self.read_line()
+        self.initial_values = await self.read_line()
+        tracer.info('\tv: {}\n\tinit.val: {}', self.version, self.initial_values, source=self.port)
+
+    async def close(self):
+        self._writer.close()
+        await self._writer.wait_closed()
+        tracer.info('Port {} is closed', self.port, source=self.port)
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    @property
+    def printing(self):
+        """
+        Debug traces of the exchanges, see tracing.tracer (shared with Lickometer).
+        """
+        return tracer.debugging
+
+    @printing.setter
+    def printing(self, enabled: bool):
+        tracer.set_level(tracing.DEBUG if enabled else tracing.INFO)
+
+    # ---- low level reads & writes ----
+
+    async def read_line(self):
+        line = await self._reader.readline()
+        return line.strip().decode()
+
+    async def _read(self, fmt, size, timeout):
+        data = await asyncio.wait_for(self._reader.readexactly(size), timeout)
+        return struct.unpack(fmt, data)[0]
+
+    async def read_order(self, timeout=-1):
+        """
+        :param timeout: seconds to wait, None waits forever (Default: self.timeout)
+        :return: (Order Enum Object)
+        """
+        order_read = await self.read_i8(timeout)
+        try:
+            return self.Order(order_read)
+        except ValueError:
+            return order_read
+
+    async def read_i8(self, timeout=-1):
+        """
+        :return: (int8_t)
+        """
+        return await self._read('<b', 1, self.timeout if timeout == -1 else timeout)
+
+    async def read_i16(self, timeout=-1):
+        """
+        :return: (int16_t)
+        """
+        return await self._read('<h', 2, self.timeout if timeout == -1 else timeout)
+
+    async def read_i32(self, timeout=-1):
+        """
+        :return: (int32_t)
+        """
+        return await self._read('<l', 4, self.timeout if timeout == -1 else timeout)
+
+    def write_order(self, order):
+        """
+        :param order: (Order Enum Object)
+        """
+        self.write_i8(order.value)
+
+    def write_i8(self, value):
+        """
+        :param value: (int8_t)
+        """
+        if -128 <= value <= 127:
+            self._writer.write(struct.pack('<b', value))
+        else:
+            tracer.error('Value error:{}', value, source=self.port)
+
+    def write_i16(self, value):
+        """
+        :param value: (int16_t)
+        """
+        self._writer.write(struct.pack('<h', value))
+
+    def write_i32(self, value):
+        """
+        :param value: (int32_t)
+        """
+        self._writer.write(struct.pack('<l', value))
+
+    # ---- Lickometer orders ----
+
+    async def set_wash_speed(self, speed: int, pumps=None):
+        """
+        Set the motor speed for washing and TTL-controlled rewarding. See Lickometer.set_wash_speed.
+        """
+
+        if not pumps:
+            pumps = ['all']
+
+        async with self._lock:
+            for p in pumps:
+                self.write_order(self.Order.SET_WASHSPEED)
+                order_result = await self.read_order()
+                if tracer.debugging: tracer.debug('AsyncLickometer.set_wash_speed: {}', order_result, source=self.port)
+
+                self.write_order(self.command[p])
+                pump_result = await self.read_order()
+                self.write_i16(speed)
+                speed_result = await self.read_i16()
+                if tracer.debugging:
+                    tracer.debug('AsyncLickometer.set_wash_speed({}, {})', pump_result, speed_result,
+                                 source=self.port)
+
+    async def set_size(self, size: int, pumps=None):
+        """
+        Set the reward size of requested pumps. See Lickometer.set_size.
+        """
+
+        async with self._lock:
+            await self._set_size(size, pumps)
+
+    async def _set_size(self, size, pumps):
+        if not pumps:
+            pumps = ['all']
+
+        for p in pumps:
+            self.write_order(self.Order.SET_SIZE)
+            order_result = await self.read_order()
+            if tracer.debugging: tracer.debug('AsyncLickometer.set_size: {}', order_result, source=self.port)
+
+            self.write_order(self.command[p])
+            pump_result = await self.read_order()
+            self.write_i16(size)
+            size_result = await self.read_i16()
+            if tracer.debugging:
+                tracer.debug('AsyncLickometer.set_size({}, {})', pump_result, size_result,
+                             source=self.port)
+
+    async def calibrate_pump(self, motor_time, motor_speed, pumps=None):
+        """
+        Set reward's motor time (s) and motor speed [0; 255] of requested pumps. See Lickometer.calibrate_pump.
+        """
+
+        if not pumps:
+            pumps = ['all']
+
+        if motor_time > 0 and motor_time != float('inf'):
+            motor_time = int(motor_time * 1000)  # convert motor_time: s --> ms
+        else:
+            motor_time = 0
+        motor_speed = min(max(motor_speed, 0), 255)
+
+        async with self._lock:
+            for p in pumps:
+                self.write_order(self.Order.CALIBRATE)
+                order_result = await self.read_order()
+                if tracer.debugging: tracer.debug('AsyncLickometer.calibrate_pump: {}', order_result, source=self.port)
+
+                self.write_order(self.command[p])
+                pump_result = await self.read_order()
+                self.write_i32(motor_time)
+                time_result = await self.read_i32()
+                self.write_i16(motor_speed)
+                speed_result = await self.read_i16()
+                if tracer.debugging:
+                    tracer.debug('AsyncLickometer.calibrate_pump({}, {}, {})', pump_result, time_result, speed_result,
+                                 source=self.port)
+
+    async def set_timeout(self, timeout):
+        """
+        Set duration of waiting for licking in WFL state (seconds, inf: no timeout). See Lickometer.set_timeout.
+        """
+
+        if timeout > 0 and timeout != float('inf'):
+            timeout *= 1000     # convert timeout: s --> ms
+        else:
+            timeout = 0
+
+        async with self._lock:
+            self.write_order(self.Order.SET_TIMEOUT)
+            order_result = await self.read_order()
+            if tracer.debugging: tracer.debug('AsyncLickometer.set_timeout: {}', order_result, source=self.port)
+
+            self.write_i32(int(timeout))
+            time_result = await self.read_i32()
+            inf_result = await self.read_order()
+            if tracer.debugging:
+                tracer.debug('AsyncLickometer.set_timeout({}, finite timeout={})', time_result, inf_result,
+                             source=self.port)
+
+    async def watch_licks(self):
+        """
+        Set Lickometer in WFL (wait for licking) state and wait for the feedback without blocking the event loop.
+
+        Returns
+        -------
+        str: 'abc' a: up, b: left, c: right --> a, b, c: lick=1 & no_lick=0
+        """
+
+        async with self._lock:
+            self.write_order(self.Order.WFL)
+            order_result = await self.read_order()
+            if tracer.debugging: tracer.debug('AsyncLickometer.watch_licks: {}', order_result, source=self.port)
+
+            # the Lickometer answers after a lick or after its own timeout
+            lick_result = await self.read_i8(timeout=None)
+            if tracer.debugging:
+                tracer.debug('AsyncLickometer.watch_licks({0}-->{0:03})', lick_result, source=self.port)
+
+        return f"{lick_result:03}"
+
+    async def set_side(self, side: str):
+        """
+        Set the next rewarded side before rewarding. See Lickometer.set_side.
+        """
+
+        async with self._lock:
+            await self._set_side(side)
+
+    async def _set_side(self, side):
+        self.write_order(self.Order.SET_SIDE)
+        order_result = await self.read_order()
+        if tracer.debugging: tracer.debug('AsyncLickometer.set_side: {}', order_result, source=self.port)
+
+        self.write_order(self.command[side])
+        side_selected = await self.read_order()
+        side_result = await self.read_order()
+        if tracer.debugging:
+            tracer.debug('AsyncLickometer.set_side({}, {})', side_selected, side_result,
+                         source=self.port)
+
+    async def reward(self, side: str, size=-1):
+        """
+        Give reward by the requested pump. Up always rewarding but left & right use current size.
+        If size specified that will be set (not current size). See Lickometer.reward.
+        """
+
+        if not size == -1:
+            pass
+        elif side == 'up':
+            size = self.rew_size
+        else:
+            size = self.current_size()
+
+        async with self._lock:
+            await self._set_size(size, None)
+            await self._set_side(side)
+
+            self.write_order(self.Order.REW)
+            order_result = await self.read_order()
+            if tracer.debugging: tracer.debug('AsyncLickometer.reward: {}', order_result, source=self.port)
+            await asyncio.sleep(0.1)
+
+            reward_result = await self.read_order()
+            if tracer.debugging: tracer.debug('AsyncLickometer.reward({})', reward_result, source=self.port)
+        return reward_result
+
+    async def punish(self):
+        async with self._lock:
+            self.write_order(self.Order.NOR)
+            result = await self.read_line()
+            if tracer.debugging: tracer.debug('AsyncLickometer.punish: {}', result, source=self.port)
+
+
+if __name__ == '__main__':
+    async def main():
+        async with AsyncLickometer() as lick_o_meter:
+            await lick_o_meter.set_size(1)
+            await lick_o_meter.set_timeout(5)
+            licks = await lick_o_meter.watch_licks()
+            print(f"I've got: {licks}")
+            await lick_o_meter.reward('up')
+
+    asyncio.run(main())
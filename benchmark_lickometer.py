@@ -0,0 +1,139 @@
+"""
+Round-trip latency benchmark of the Lickometer orders.
+
+Every operation is repeated against the Arduino (--port, default: find it) or a VirtualLickometer (--virtual), the
+p50/p95/p99 latency, throughput and bytes on the wire per operation are printed and saved as JSON so that firmware
+and host changes can be compared.
+Note: on a real device watch_licks waits for a real lick and reward delivers water.
+"""
+
+import argparse
+import json
+import platform
+import time
+
+from lickometer import Lickometer
+
+OPERATIONS = {
+    'set_size': lambda lick_o_meter: lick_o_meter.set_size(1),
+    'set_side': lambda lick_o_meter: lick_o_meter.set_side('left'),
+    'calibrate_pump': lambda lick_o_meter: lick_o_meter.calibrate_pump(0.5, 200),
+    'set_timeout': lambda lick_o_meter: lick_o_meter.set_timeout(1),
+    'watch_licks': lambda lick_o_meter: lick_o_meter.watch_licks(),
+    'reward': lambda lick_o_meter: lick_o_meter.reward('up'),
+}
+
+
+def percentile(sorted_values: list, percent: float):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    rank = max(0, min(len(sorted_values) - 1, round(percent / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def benchmark_operation(lick_o_meter, operation, repetitions: int):
+    """
+    Run an operation repetitions times and summarize its latency.
+
+    Parameters
+    ----------
+    lick_o_meter : Lickometer
+    operation : callable
+        Called with lick_o_meter.
+    repetitions : int
+
+    Returns
+    -------
+    dict: latency percentiles (ms), throughput (operations/s) and bytes written/read per operation
+    """
+
+    latencies = []
+    written, read = lick_o_meter.bytes_written, lick_o_meter.reader.bytes_read
+    start = time.perf_counter()
+    for _ in range(repetitions):
+        t = time.perf_counter_ns()
+        operation(lick_o_meter)
+        latencies.append(time.perf_counter_ns() - t)
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'repetitions': repetitions,
+        'p50_ms': percentile(latencies, 50) / 1e6,
+        'p95_ms': percentile(latencies, 95) / 1e6,
+        'p99_ms': percentile(latencies, 99) / 1e6,
+        'mean_ms': sum(latencies) / len(latencies) / 1e6,
+        'max_ms': latencies[-1] / 1e6,
+        'throughput_per_s': repetitions / elapsed,
+        'bytes_written_per_op': (lick_o_meter.bytes_written - written) / repetitions,
+        'bytes_read_per_op': (lick_o_meter.reader.bytes_read - read) / repetitions,
+    }
+
+
+def run_benchmark(lick_o_meter, operations: list, repetitions: int):
+    """
+    Benchmark the requested operations one after the other.
+
+    Returns
+    -------
+    dict: {operation name: summary of benchmark_operation()}
+    """
+
+    results = {}
+    for name in operations:
+        print(f"Benchmarking {name} x{repetitions}...")
+        results[name] = benchmark_operation(lick_o_meter, OPERATIONS[name], repetitions)
+    return results
+
+
+def print_results(results: dict):
+    print(f"\n{'operation':<16}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'op/s':>10}{'B out':>8}{'B in':>8}")
+    for name, r in results.items():
+        print(f"{name:<16}{r['p50_ms']:>10.3f}{r['p95_ms']:>10.3f}{r['p99_ms']:>10.3f}{r['throughput_per_s']:>10.1f}"
+              f"{r['bytes_written_per_op']:>8.1f}{r['bytes_read_per_op']:>8.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='LickometerBenchmark',
+        description='Round-trip latency benchmark of the Lickometer protocol')
+    parser.add_argument('--port', '-p', help='Serial port of the Lickometer (default: find the Arduino)')
+    parser.add_argument('--virtual', '-V', help='Benchmark a VirtualLickometer on a pty', action='store_true')
+    parser.add_argument('--latency', type=float, default=0.0, help='Reply latency of the VirtualLickometer (s)')
+    parser.add_argument('--repetitions', '-n', type=int, default=1000, help='Repetitions of each operation')
+    parser.add_argument('--operations', '-O', nargs='+', choices=list(OPERATIONS), default=list(OPERATIONS))
+    parser.add_argument('--composite', help='Use the composite REW_SIDE_SIZE reward', action='store_true')
+    parser.add_argument('--output', '-o', help='JSON file of the results (default: benchmark_<date>.json)')
+    args = parser.parse_args()
+
+    device = None
+    port = args.port
+    if args.virtual:
+        from virtual_lickometer import VirtualLickometer
+        device = VirtualLickometer(latency=args.latency).start()
+        port = device.port
+
+    # every repetition is sent: delta-sync would skip the repeated configuration orders
+    lick_o_meter = Lickometer(port=port, composite_reward=args.composite, delta_sync=False)
+    try:
+        results = run_benchmark(lick_o_meter, args.operations, args.repetitions)
+    finally:
+        lick_o_meter.close()
+        if device is not None:
+            device.stop()
+
+    print_results(results)
+
+    output = args.output or f"benchmark_{time.strftime('%Y_%m_%d_%H_%M_%S', time.localtime())}.json"
+    with open(output, 'w') as f:
+        json.dump({'date': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime()),
+                   'host': platform.node(),
+                   'port': lick_o_meter.port,
+                   'virtual': args.virtual,
+                   'composite_reward': args.composite,
+                   'version': lick_o_meter.version,
+                   'initial_values': lick_o_meter.initial_values,
+                   'results': results,
+                   'order_stats': lick_o_meter.stats.snapshot()}, f, indent=2)
+    print(f"\nResults saved to {output}")
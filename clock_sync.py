@@ -0,0 +1,193 @@
+"""
+Synchronisation of the Lickometer clock with the host clock.
+
+ClockSync pings the Lickometer (Protocol.ping()), each exchange pairs the device clock (micros()) with the midpoint of
+the host send & receive times. The offset and drift of the device clock are fitted by a robust (Theil-Sen) regression
+on the exchanges with the shortest round trips, so device timestamps (e.g. Event.device_time of licks and rewards) can
+be placed on the host timeline of time.perf_counter(), the clock of psychopy:
+
+    sync = ClockSync(lick_o_meter)
+    sync.sync()                                   # burst of pings at the start of the session
+    ...
+    sync.update()                                 # between trials: re-sync every interval seconds
+    lick_time = sync.to_clock(event.device_time, trial_clock)   # on the psychopy clock of the window flips
+
+The pings share the serial port with the other orders, call sync() and update() from the thread driving the
+Lickometer (or submit them to its DeviceWorker).
+"""
+
+import time
+from collections import deque
+
+import numpy
+
+from tracing import tracer
+
+WRAP = 1 << 32  # the int32 device clock wraps around
+
+
+class ClockSync:
+    def __init__(self, lick_o_meter, window=64, interval=10.0, rtt_quantile=0.5, device_unit=1e-6):
+        """
+        Parameters
+        ----------
+        lick_o_meter : lickometer.Protocol
+        window : int, optional
+            Number of the last exchanges used by the fit.
+        interval : float, optional
+            Seconds between two re-syncs by update().
+        rtt_quantile : float, optional
+            Only the exchanges with a round trip below this quantile are fitted (the others were delayed by USB or
+            the OS scheduler).
+        device_unit : float, optional
+            Seconds per tick of the device clock (micros(): 1e-6).
+        """
+        self.lick_o_meter = lick_o_meter
+        self.interval = interval
+        self.rtt_quantile = rtt_quantile
+        self.device_unit = device_unit
+        self.samples = deque(maxlen=window)  # (host midpoint s, device s unwrapped, round trip s)
+        self.slope = 1.0
+        self.intercept = None  # host time at device time 0
+        self.error = None      # median absolute residual of the fitted exchanges (s)
+        self.last_sync = None
+        self._last_raw = None
+        self._wraps = 0
+        self._connection = lick_o_meter.serial
+
+    @property
+    def synchronised(self):
+        return self.intercept is not None
+
+    @property
+    def drift_ppm(self):
+        """
+        :return: (float) how much faster the device clock runs than the host clock, in parts per million
+        """
+        return (1 / self.slope - 1) * 1e6
+
+    def reset(self):
+        """
+        Forget the exchanges, e.g. after the Arduino restarted and its clock started from 0 again.
+        """
+        self.samples.clear()
+        self.intercept = None
+        self.error = None
+        self._last_raw = None
+        self._wraps = 0
+
+    def _unwrap(self, raw):
+        raw &= WRAP - 1
+        if self._last_raw is not None and raw < self._last_raw - WRAP // 2:
+            self._wraps += 1
+        self._last_raw = raw
+        return (raw + self._wraps * WRAP) * self.device_unit
+
+    def ping(self):
+        """
+        One exchange with the Lickometer.
+
+        Returns
+        -------
+        float: round trip (s), None on timeout
+        """
+        if self.lick_o_meter.serial is not self._connection:
+            # reconnected: the Arduino restarted
+            self._connection = self.lick_o_meter.serial
+            self.reset()
+        result = self.lick_o_meter.ping()
+        if result is None:
+            return None
+        send, receive, device_time = result
+        self.samples.append(((send + receive) / 2, self._unwrap(device_time), receive - send))
+        return receive - send
+
+    def sync(self, n=16, pause=0.002):
+        """
+        Burst of n pings followed by a new fit.
+
+        Returns
+        -------
+        bool: False if no exchange succeeded
+        """
+        for _ in range(n):
+            self.ping()
+            time.sleep(pause)
+        self.last_sync = time.perf_counter()
+        return self.fit()
+
+    def update(self, n=4):
+        """
+        Re-sync if the last sync is older than interval, cheap enough to be called between trials.
+
+        Returns
+        -------
+        bool: True if synchronised
+        """
+        if self.last_sync is None or time.perf_counter() - self.last_sync >= self.interval:
+            self.sync(n)
+        return self.synchronised
+
+    def fit(self):
+        """
+        Fit host = intercept + slope * device on the exchanges with short round trips (Theil-Sen: median of the
+        pairwise slopes, robust to the remaining delayed exchanges).
+
+        Returns
+        -------
+        bool: False if there are not enough exchanges
+        """
+        if not self.samples:
+            return False
+        host, device, rtt = numpy.array(self.samples).T
+        keep = rtt <= numpy.quantile(rtt, self.rtt_quantile)
+        host, device = host[keep], device[keep]
+
+        # centred for precision
+        host0, device0 = host[0], device[0]
+        host, device = host - host0, device - device0
+        if len(host) >= 2 and device.max() - device.min() > 0:
+            i, j = numpy.triu_indices(len(host), 1)
+            dd = device[j] - device[i]
+            valid = dd != 0
+            slope = float(numpy.median((host[j] - host[i])[valid] / dd[valid]))
+            # the pings of one burst are too close in time to estimate the drift against jitter
+            if device.max() - device.min() < 1.0:
+                slope = self.slope
+        else:
+            slope = self.slope
+        offset = float(numpy.median(host - slope * device))
+        self.slope = slope
+        self.intercept = host0 + offset - slope * device0
+        self.error = float(numpy.median(numpy.abs(host - offset - slope * device)))
+        if tracer.debugging:
+            tracer.debug('ClockSync: drift {:.1f} ppm, error {:.1f} us, {} exchanges', self.drift_ppm,
+                         self.error * 1e6, len(host), source=self.lick_o_meter.port)
+        return True
+
+    def to_host(self, device_time):
+        """
+        :param device_time: (int) device timestamp (e.g. Event.device_time), may have wrapped around
+        :return: (float) host time.perf_counter() seconds
+        """
+        raw = (device_time & (WRAP - 1)) + self._wraps * WRAP
+        # the wrap closest to the last exchange
+        if self._last_raw is not None:
+            reference = self._last_raw + self._wraps * WRAP
+            raw += round((reference - raw) / WRAP) * WRAP
+        return self.intercept + self.slope * raw * self.device_unit
+
+    def to_device(self, host_time):
+        """
+        :param host_time: (float) time.perf_counter() seconds
+        :return: (int) device timestamp (int32, wrapped like the device clock)
+        """
+        raw = int(round((host_time - self.intercept) / self.slope / self.device_unit)) & (WRAP - 1)
+        return raw - WRAP if raw >= WRAP // 2 else raw
+
+    def to_clock(self, device_time, clock):
+        """
+        :param clock: psychopy.core.Clock (e.g. the clock of the window flip timestamps)
+        :return: (float) time of the device timestamp on clock
+        """
+        return self.to_host(device_time) - clock.getLastResetTime()
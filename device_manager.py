@@ -0,0 +1,209 @@
+"""
+Drive several Lickometers (one per rig) from one process.
+
+Every Lickometer gets its own worker thread running its orders one after the other, so the rigs are driven in
+parallel while the orders of one rig never interleave on its serial port. The Events of all the rigs are aggregated
+into a single queue, tagged with the rig they come from: the result of every lick and reward order run by the workers
+(see DeviceWorker.PUBLISHED) and the records decoded while a device reader is in event mode:
+
+    with LickometerManager({'rig1': {'serial_number': '5583...'}, 'rig2': {'port': '/dev/ttyACM1'}}) as manager:
+        manager.broadcast('set_size', 1)
+        licks = manager.submit('rig1', 'watch_licks')   # concurrent.futures.Future
+        manager.call('rig2', 'reward', 'up')
+        print(licks.result())
+        print(manager.wait_event(1))   # e.g. Event(order=Order.WFL, value='100', ..., rig='rig1')
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from lickometer import Event, Lickometer, find_arduinos
+
+
+class DeviceWorker(threading.Thread):
+    """
+    Thread running the methods of one device in submission order.
+    """
+
+    # methods whose result is published as an Event: method name --> order of the Event
+    PUBLISHED = {'watch_licks': Lickometer.Order.WFL, 'reward': Lickometer.Order.REW,
+                 'reward_composite': Lickometer.Order.REW_SIDE_SIZE}
+
+    def __init__(self, device, name=None, events=None, rig=None):
+        """
+        :param device: (Lickometer)
+        :param events: optional queue receiving an Event with the result of every PUBLISHED method
+        :param rig: id of the device put into the Events
+        """
+        super(DeviceWorker, self).__init__(name=name or f'DeviceWorker({device.port})', daemon=True)
+        self.device = device
+        self.events = events
+        self.rig = rig
+        self.jobs = queue.Queue()
+        self.start()
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            future, method, args, kwargs = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = method(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+                continue
+            order = self.PUBLISHED.get(getattr(method, '__name__', None))
+            if self.events is not None and order is not None:
+                # no device time: the result of the order, not a record sent by the device
+                self.events.put(Event(order, result, None, time.time(), self.rig))
+            future.set_result(result)
+
+    def submit(self, method, *args, **kwargs):
+        """
+        Queue a call of the device.
+
+        Parameters
+        ----------
+        method : str or callable
+            Name of the method of the device, or a callable run in the worker thread.
+
+        Returns
+        -------
+        concurrent.futures.Future: result of the call
+        """
+        if isinstance(method, str):
+            method = getattr(self.device, method)
+        future = Future()
+        self.jobs.put((future, method, args, kwargs))
+        return future
+
+    def stop(self, timeout=None):
+        """
+        Stop the worker once the queued calls are done.
+        """
+        self.jobs.put(None)
+        self.join(timeout)
+
+
+class LickometerManager:
+    """
+    Open and drive several Lickometers, one worker thread per rig.
+    """
+
+    def __init__(self, rigs=None, **kwargs):
+        """
+        Parameters
+        ----------
+        rigs : dict, optional
+            {rig id: Lickometer keyword arguments (e.g. port or serial_number)}.
+            (Default: every Arduino found, the rig id is its serial number or port)
+        kwargs :
+            Keyword arguments common to all the Lickometers.
+        """
+        if rigs is None:
+            rigs = {}
+            for port in find_arduinos():
+                if port.serial_number is not None:
+                    rigs[port.serial_number] = {'serial_number': port.serial_number}
+                else:
+                    rigs[port.device] = {'port': port.device}
+        if not rigs:
+            raise ValueError('No rig to manage')
+
+        # Events of all the rigs, see Event.rig
+        self.events = queue.Queue()
+        self.devices = {}
+        self.workers = {}
+
+        # the Arduinos restart when the port is opened: open them in parallel
+        with ThreadPoolExecutor(max_workers=len(rigs), thread_name_prefix='LickometerManager') as pool:
+            opening = {rig: pool.submit(Lickometer, **{**kwargs, **rig_kwargs, 'rig': rig,
+                                                       'forward_events': self.events})
+                       for rig, rig_kwargs in rigs.items()}
+        failed = {}
+        for rig, future in opening.items():
+            try:
+                self.devices[rig] = future.result()
+            except BaseException as e:
+                failed[rig] = e
+        if failed:
+            self.close()
+            raise ConnectionError(f'Could not open rigs {list(failed)}: {failed}')
+
+        for rig, device in self.devices.items():
+            self.workers[rig] = DeviceWorker(device, name=f'DeviceWorker({rig})', events=self.events, rig=rig)
+
+    @property
+    def rigs(self):
+        return list(self.devices)
+
+    def __getitem__(self, rig):
+        return self.devices[rig]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, rig, method, *args, **kwargs):
+        """
+        Queue a call of the Lickometer of rig without waiting for it.
+
+        Returns
+        -------
+        concurrent.futures.Future: result of the call
+        """
+        return self.workers[rig].submit(method, *args, **kwargs)
+
+    def call(self, rig, method, *args, timeout=None, **kwargs):
+        """
+        Call the Lickometer of rig (after its queued calls) and wait for the result.
+        """
+        return self.submit(rig, method, *args, **kwargs).result(timeout)
+
+    def broadcast(self, method, *args, timeout=None, **kwargs):
+        """
+        Call the same method of all the Lickometers in parallel and wait for all of them.
+
+        Returns
+        -------
+        dict: {rig id: result}
+        """
+        futures = {rig: self.submit(rig, method, *args, **kwargs) for rig in self.workers}
+        return {rig: future.result(timeout) for rig, future in futures.items()}
+
+    def wait_event(self, timeout=None):
+        """
+        Wait for the next Event of any rig: results of the lick and reward orders (value: result of the method,
+        device_time: None) and records decoded in event mode.
+
+        Returns
+        -------
+        Event: its rig field is the rig id, None if the timeout expired
+        """
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        for worker in self.workers.values():
+            worker.stop()
+        for device in self.devices.values():
+            device.close()
+        self.workers.clear()
+        self.devices.clear()
+
+
+if __name__ == '__main__':
+    with LickometerManager() as manager:
+        print(f'Rigs: {manager.rigs}')
+        manager.broadcast('set_size', 1)
+        manager.broadcast('set_timeout', 5)
+        print(manager.broadcast('watch_licks'))
@@ -0,0 +1,108 @@
+"""
+Timestamps of the presented frames and dropped-frame detection.
+
+Every flip() of a window is recorded in a preallocated array. Between start_trial() and end_trial() the intervals
+between consecutive flips of a window are checked: an interval longer than drop_factor frame durations means at least
+one frame was dropped (the previous frame stayed on the screen longer than planned):
+
+    frames = FrameRecorder(frame_dur, ['left', 'right'])
+    frames.start_trial()
+    while ...:
+        frames.record('left', win_l.flip())
+        frames.record('right', win_r.flip())
+    stats = frames.end_trial()      # {'frames': 180, 'dropped': 1, 'max_interval': 0.0334, 'windows': {...}}
+"""
+
+import numpy
+
+
+class FrameRecorder:
+    def __init__(self, frame_dur, windows=('left', 'right'), capacity=1 << 16, drop_factor=1.5):
+        """
+        Parameters
+        ----------
+        frame_dur : float
+            Expected duration of a frame (s), e.g. VisualStimulator.frameDur.
+        windows : iterable of str, optional
+            Names of the windows.
+        capacity : int, optional
+            Frames preallocated per window (the arrays grow if a session is longer).
+        drop_factor : float, optional
+            Intervals longer than drop_factor * frame_dur are counted as dropped frames.
+        """
+        self.frame_dur = frame_dur
+        self.drop_factor = drop_factor
+        self.windows = list(windows)
+        self.times = {w: numpy.empty(capacity) for w in self.windows}
+        self.count = {w: 0 for w in self.windows}
+        self.trial_start = None  # {window: index of the first flip of the trial}
+        self.trials = []         # statistics of the ended trials
+
+    @property
+    def drop_threshold(self):
+        return self.drop_factor * self.frame_dur
+
+    def record(self, window, t):
+        """
+        :param window: (str) name of the window
+        :param t: (float) timestamp returned by window.flip()
+        """
+        i = self.count[window]
+        times = self.times[window]
+        if i == len(times):
+            times = self.times[window] = numpy.resize(times, 2 * len(times))
+        times[i] = t
+        self.count[window] = i + 1
+
+    def flip(self, window, win):
+        """
+        Flip win and record its timestamp.
+
+        Returns
+        -------
+        float: flip timestamp
+        """
+        t = win.flip()
+        self.record(window, t)
+        return t
+
+    def timestamps(self, window):
+        """
+        :return: (numpy.ndarray) flip timestamps of the session (view, not a copy)
+        """
+        return self.times[window][:self.count[window]]
+
+    def start_trial(self):
+        self.trial_start = dict(self.count)
+
+    def trial_stats(self):
+        """
+        Frame statistics of the running trial.
+
+        Returns
+        -------
+        dict: frames (most flips of a window), dropped (intervals above the threshold, all windows), max_interval (s),
+            windows: {window: {frames, dropped, max_interval}}
+        """
+        start = self.trial_start or {w: 0 for w in self.windows}
+        windows = {}
+        for w in self.windows:
+            intervals = numpy.diff(self.times[w][start[w]:self.count[w]])
+            windows[w] = {'frames': self.count[w] - start[w],
+                          'dropped': int(numpy.count_nonzero(intervals > self.drop_threshold)),
+                          'max_interval': float(intervals.max()) if len(intervals) else 0.0}
+        return {'frames': max((s['frames'] for s in windows.values()), default=0),
+                'dropped': sum(s['dropped'] for s in windows.values()),
+                'max_interval': max((s['max_interval'] for s in windows.values()), default=0.0),
+                'windows': windows}
+
+    def end_trial(self):
+        """
+        Returns
+        -------
+        dict: see trial_stats(), also appended to self.trials
+        """
+        stats = self.trial_stats()
+        self.trials.append(stats)
+        self.trial_start = None
+        return stats
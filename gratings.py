@@ -0,0 +1,449 @@
+"""
+Grating textures of the stimuli, computed once with NumPy and cached.
+
+psychopy builds the texture ('sin', 'sqr') and the mask ('gauss', 'circle') of every GratingStim when it is created.
+The textures only depend on their name and resolution (sf, contrast, size, ori and phase are applied by OpenGL when
+drawing), so the arrays are computed once, shared by the stimuli of both windows and saved in ~/.jumpstand/textures
+for the next sessions:
+
+    from gratings import textures
+
+    stim = visual.GratingStim(win, sf=0.1, ori=90, **textures.stim_kwargs('sqr', 'gauss'))
+
+The arrays follow the conventions of psychopy (values in [-1, 1], one period of the grating across the columns, -1
+is transparent in a mask), so the stimuli look the same as with the named textures.
+
+render_grating() computes the pixels of a GratingStim from these textures (used by headless.py), grating_frames()
+renders a whole batch of (ori, phase) frames in one vectorized call and export_movie() streams the frames of a session
+into a memory-mapped .npy file, chunk by chunk:
+
+    phases = numpy.mod(numpy.arange(n_frames) * frame_dur, 1)
+    movie = export_movie('session.npy', 1920, 1080, oris, phases, sf=0.1, contrast=1.0, pix_per_deg=pix_per_deg)
+"""
+
+import os
+
+import numpy
+
+TEXTURE_CACHE = os.path.join(os.path.expanduser('~'), '.jumpstand', 'textures')
+TEXTURE_RES = 128  # default texRes of psychopy GratingStim
+
+
+def radial_matrix(res):
+    """
+    :return: (numpy.ndarray) distance from the centre of a res x res matrix, 1 at the middle of the edges
+    """
+    yy, xx = numpy.mgrid[0:res, 0:res]
+    xx = 1.0 - 2.0 / res * xx
+    yy = 1.0 - 2.0 / res * yy
+    return numpy.sqrt(xx ** 2 + yy ** 2)
+
+
+def make_texture(name, res=TEXTURE_RES):
+    """
+    Compute a texture or mask the way psychopy does for its named textures.
+
+    Parameters
+    ----------
+    name : str
+        'sin', 'sqr' (textures), 'gauss', 'circle' (masks).
+    res : int, optional
+        Width and height of the texture, a power of 2.
+
+    Returns
+    -------
+    numpy.ndarray: (res, res) float32 in [-1, 1]
+    """
+    if name in ('sin', 'sqr'):
+        one_period = numpy.linspace(0, 2 * numpy.pi, res)
+        intensity = numpy.sin(one_period - numpy.pi / 2)
+        if name == 'sqr':
+            intensity = numpy.where(intensity > 0, 1.0, -1.0)
+        texture = numpy.broadcast_to(intensity, (res, res))
+    elif name == 'gauss':
+        sigma = 1.0 / 3.0
+        texture = numpy.exp(-radial_matrix(res) ** 2 / (2.0 * sigma ** 2)) * 2 - 1
+    elif name == 'circle':
+        texture = (radial_matrix(res) <= 1) * 2.0 - 1
+    else:
+        raise ValueError(f'Unknown texture: {name}')
+    return numpy.ascontiguousarray(texture, dtype=numpy.float32)
+
+
+def _sample(texture, s, t, interpolate=False, wrap=True):
+    """
+    Sample a texture like OpenGL at texture coordinates (s along the columns, t along the rows).
+    """
+    res_t, res_s = texture.shape
+    if wrap:
+        s = s - numpy.floor(s)
+        t = t - numpy.floor(t)
+    else:
+        s = numpy.clip(s, 0.0, 1.0)
+        t = numpy.clip(t, 0.0, 1.0)
+    if not interpolate:
+        # GL_NEAREST
+        col = numpy.minimum((s * res_s).astype(numpy.intp), res_s - 1)
+        row = numpy.minimum((t * res_t).astype(numpy.intp), res_t - 1)
+        return texture[row, col]
+    # GL_LINEAR between the texel centres
+    fs = s * res_s - 0.5
+    ft = t * res_t - 0.5
+    s0, t0 = numpy.floor(fs), numpy.floor(ft)
+    ws, wt = fs - s0, ft - t0
+    s0, t0 = s0.astype(numpy.intp), t0.astype(numpy.intp)
+    if wrap:
+        s0, s1 = s0 % res_s, (s0 + 1) % res_s
+        t0, t1 = t0 % res_t, (t0 + 1) % res_t
+    else:
+        s0, s1 = numpy.clip(s0, 0, res_s - 1), numpy.clip(s0 + 1, 0, res_s - 1)
+        t0, t1 = numpy.clip(t0, 0, res_t - 1), numpy.clip(t0 + 1, 0, res_t - 1)
+    return ((texture[t0, s0] * (1 - ws) + texture[t0, s1] * ws) * (1 - wt) +
+            (texture[t1, s0] * (1 - ws) + texture[t1, s1] * ws) * wt)
+
+
+def _sample_1d(row, u):
+    """
+    GL_NEAREST lookup of a texture constant along its rows (the gratings): only the column matters.
+
+    u is s * resolution (texels), overwritten.
+    """
+    res = len(row)
+    index = numpy.floor(u, out=u).astype(numpy.int32)
+    if res & (res - 1):
+        index %= res
+    else:
+        # wrap by the power of 2 resolution, floor and & also wrap the negative coordinates
+        index &= res - 1
+    return row.take(index)
+
+
+def _render(dx, dy, width, height, sf_x, sf_y, cos, sin, phase_x, phase_y, gain, opacity, tex, mask, res,
+            interpolate, cache):
+    """
+    Pixels of a grating. dx (..., 1, w) and dy (..., h, 1) are the pixel positions, cos, sin and phase_x scalars or
+    (n, 1, 1) arrays of a batch of frames. Every coordinate is the sum of a row and a column term, the constants are
+    folded into these small operands so the full-size arrays only see an addition and the texture lookup.
+
+    Returns
+    -------
+    (numpy.ndarray, numpy.ndarray or None): color and alpha, alpha None where the grating covers every pixel
+    """
+    texture = cache.get(tex, res)
+    if texture is None:
+        value = numpy.full(numpy.broadcast_shapes(numpy.shape(dx * cos), numpy.shape(dy * sin)), gain,
+                           dtype=numpy.float32)
+    else:
+        # texture coordinates: s = x * sf_x - phase_x + 0.5 with x the position in the frame of the grating
+        if not interpolate and (texture == texture[0]).all():
+            # in texels: one pixel costs an addition and the lookup, a single row or column if the grating is
+            # horizontal or vertical
+            res_s = texture.shape[1]
+            u = (0.5 - phase_x) * res_s
+            if numpy.any(cos):
+                u = u + dx * (cos * sf_x * res_s)
+            if numpy.any(sin):
+                u = u - dy * (sin * sf_x * res_s)
+            value = _sample_1d(texture[0], u)
+        else:
+            s = (dx * (cos * sf_x) + (0.5 - phase_x)) - dy * (sin * sf_x)
+            t = (dx * (sin * sf_y) + (0.5 - phase_y)) + dy * (cos * sf_y)
+            value = _sample(texture, s, t, interpolate)
+        if gain != 1:
+            value = value * numpy.float32(gain)
+
+    # the grating covers every pixel if it covers the corners of the region (both are convex)
+    corners_x = numpy.array([numpy.min(dx), numpy.max(dx)]).reshape(1, 2, 1)
+    corners_y = numpy.array([numpy.min(dy), numpy.max(dy)]).reshape(2, 1, 1)
+    cos_, sin_ = numpy.ravel(cos)[numpy.newaxis, numpy.newaxis, :], numpy.ravel(sin)[numpy.newaxis, numpy.newaxis, :]
+    covered = (numpy.all(numpy.abs(corners_x * cos_ - corners_y * sin_) <= width / 2) and
+               numpy.all(numpy.abs(corners_x * sin_ + corners_y * cos_) <= height / 2))
+    if mask is None and covered:
+        return value, (None if opacity == 1 else numpy.float32(opacity))
+
+    # mask coordinates: 0 to 1 across the grating
+    ms = (dx * (cos / width) + 0.5) - dy * (sin / width)
+    mt = (dx * (sin / height) + 0.5) + dy * (cos / height)
+    alpha = numpy.float32(opacity)
+    if not covered:
+        alpha = ((ms >= 0) & (ms < 1) & (mt >= 0) & (mt < 1)) * alpha
+    if mask is not None:
+        alpha = alpha * ((_sample(cache.get(mask, res), ms, mt, interpolate, wrap=False) + 1) / 2)
+    return value, alpha
+
+
+def render_grating(dx, dy, size, sf, ori=0.0, phase=0.0, contrast=1.0, color=1.0, opacity=1.0, tex='sin', mask=None,
+                   res=None, interpolate=False, cache=None):
+    """
+    Pixels of a psychopy GratingStim, as OpenGL draws it.
+
+    Parameters
+    ----------
+    dx, dy : numpy.ndarray
+        Position of the pixels relative to the centre of the grating (pix, y upwards): a (1, w) row and a (h, 1)
+        column.
+    size : (float, float)
+        Width and height of the grating (pix).
+    sf : float or (float, float)
+        Spatial frequency (cycles / pix).
+    ori : float, optional
+        Orientation (degrees, clockwise).
+    phase : float or (float, float), optional
+        Phase (cycles).
+    contrast, color, opacity : float, optional
+        Grayscale color in [-1, 1], see psychopy.
+    tex, mask : str, optional
+        Names of the texture and mask, see make_texture(). tex None: uniform color.
+    res : int, optional
+        Resolution of the textures (Default: resolution of the cache).
+    cache : TextureCache, optional
+        (Default: textures)
+
+    Returns
+    -------
+    (numpy.ndarray, numpy.ndarray or float): color in [-1, 1] and alpha in [0, 1] of the pixels (0 outside the
+        grating)
+    """
+    sf_x, sf_y = (float(v) for v in numpy.broadcast_to(numpy.asarray(sf, dtype=float), (2,)))
+    phase_x, phase_y = (float(v) for v in numpy.broadcast_to(numpy.asarray(phase, dtype=float), (2,)))
+    width, height = (float(v) for v in numpy.broadcast_to(numpy.asarray(size, dtype=float), (2,)))
+    theta = numpy.deg2rad(ori)
+    cos, sin = float(numpy.cos(theta)), float(numpy.sin(theta))
+    if ori % 90 == 0:
+        # exact, a horizontal or vertical grating is rendered from a single row or column
+        cos, sin = float(round(cos)), float(round(sin))
+    value, alpha = _render(dx, dy, width, height, sf_x, sf_y, cos, sin, phase_x, phase_y, contrast * color, opacity,
+                           tex, mask, res, interpolate, cache or textures)
+    return value, (numpy.float32(1) if alpha is None else alpha)
+
+
+class TextureCache:
+    """
+    Textures by (name, resolution), kept in memory and on disk.
+    """
+
+    def __init__(self, path=TEXTURE_CACHE, res=TEXTURE_RES):
+        """
+        Parameters
+        ----------
+        path : str, optional
+            Directory of the saved textures, None: memory only.
+        res : int, optional
+            Default resolution of the textures.
+        """
+        self.path = path
+        self.res = res
+        self.textures = {}
+
+    def _file(self, name, res):
+        return os.path.join(self.path, f'{name}_{res}.npy')
+
+    def get(self, name, res=None):
+        """
+        Parameters
+        ----------
+        name : str or None
+            See make_texture(), None (no texture / mask) is returned as is.
+        res : int, optional
+            (Default: self.res)
+
+        Returns
+        -------
+        numpy.ndarray: read-only texture shared by all the callers
+        """
+        if name is None:
+            return None
+        res = res or self.res
+        key = (name, res)
+        texture = self.textures.get(key)
+        if texture is not None:
+            return texture
+
+        texture = None
+        if self.path is not None:
+            try:
+                texture = numpy.load(self._file(name, res))
+                if texture.shape != (res, res):
+                    texture = None
+            except (OSError, ValueError):
+                texture = None
+        if texture is None:
+            texture = make_texture(name, res)
+            self._save(name, res, texture)
+        texture.setflags(write=False)
+        self.textures[key] = texture
+        return texture
+
+    def _save(self, name, res, texture):
+        if self.path is None:
+            return
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            temporary = self._file(name, res) + '.tmp'
+            with open(temporary, 'wb') as f:
+                numpy.save(f, texture)
+            os.replace(temporary, self._file(name, res))
+        except OSError:
+            pass  # the cache is only an optimisation
+
+    def stim_kwargs(self, tex='sin', mask=None, res=None):
+        """
+        Keyword arguments of psychopy.visual.GratingStim using the cached arrays.
+
+        Returns
+        -------
+        dict: tex, mask, texRes
+        """
+        res = res or self.res
+        return {'tex': self.get(tex, res), 'mask': self.get(mask, res), 'texRes': res}
+
+    def clear(self):
+        """
+        Forget the textures in memory and on disk.
+        """
+        self.textures.clear()
+        if self.path is not None and os.path.isdir(self.path):
+            for file in os.listdir(self.path):
+                if file.endswith('.npy'):
+                    os.remove(os.path.join(self.path, file))
+
+
+# Textures shared by the stimuli of the project
+textures = TextureCache()
+
+
+def grating_frames(width, height, oris, phases, sf, size=None, contrast=1.0, tex='sqr', mask=None, background=0.0,
+                   pos=(0, 0), pix_per_deg=1.0, res=None, interpolate=False, cache=None, out=None):
+    """
+    Frames of a full-screen grating for a batch of (ori, phase) pairs, rendered in one vectorized call.
+
+    Parameters
+    ----------
+    width, height : int
+        Size of the frames (pix).
+    oris, phases : array_like
+        Orientation (degrees, clockwise) and phase (cycles) of the grating in every frame, broadcast to the same length.
+    sf : float or (float, float)
+        Spatial frequency (cycles / deg, see pix_per_deg).
+    size : float or (float, float), optional
+        Size of the grating (deg), None: large enough to cover the frames at any orientation.
+    contrast, tex, mask, res, interpolate, cache : optional
+        See render_grating().
+    background : float, optional
+        Grayscale color of the window in [-1, 1].
+    pos : (float, float), optional
+        Centre of the grating relative to the centre of the frames (deg, y upwards).
+    pix_per_deg : float, optional
+        Conversion of sf, size and pos to pixels (Default: 1, the parameters are in pix).
+    out : numpy.ndarray, optional
+        (n, height, width) array the frames are written into, float32 or uint8 (see to_uint8()).
+
+    Returns
+    -------
+    numpy.ndarray: (n, height, width) frames, float32 in [-1, 1] by default
+    """
+    oris, phases = numpy.broadcast_arrays(numpy.atleast_1d(numpy.asarray(oris, dtype=float)),
+                                          numpy.atleast_1d(numpy.asarray(phases, dtype=float)))
+    if out is None:
+        out = numpy.empty((len(oris), height, width), dtype=numpy.float32)
+    dx = (numpy.arange(width, dtype=numpy.float32) - (width - 1) / 2 - pos[0] * pix_per_deg)[numpy.newaxis, :]
+    dy = ((height - 1) / 2 - numpy.arange(height, dtype=numpy.float32) - pos[1] * pix_per_deg)[:, numpy.newaxis]
+    if size is None:
+        size = 2 * numpy.hypot(width, height) + 2 * numpy.hypot(*pos) * pix_per_deg
+    else:
+        size = numpy.asarray(size, dtype=float) * pix_per_deg
+    width_g, height_g = (float(v) for v in numpy.broadcast_to(size, (2,)))
+    sf_x, sf_y = (float(v) for v in numpy.broadcast_to(numpy.asarray(sf, dtype=float) / pix_per_deg, (2,)))
+
+    # float32 operands keep the (n, height, width) arrays in float32, exact cos and sin at multiples of 90 degrees
+    theta = numpy.deg2rad(oris)[:, numpy.newaxis, numpy.newaxis]
+    cos, sin = numpy.cos(theta).astype(numpy.float32), numpy.sin(theta).astype(numpy.float32)
+    right = (oris % 90 == 0)[:, numpy.newaxis, numpy.newaxis]
+    cos, sin = numpy.where(right, numpy.round(cos), cos), numpy.where(right, numpy.round(sin), sin)
+    phase = phases[:, numpy.newaxis, numpy.newaxis].astype(numpy.float32)
+
+    # vertical, horizontal and oblique gratings are rendered separately, the first two from a single row or column
+    cos_1d, sin_1d = cos.ravel(), sin.ravel()
+    for group in (sin_1d == 0, cos_1d == 0, (cos_1d != 0) & (sin_1d != 0)):
+        if not group.any():
+            continue
+        value, alpha = _render(dx, dy, width_g, height_g, sf_x, sf_y, cos[group], sin[group], phase[group], 0.0,
+                               contrast, 1.0, tex, mask, res, interpolate, cache or textures)
+        if alpha is not None:
+            # blendMode 'avg' over the background
+            value = alpha * (value - numpy.float32(background)) + numpy.float32(background)
+        if out.dtype == numpy.uint8:
+            # before broadcasting a row or column to the frames
+            value = to_uint8(value)
+        if group.all():
+            out[...] = value
+        else:
+            out[group] = value
+    return out
+
+
+def to_uint8(frames):
+    """
+    :return: (numpy.ndarray) psychopy colors in [-1, 1] as 0 (black) to 255 (white)
+    """
+    return numpy.clip(numpy.rint((numpy.asarray(frames, dtype=numpy.float32) + 1) * 127.5), 0, 255).astype(numpy.uint8)
+
+
+def grating_chunks(width, height, oris, phases, chunk=None, out=None, dtype=numpy.float32, **kwargs):
+    """
+    Generate the frames of grating_frames() by chunks, so a whole session is rendered in constant memory.
+
+    Parameters
+    ----------
+    chunk : int, optional
+        Frames per chunk (Default: ~4 Mpixels per chunk).
+    out : numpy.ndarray, optional
+        (n, height, width) array (e.g. a numpy.memmap) the chunks are written into, None: a buffer reused by the
+        chunks.
+    dtype : numpy.dtype, optional
+        float32 or uint8 (see grating_frames()) of the buffer.
+    kwargs :
+        See grating_frames().
+
+    Yields
+    ------
+    (int, numpy.ndarray): index of the first frame of the chunk and its frames
+    """
+    oris, phases = numpy.broadcast_arrays(numpy.atleast_1d(numpy.asarray(oris, dtype=float)),
+                                          numpy.atleast_1d(numpy.asarray(phases, dtype=float)))
+    chunk = chunk or max(1, (1 << 22) // (width * height))
+    buffer = None if out is not None else numpy.empty((min(chunk, len(oris)), height, width), dtype=dtype)
+    for start in range(0, len(oris), chunk):
+        stop = min(start + chunk, len(oris))
+        frames = out[start:stop] if out is not None else buffer[:stop - start]
+        yield start, grating_frames(width, height, oris[start:stop], phases[start:stop], out=frames, **kwargs)
+
+
+def export_movie(path, width, height, oris, phases, dtype=numpy.uint8, chunk=None, **kwargs):
+    """
+    Render the frames of a stimulus sequence into a memory-mapped .npy file, chunk by chunk.
+
+    The phases of a drifting grating (iterate_motion_time_grating_2afc) are those of the frame times, e.g.
+    numpy.mod(numpy.arange(n_frames) * frame_dur, 1).
+
+    Parameters
+    ----------
+    path : str
+        .npy file, read back with numpy.load(path, mmap_mode='r').
+    width, height, oris, phases, kwargs :
+        See grating_frames().
+    dtype : numpy.dtype, optional
+        uint8: 0 (black) to 255 (white), float32: psychopy colors in [-1, 1].
+    chunk : int, optional
+        See grating_chunks().
+
+    Returns
+    -------
+    numpy.memmap: (n, height, width) frames
+    """
+    n_frames = numpy.broadcast(numpy.atleast_1d(oris), numpy.atleast_1d(phases)).size
+    movie = numpy.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(n_frames, height, width))
+    for _ in grating_chunks(width, height, oris, phases, chunk, out=movie, **kwargs):
+        pass
+    movie.flush()
+    return movie
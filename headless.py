@@ -0,0 +1,333 @@
+"""
+Headless rendering of the stimuli: NumPy software rendering into offscreen buffers, no display or OpenGL needed.
+
+Window, GratingStim, Rect, TextStim and Mouse have the parts of the psychopy interface used by the stimulus classes,
+so the same code runs on a build box and the frames can be read as arrays:
+
+    win = headless.Window((1920, 1080), color=0, units='deg', pix_per_deg=35.0)
+    grating = headless.GratingStim(win, sf=0.1, size=60, tex='sqr', ori=90)
+    grating.draw()
+    win.flip()
+    frame = win.get_frame()        # (1080, 1920) float32, psychopy rgb [-1, 1]
+
+VisualStimulator (params['headless']) and TwoAFC (headless=True) create these instead of psychopy windows. Frames are
+grayscale and flip() does not wait for a vertical blank, so a render loop runs as fast as the stimuli can be drawn:
+
+    python headless.py     # render cost of the gratings of the experiments
+"""
+
+import time
+
+import numpy
+
+import gratings
+
+
+def _gray(color):
+    """
+    :return: (float) grayscale value of a psychopy rgb color (number or triplet in [-1, 1])
+    """
+    if color is None:
+        return 0.0
+    if isinstance(color, str):
+        return {'white': 1.0, 'black': -1.0, 'gray': 0.0, 'grey': 0.0}.get(color.lower(), 0.0)
+    return float(numpy.mean(color))
+
+
+class Window:
+    """
+    Offscreen window: a back buffer the stimuli are drawn into and the front buffer of the last flipped frame.
+    """
+
+    def __init__(self, size=(800, 600), color=0, units=None, pix_per_deg=None, monitor=None, name='headless',
+                 **kwargs):
+        """
+        Parameters
+        ----------
+        size : (int, int)
+            Width and height (pix).
+        color : optional
+            Background color (psychopy rgb).
+        units : str, optional
+            Default units of the stimuli: 'pix', 'deg', 'norm' or 'height' (Default: the units of the monitor, else
+            'norm' like psychopy.visual.Window).
+        pix_per_deg : float, optional
+            Conversion of 'deg' units (Default: from monitor, see psychopy.tools.monitorunittools).
+        monitor : psychopy.monitors.Monitor, optional
+        kwargs :
+            Other psychopy.visual.Window arguments, ignored.
+        """
+        self.size = numpy.array(size, dtype=int)
+        self.color = color
+        if units is None and monitor is not None:
+            units = monitor.getUnits()
+        self.units = units or 'norm'
+        self.monitor = monitor
+        self.name = name
+        if pix_per_deg is None and monitor is not None:
+            from psychopy.tools import monitorunittools
+            pix_per_deg = monitorunittools.deg2pix(1.0, monitor, correctFlat=False)
+        self.pix_per_deg = pix_per_deg
+        self.waitBlanking = True   # frames are never throttled
+        self.monitorFramePeriod = 1 / 60
+        self.frame_count = 0
+        self._toDraw = []
+
+        width, height = self.size
+        # pixel centres, origin at the centre of the window, y upwards
+        self.x = (numpy.arange(width, dtype=numpy.float32) - (width - 1) / 2)[numpy.newaxis, :]
+        self.y = ((height - 1) / 2 - numpy.arange(height, dtype=numpy.float32))[:, numpy.newaxis]
+        self.back = numpy.full((height, width), _gray(color), dtype=numpy.float32)
+        self.front = self.back.copy()
+
+    def to_pix(self, value, units=None):
+        """
+        :return: (numpy.ndarray) value (size or position, number or pair) in pixels
+        """
+        units = units or self.units
+        value = numpy.asarray(value, dtype=float)
+        if units == 'pix':
+            return value
+        if units == 'deg':
+            if self.pix_per_deg is None:
+                raise ValueError(f'{self.name}: deg units need pix_per_deg or a monitor')
+            return value * self.pix_per_deg
+        if units == 'norm':
+            return value * self.size / 2
+        if units == 'height':
+            return value * self.size[1]
+        raise ValueError(f'Unsupported units: {units}')
+
+    def clearBuffer(self):
+        self.back.fill(_gray(self.color))
+
+    def flip(self, clearBuffer=True):
+        """
+        Draw the autoDraw stimuli, make the back buffer the displayed frame.
+
+        Returns
+        -------
+        float: time.perf_counter() of the flip
+        """
+        for stim in self._toDraw:
+            stim.draw()
+        self.front, self.back = self.back, self.front
+        if clearBuffer:
+            self.clearBuffer()
+        else:
+            self.back[:] = self.front
+        self.frame_count += 1
+        return time.perf_counter()
+
+    def wait_blanking(self):
+        """
+        Called by presenter.DualPresenter: there is no vertical blank to wait for.
+        """
+        return time.perf_counter()
+
+    def get_frame(self):
+        """
+        :return: (numpy.ndarray) (height, width) pixels of the last flipped frame in [-1, 1], valid until the next flip
+        """
+        return self.front
+
+    def close(self):
+        pass
+
+
+class _Stim:
+    def __init__(self, win, units=None, pos=(0, 0), size=None, ori=0.0, opacity=1.0, name='', autoDraw=False):
+        self.win = win
+        self.units = units or win.units
+        self.pos = numpy.array(pos, dtype=float)
+        self.size = None if size is None else numpy.broadcast_to(numpy.asarray(size, dtype=float), (2,)).copy()
+        self.ori = ori
+        self.opacity = 1.0 if opacity is None else opacity
+        self.name = name
+        self.autoDraw = False
+        self.setAutoDraw(autoDraw)
+
+    def setAutoDraw(self, value):
+        if value and self not in self.win._toDraw:
+            self.win._toDraw.append(self)
+        elif not value and self in self.win._toDraw:
+            self.win._toDraw.remove(self)
+        self.autoDraw = value
+
+    def setSize(self, size, units=None):
+        size = numpy.broadcast_to(numpy.asarray(size, dtype=float), (2,))
+        if units is not None and units != self.units:
+            size = self.win.to_pix(size, units) / self.win.to_pix(1.0, self.units)
+        self.size = size.copy()
+
+    def _region(self):
+        """
+        :return: (slice, slice, dx, dy) rows & columns of the window covered by the stimulus and the position of their
+            pixels relative to the centre of the stimulus (pix)
+        """
+        width, height = self.win.to_pix(self.size, self.units)
+        pos = self.win.to_pix(self.pos, self.units)
+        # bounding box of the rotated stimulus
+        theta = numpy.deg2rad(self.ori)
+        half_w = (abs(width * numpy.cos(theta)) + abs(height * numpy.sin(theta))) / 2
+        half_h = (abs(width * numpy.sin(theta)) + abs(height * numpy.cos(theta))) / 2
+        win_w, win_h = self.win.size
+        cx, cy = (win_w - 1) / 2 + pos[0], (win_h - 1) / 2 - pos[1]
+        cols = slice(max(int(numpy.floor(cx - half_w)), 0), min(int(numpy.ceil(cx + half_w)) + 1, win_w))
+        rows = slice(max(int(numpy.floor(cy - half_h)), 0), min(int(numpy.ceil(cy + half_h)) + 1, win_h))
+        return rows, cols, self.win.x[:, cols] - pos[0], self.win.y[rows, :] - pos[1]
+
+    def _blend(self, rows, cols, value, alpha):
+        # blendMode 'avg'
+        region = self.win.back[rows, cols]
+        region += alpha * (value - region)
+
+    def contains(self, x, y=None, units=None):
+        """
+        :param x: point (x, y) or psychopy Mouse / headless Mouse
+        :return: (bool) True if the point is inside the (rotated) stimulus
+        """
+        if y is None:
+            x, y = x.getPos() if hasattr(x, 'getPos') else x
+        px, py = self.win.to_pix((x, y), units)
+        dx, dy = px - self.win.to_pix(self.pos, self.units)[0], py - self.win.to_pix(self.pos, self.units)[1]
+        theta = numpy.deg2rad(self.ori)
+        sx = dx * numpy.cos(theta) - dy * numpy.sin(theta)
+        sy = dx * numpy.sin(theta) + dy * numpy.cos(theta)
+        width, height = self.win.to_pix(self.size, self.units)
+        return bool(abs(sx) <= width / 2 and abs(sy) <= height / 2)
+
+
+class GratingStim(_Stim):
+    """
+    psychopy.visual.GratingStim rendered with gratings.render_grating().
+    """
+
+    def __init__(self, win, tex='sin', mask=None, units=None, pos=(0, 0), size=None, sf=None, ori=0.0, phase=(0.0, 0.0),
+                 texRes=None, color=(1.0, 1.0, 1.0), colorSpace='rgb', contrast=1.0, opacity=1.0, interpolate=False,
+                 name='', autoDraw=False, **kwargs):
+        """
+        tex and mask are names (see gratings.make_texture()) or arrays of the texture cache (the tex & mask of
+        gratings.textures.stim_kwargs()).
+        """
+        super(GratingStim, self).__init__(win, units, pos, size, ori, opacity, name, autoDraw)
+        self.tex = self._texture_name(tex)
+        self.mask = self._texture_name(mask)
+        self.texRes = texRes
+        self.sf = sf
+        self.phase = phase
+        self.color = color
+        self.contrast = contrast
+        self.interpolate = interpolate
+        if self.size is None:
+            # the whole window
+            self.size = self.win.size / self.win.to_pix(1.0, self.units)
+
+    @staticmethod
+    def _texture_name(texture):
+        if texture is None or isinstance(texture, str):
+            return texture
+        for (name, res), cached in gratings.textures.textures.items():
+            if cached is texture:
+                return name
+        raise ValueError('headless.GratingStim only draws named textures or arrays of gratings.textures')
+
+    def draw(self):
+        rows, cols, dx, dy = self._region()
+        if rows.start >= rows.stop or cols.start >= cols.stop:
+            return
+        size = self.win.to_pix(self.size, self.units)
+        # sf is in cycles per unit of the stimulus, None: one cycle across the stimulus
+        sf = 1.0 / size if self.sf is None else numpy.asarray(self.sf, dtype=float) / self.win.to_pix(1.0, self.units)
+        value, alpha = gratings.render_grating(dx, dy, size, sf, self.ori,
+                                               self.phase, self.contrast, _gray(self.color), self.opacity, self.tex,
+                                               self.mask, self.texRes, self.interpolate)
+        self._blend(rows, cols, value, alpha)
+
+
+class Rect(_Stim):
+    """
+    Filled rectangle (psychopy.visual.rect.Rect).
+    """
+
+    def __init__(self, win, width=0.5, height=0.5, units=None, fillColor='white', pos=(0, 0), size=None, ori=0.0,
+                 opacity=None, name='', autoDraw=False, **kwargs):
+        super(Rect, self).__init__(win, units, pos, (width, height) if size is None else size, ori, opacity, name,
+                                   autoDraw)
+        self.fillColor = fillColor
+
+    def draw(self):
+        rows, cols, dx, dy = self._region()
+        if rows.start >= rows.stop or cols.start >= cols.stop:
+            return
+        value, alpha = gratings.render_grating(dx, dy, self.win.to_pix(self.size, self.units), 0.0, self.ori,
+                                               color=_gray(self.fillColor), opacity=self.opacity, tex=None)
+        self._blend(rows, cols, value, alpha)
+
+
+class TextStim(_Stim):
+    """
+    Text is not rendered headless, the stimulus only keeps its text.
+    """
+
+    def __init__(self, win, text='', pos=(0, 0), units=None, name='', autoDraw=False, **kwargs):
+        super(TextStim, self).__init__(win, units, pos, (0, 0), 0.0, 1.0, name, autoDraw)
+        self.text = text
+
+    def draw(self):
+        pass
+
+
+class Mouse:
+    """
+    Mouse / touch screen of a headless window: setPos() moves it, press() simulates a touch.
+    """
+
+    def __init__(self, win=None, visible=True):
+        self.win = win
+        self.pos = numpy.zeros(2)
+        self.pressed = [0, 0, 0]
+
+    def getPos(self):
+        return self.pos.copy()
+
+    def setPos(self, newPos=(0, 0)):
+        self.pos = numpy.array(newPos, dtype=float)
+
+    def getPressed(self, getTime=False):
+        return list(self.pressed)
+
+    def clickReset(self, buttons=(0, 1, 2)):
+        for button in buttons:
+            self.pressed[button] = 0
+
+    def press(self, pos=None, button=0):
+        if pos is not None:
+            self.setPos(pos)
+        self.pressed[button] = 1
+
+    def isPressedIn(self, shape, buttons=(0, 1, 2)):
+        return any(self.pressed[b] for b in buttons) and shape.contains(self)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='HeadlessBenchmark', description='Render cost of the grating stimuli')
+    parser.add_argument('--size', type=int, nargs=2, default=(1920, 1080))
+    parser.add_argument('--frames', type=int, default=60)
+    args = parser.parse_args()
+
+    win = Window(args.size, units='pix')
+    stimuli = {'sqr': GratingStim(win, size=max(args.size), sf=1 / 100, **gratings.textures.stim_kwargs('sqr')),
+               'sin gauss': GratingStim(win, size=min(args.size), sf=1 / 100,
+                                        **gratings.textures.stim_kwargs('sin', 'gauss'))}
+    for name, stim in stimuli.items():
+        start = time.perf_counter()
+        for i in range(args.frames):
+            stim.ori = i
+            stim.phase = i / args.frames
+            stim.draw()
+            win.flip()
+        duration = (time.perf_counter() - start) / args.frames
+        print(f'{name}: {duration * 1e3:.1f} ms per frame ({1 / duration:.0f} fps) at {args.size[0]}x{args.size[1]}')
@@ -1,7 +1,6 @@
-import logging
-
 from vis_stim_experiment import vis_stim_experiment_master
 from lickometer import Protocol
+from tracing import tracer
 
 # Parameters for communication between stimulation and recording PC
 # port connected to the fUSi
@@ -113,9 +112,15 @@ if __name__ == '__main__':
     print(f"Right side: {stat_params['right_correct']} / {stat_params['right_correct'] + stat_params['right_wrong']} = "
           f"{stat_params['right_correct'] / (stat_params['right_correct'] + stat_params['right_wrong'])}")
 
-    logging.debug("------------------------------------------")
-    logging.debug(f"Left: {stat_params['left']} Right: {stat_params['right']} Correct: {stat_params['correct']} Wrong: {stat_params['wrong']}")
-    logging.debug(f"Precision: {stat_params['correct']/(stat_params['correct'] + stat_params['wrong'])} (correct / correct + wrong)")
-    logging.debug(f"Left correct: {stat_params['left_correct'] / (stat_params['left_correct'] + stat_params['left_wrong'])}")
-    logging.debug(f"Right correct: {stat_params['right_correct'] / (stat_params['right_correct'] + stat_params['right_wrong'])}")
-
+    # end-of-session summary in the session logs (see VisualStimulator)
+    tracer.info("Session summary: left {left} right {right} correct {correct} wrong {wrong}, precision {precision} "
+                "(correct / correct + wrong), left correct {left_correct_ratio}, right correct {right_correct_ratio}",
+                left=stat_params['left'], right=stat_params['right'], correct=stat_params['correct'],
+                wrong=stat_params['wrong'],
+                precision=stat_params['correct'] / (stat_params['correct'] + stat_params['wrong']),
+                left_correct_ratio=stat_params['left_correct'] / (stat_params['left_correct'] +
+                                                                  stat_params['left_wrong']),
+                right_correct_ratio=stat_params['right_correct'] / (stat_params['right_correct'] +
+                                                                    stat_params['right_wrong']),
+                source='jumpstand')
+    tracer.flush()
@@ -0,0 +1,256 @@
+"""
+Host-side lick detection on the raw lick sensor samples streamed by Lickometer.start_stream().
+
+The samples of each lickometer (up, left, right) are filtered, thresholded with hysteresis and the lick onsets are
+grouped into bouts, all vectorized with NumPy. LickDetector processes a live stream block by block (e.g. the new
+samples of Lickometer.samples), detect_session() re-analyses a whole capture file in one call.
+"""
+
+import numpy
+
+from lickometer import SampleCapture
+
+CHANNELS = ('up', 'left', 'right')
+
+BOUT_DTYPE = numpy.dtype([('start', 'f8'), ('end', 'f8'), ('n_licks', 'i8'), ('rate', 'f8')])
+
+
+def moving_average(x, window: int, history=None):
+    """
+    Causal moving average (mean of the last window samples) computed with a cumulative sum.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+    window : int
+    history : numpy.ndarray, optional
+        Samples preceding x (at least window - 1) to continue the average across blocks.
+
+    Returns
+    -------
+    numpy.ndarray: same length as x
+    """
+    if history is not None and len(history):
+        x = numpy.concatenate((history, x))
+        skip = len(history)
+    else:
+        skip = 0
+    c = numpy.cumsum(x, dtype=numpy.float64)
+    out = numpy.empty(len(x))
+    out[window:] = (c[window:] - c[:-window]) / window
+    # beginning of the signal: mean of the samples available so far
+    out[:window] = c[:window] / numpy.arange(1, min(window, len(x)) + 1)
+    return out[skip:]
+
+
+def _tail(x, n: int):
+    return x[len(x) - n:] if n > 0 else x[:0]
+
+
+def hysteresis(x, high, low, state=False):
+    """
+    Vectorized hysteresis threshold: on above high, off below low, unchanged in between.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+    high, low : float
+    state : bool, optional
+        State before the first sample.
+
+    Returns
+    -------
+    numpy.ndarray of bool
+    """
+    marks = numpy.zeros(len(x), dtype=numpy.int8)
+    marks[x > high] = 1
+    marks[x < low] = -1
+    changed = numpy.flatnonzero(marks)
+    last = numpy.zeros(len(x), dtype=numpy.int64)
+    last[changed] = changed
+    last = numpy.maximum.accumulate(last)
+    out = marks[last] > 0
+    # before the first change the previous state holds
+    first = changed[0] if len(changed) else len(x)
+    out[:first] = state
+    return out
+
+
+def group_bouts(onsets, max_interval: float):
+    """
+    Group lick onsets (s) into bouts: consecutive licks closer than max_interval belong to the same bout.
+
+    Returns
+    -------
+    numpy.ndarray of BOUT_DTYPE
+    """
+    if len(onsets) == 0:
+        return numpy.zeros(0, dtype=BOUT_DTYPE)
+    breaks = numpy.flatnonzero(numpy.diff(onsets) > max_interval) + 1
+    starts = numpy.concatenate(([0], breaks))
+    ends = numpy.concatenate((breaks, [len(onsets)])) - 1
+
+    bouts = numpy.zeros(len(starts), dtype=BOUT_DTYPE)
+    bouts['start'] = onsets[starts]
+    bouts['end'] = onsets[ends]
+    bouts['n_licks'] = ends - starts + 1
+    duration = bouts['end'] - bouts['start']
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        bouts['rate'] = numpy.where(duration > 0, (bouts['n_licks'] - 1) / duration, 0)
+    return bouts
+
+
+def bout_statistics(bouts):
+    """
+    :param bouts: (numpy.ndarray of BOUT_DTYPE)
+    :return: (dict) number of bouts, licks per bout, bout duration (s) and lick rate within bouts (Hz)
+    """
+    if len(bouts) == 0:
+        return {'n_bouts': 0, 'licks_per_bout': 0.0, 'bout_duration': 0.0, 'bout_rate': 0.0}
+    return {'n_bouts': len(bouts),
+            'licks_per_bout': float(bouts['n_licks'].mean()),
+            'bout_duration': float((bouts['end'] - bouts['start']).mean()),
+            'bout_rate': float(bouts['rate'].mean())}
+
+
+class LickDetector:
+    """
+    Block-wise lick detection on raw sensor samples.
+
+    Every channel is smoothed (smoothing_s moving average), its baseline (baseline_s moving average) is removed and
+    the result is thresholded with hysteresis. The threshold is threshold sensor units above the baseline or, if not
+    given, k_mad times the noise (median absolute deviation) of the first block scaled to the smoothed signal. Onsets closer than refractory_s to the
+    previous one are dropped. Filter states, thresholds and open bouts are carried over between blocks.
+    """
+
+    def __init__(self, sampling=2000, smoothing_s=0.005, baseline_s=0.5, threshold=None, k_mad=12, release=0.5,
+                 refractory_s=0.05, bout_interval_s=0.5, channels=CHANNELS):
+        self.sampling = sampling
+        self.smoothing = max(1, int(smoothing_s * sampling))
+        self.baseline = max(1, int(baseline_s * sampling))
+        self.threshold = {c: threshold for c in channels}
+        self.k_mad = k_mad
+        self.release = release
+        self.refractory_s = refractory_s
+        self.bout_interval_s = bout_interval_s
+        self.channels = channels
+
+        self._raw = {c: numpy.zeros(0) for c in channels}       # raw history for the smoothing filter
+        self._smooth = {c: numpy.zeros(0) for c in channels}    # smoothed history for the baseline filter
+        self._state = {c: False for c in channels}
+        self._last_onset = {c: -numpy.inf for c in channels}
+        self._open_bout = {c: numpy.zeros(0) for c in channels}  # onsets of the bout not closed yet
+        self.n_licks = {c: 0 for c in channels}
+
+    def _filter(self, c, raw):
+        smooth = moving_average(raw, self.smoothing, self._raw[c])
+        signal = smooth - moving_average(smooth, self.baseline, self._smooth[c])
+        self._raw[c] = _tail(numpy.concatenate((self._raw[c], raw)), self.smoothing - 1)
+        self._smooth[c] = _tail(numpy.concatenate((self._smooth[c], smooth)), self.baseline - 1)
+        return signal
+
+    def process(self, samples):
+        """
+        Detect licks in the next block of samples.
+
+        Parameters
+        ----------
+        samples : numpy.ndarray of SAMPLE_DTYPE
+            Consecutive block of the stream.
+
+        Returns
+        -------
+        dict: {channel: {'onsets': lick onset times (s), 'bouts': bouts closed in this block (BOUT_DTYPE),
+                         'rate': lick rate in this block (Hz)}}
+        """
+        t = samples['index'] / self.sampling
+        duration = len(samples) / self.sampling
+        result = {}
+        for c in self.channels:
+            raw = samples[c].astype(numpy.float64)
+            signal = self._filter(c, raw)
+            if self.threshold[c] is None:
+                # noise of the raw samples scaled to the smoothed signal
+                mad = numpy.median(numpy.abs(raw - numpy.median(raw))) / numpy.sqrt(self.smoothing)
+                self.threshold[c] = self.k_mad * max(mad, 1.0)
+            high = self.threshold[c]
+            on = hysteresis(signal, high, high * self.release, self._state[c])
+
+            rising = numpy.flatnonzero(on[1:] & ~on[:-1]) + 1
+            if len(on) and on[0] and not self._state[c]:
+                rising = numpy.concatenate(([0], rising))
+            self._state[c] = bool(on[-1]) if len(on) else self._state[c]
+
+            onsets = t[rising]
+            previous = numpy.concatenate(([self._last_onset[c]], onsets[:-1]))
+            onsets = onsets[onsets - previous >= self.refractory_s]
+            if len(onsets):
+                self._last_onset[c] = onsets[-1]
+            self.n_licks[c] += len(onsets)
+
+            # bouts: close the ones followed by a long enough gap
+            pending = numpy.concatenate((self._open_bout[c], onsets))
+            bouts = group_bouts(pending, self.bout_interval_s)
+            closed = bouts[:-1]
+            if len(bouts) and len(t) and t[-1] - bouts['end'][-1] > self.bout_interval_s:
+                closed = bouts
+            self._open_bout[c] = pending[pending > closed['end'][-1]] if len(closed) else pending
+
+            result[c] = {'onsets': onsets, 'bouts': closed, 'rate': len(onsets) / duration if duration else 0.0}
+        return result
+
+
+def detect_session(samples, sampling=2000, block=None, **kwargs):
+    """
+    Detect the licks of a whole session.
+
+    Parameters
+    ----------
+    samples : numpy.ndarray of SAMPLE_DTYPE or str
+        Samples or path of a SampleCapture file.
+    sampling : int, optional
+    block : int, optional
+        Process the session in blocks of this many samples (constant memory for long captures), default: at once.
+    kwargs :
+        Parameters of LickDetector.
+
+    Returns
+    -------
+    dict: {channel: {'onsets': lick onset times (s), 'rate': mean lick rate (Hz), 'bouts': BOUT_DTYPE array,
+                     'statistics': bout_statistics()}}
+    """
+    if isinstance(samples, str):
+        samples = SampleCapture.load(samples)
+    detector = LickDetector(sampling=sampling, **kwargs)
+    block = block or max(len(samples), 1)
+
+    onsets = {c: [] for c in detector.channels}
+    bouts = {c: [] for c in detector.channels}
+    for start in range(0, len(samples), block):
+        for c, r in detector.process(samples[start:start + block]).items():
+            onsets[c].append(r['onsets'])
+            bouts[c].append(r['bouts'])
+
+    duration = len(samples) / sampling
+    result = {}
+    for c in detector.channels:
+        remaining = group_bouts(detector._open_bout[c], detector.bout_interval_s)
+        c_bouts = numpy.concatenate(bouts[c] + [remaining])
+        c_onsets = numpy.concatenate(onsets[c]) if onsets[c] else numpy.zeros(0)
+        result[c] = {'onsets': c_onsets,
+                     'rate': len(c_onsets) / duration if duration else 0.0,
+                     'bouts': c_bouts,
+                     'statistics': bout_statistics(c_bouts)}
+    return result
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='LickDetection', description='Detect licks in a raw sample capture file')
+    parser.add_argument('capture', help='SampleCapture file recorded by Lickometer.start_stream()')
+    parser.add_argument('--sampling', type=int, default=2000)
+    args = parser.parse_args()
+
+    for channel, r in detect_session(args.capture, args.sampling, block=args.sampling * 60).items():
+        print(f"{channel:>6}: {len(r['onsets'])} licks, {r['rate']:.2f} Hz, {r['statistics']}")
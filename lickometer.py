@@ -1,94 +1,903 @@
+import functools
+import json
 import logging
+import os
+import queue
 import random
+import threading
+from collections import deque, namedtuple
+from contextlib import contextmanager
 
+import numpy
 import serial
 import serial.tools.list_ports as list_ports
 import struct
 import time
 from enum import Enum
 
+import tracing
+from tracing import tracer
+from transports import open_transport
+
+
+# Timestamped order/value/time record decoded from the serial stream (rig: id of the device when several are used)
+Event = namedtuple('Event', ['order', 'value', 'device_time', 'host_time', 'rig'], defaults=(None,))
+
+# Precompiled little-endian encodings of the protocol
+I8 = struct.Struct('<b')
+I16 = struct.Struct('<h')
+I32 = struct.Struct('<l')
+OV_FRAME = struct.Struct('<bh')  # order, value
+REW_SIDE_SIZE_FRAME = struct.Struct('<bbh')  # order, side, size
+OVT_FRAME = struct.Struct('<bhl')  # order, value, device time (reply of PING)
+
+# Raw lick sensor sample streamed in STREAM state: sample counter, up, left & right sensor values
+SAMPLE_DTYPE = numpy.dtype([('index', '<u4'), ('up', '<i2'), ('left', '<i2'), ('right', '<i2')])
+STREAM_END = 0xFFFFFFFF  # index of the record closing the stream
+LINE_BITS_PER_BYTE = 10  # 8N1: start bit, 8 data bits, stop bit
+
+
+class FrameDecoder:
+    """
+    Decodes fixed size records (default: order/value/time, '<bhl') from a byte stream.
+
+    Received bytes are copied into a reusable buffer, all complete records are unpacked at once by a precompiled
+    struct.Struct over a memoryview of the buffer and a partial record is kept for the next feed().
+    If a NumPy dtype is given, the records are decoded into a structured array instead.
+    """
+
+    def __init__(self, fmt='<bhl', capacity=4096, dtype=None):
+        self.dtype = dtype
+        self.frame = struct.Struct(fmt if dtype is None else f'{dtype.itemsize}s')
+        self._buffer = bytearray(capacity)
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def feed(self, data):
+        end = self._length + len(data)
+        if end > len(self._buffer):
+            self._buffer.extend(bytes(max(end, 2 * len(self._buffer)) - len(self._buffer)))
+        self._buffer[self._length:end] = data
+        self._length = end
+
+    def decode(self):
+        """
+        :return: (list of tuples or numpy.ndarray of dtype) all complete records fed so far
+        """
+        n = self._length - self._length % self.frame.size
+        if n == 0:
+            return [] if self.dtype is None else numpy.empty(0, dtype=self.dtype)
+        remainder = self._length - n
+        with memoryview(self._buffer) as view:
+            if self.dtype is None:
+                records = list(self.frame.iter_unpack(view[:n]))
+            else:
+                records = numpy.frombuffer(view[:n], dtype=self.dtype).copy()
+            # keep the partial record (shorter than a record, so the slices cannot overlap)
+            view[:remainder] = view[n:self._length]
+        self._length = remainder
+        return records
+
+    def take_remainder(self):
+        """
+        :return: (bytes) the partial record, the decoder is emptied
+        """
+        remainder = bytes(self._buffer[:self._length])
+        self._length = 0
+        return remainder
+
+
+class SampleRing:
+    """
+    Fixed-size ring buffer of the most recent raw lick sensor samples (SAMPLE_DTYPE) for live use.
+    """
+
+    def __init__(self, capacity: int):
+        self.data = numpy.zeros(capacity, dtype=SAMPLE_DTYPE)
+        self.count = 0  # samples written since start
+        self._lock = threading.Lock()
+
+    def extend(self, samples):
+        capacity = len(self.data)
+        samples = samples[-capacity:]
+        with self._lock:
+            start = self.count % capacity
+            first = min(len(samples), capacity - start)
+            self.data[start:start + first] = samples[:first]
+            self.data[:len(samples) - first] = samples[first:]
+            self.count += len(samples)
+
+    def latest(self, n=None):
+        """
+        :param n: number of samples, None: the whole buffer
+        :return: (numpy.ndarray) copy of the last n samples, oldest first
+        """
+        capacity = len(self.data)
+        with self._lock:
+            n = min(capacity if n is None else n, self.count, capacity)
+            end = self.count % capacity
+            if n <= end:
+                return self.data[end - n:end].copy()
+            return numpy.concatenate((self.data[capacity - (n - end):], self.data[:end]))
+
+
+class SampleCapture:
+    """
+    Appends raw lick sensor samples (SAMPLE_DTYPE) to a memory-mapped file. The file is grown in chunks and
+    truncated to the samples written when closed, read it back with SampleCapture.load(path).
+    """
+
+    def __init__(self, path: str, chunk: int = 2000 * 600):
+        self.path = path
+        self.chunk = chunk
+        self.length = 0
+        self._map = numpy.memmap(path, dtype=SAMPLE_DTYPE, mode='w+', shape=(chunk,))
+
+    def append(self, samples):
+        end = self.length + len(samples)
+        if end > len(self._map):
+            self._map.flush()
+            capacity = max(end, len(self._map) + self.chunk)
+            self._map = numpy.memmap(self.path, dtype=SAMPLE_DTYPE, mode='r+', shape=(capacity,))
+        self._map[self.length:end] = samples
+        self.length = end
+
+    def close(self):
+        self._map.flush()
+        self._map = None
+        os.truncate(self.path, self.length * SAMPLE_DTYPE.itemsize)
+
+    @staticmethod
+    def load(path: str):
+        """
+        :return: (numpy.memmap) read-only samples of a capture file
+        """
+        return numpy.memmap(path, dtype=SAMPLE_DTYPE, mode='r')
+
+
+class Deadline:
+    """
+    Time limit on the monotonic clock shared by several reads, see Protocol.deadline().
+    """
+
+    def __init__(self, timeout):
+        """
+        :param timeout: seconds from now, None: no limit
+        """
+        self.end = None if timeout is None else time.monotonic() + timeout
+
+    def remaining(self):
+        """
+        :return: (float) seconds left (0 once expired), None if there is no limit
+        """
+        return None if self.end is None else max(0.0, self.end - time.monotonic())
+
+    @property
+    def expired(self):
+        return self.end is not None and time.monotonic() >= self.end
+
+
+class SerialReader(threading.Thread):
+    """
+    Background thread that owns the read side of the serial port.
+
+    The thread blocks on serial reads (bounded by the port timeout) instead of polling, so waiting for the
+    Lickometer costs no CPU. Received bytes are collected in a buffer consumed by Protocol's read_* methods.
+    In frame mode the bytes are passed to a FrameDecoder and a handler consumes the decoded records instead, e.g. in
+    event mode the order/value/time records are put into a queue of timestamped Events.
+    """
+
+    def __init__(self, serial_port, events=None, forward=None, rig=None):
+        """
+        :param serial_port: (serial.Serial)
+        :param events: queue of the decoded Events (Default: new queue.Queue)
+        :param forward: optional queue receiving a copy of the Events, e.g. aggregating several devices
+        :param rig: id of the device put into the Events
+        """
+        super(SerialReader, self).__init__(name=f'SerialReader({serial_port.port})', daemon=True)
+        self.serial = serial_port
+        self.events = events if events is not None else queue.Queue()
+        self.forward = forward
+        self.rig = rig
+        self.orders = {}  # order value --> Order Enum Object
+        self.event_decoder = FrameDecoder()
+        self.decoder = None
+        self.handler = None
+        self.error = None
+        self.bytes_read = 0
+        self.last_arrival = None  # time.perf_counter() when the last bytes were received
+        self._running = True
+        self._buffer = bytearray()
+        self._condition = threading.Condition()
+
+    def run(self):
+        while self._running:
+            try:
+                data = self.serial.read(max(1, self.serial.in_waiting))
+            except (serial.SerialException, OSError, TypeError) as e:
+                # TypeError: pyserial reading from a port closed by another thread
+                with self._condition:
+                    if self._running:
+                        self.error = e if isinstance(e, serial.SerialException) else serial.SerialException(e)
+                    self._running = False
+                    self._condition.notify_all()
+                return
+            if not data:
+                continue
+
+            host_time = time.time()
+            arrival = time.perf_counter()
+            with self._condition:
+                self.last_arrival = arrival
+                self.bytes_read += len(data)
+                if self.decoder is not None:
+                    self.decoder.feed(data)
+                    self.handler(self.decoder.decode(), host_time)
+                else:
+                    self._buffer += data
+                self._condition.notify_all()
+
+    def _put_events(self, records, host_time):
+        orders = self.orders
+        put = self.events.put
+        rig = self.rig
+        for order, value, device_time in records:
+            event = Event(orders.get(order, order), value, device_time, host_time, rig)
+            put(event)
+            if self.forward is not None:
+                self.forward.put(event)
+
+    @property
+    def event_mode(self):
+        return self.decoder is self.event_decoder
+
+    def set_frame_mode(self, decoder=None, handler=None):
+        """
+        Route the received bytes through decoder, handler(records, host_time) is called with the decoded records.
+        Bytes already buffered are decoded immediately. Without decoder the reader goes back to raw byte buffering,
+        a partial record is given back to the raw buffer.
+        """
+        with self._condition:
+            if self.decoder is not None:
+                self._buffer[:0] = self.decoder.take_remainder()
+            self.decoder = decoder
+            self.handler = handler
+            if decoder is not None:
+                decoder.feed(self._buffer)
+                self._buffer.clear()
+                handler(decoder.decode(), time.time())
+
+    def set_event_mode(self, enabled: bool):
+        """
+        Switch between raw byte buffering and decoding order/value/time records into the event queue.
+        """
+        if enabled != self.event_mode:
+            if enabled:
+                self.set_frame_mode(self.event_decoder, self._put_events)
+            else:
+                self.set_frame_mode()
+
+    def in_waiting(self):
+        """
+        :return: (int) number of received bytes not consumed yet
+        """
+        return len(self._buffer)
+
+    def wait_for_bytes(self, size, timeout=None):
+        """
+        Block until at least size bytes are buffered.
+
+        :param size: number of bytes
+        :param timeout: seconds to wait, None waits forever
+        :return: (bool) False on timeout
+        """
+        with self._condition:
+            ready = self._condition.wait_for(lambda: len(self._buffer) >= size or not self._running, timeout)
+            if len(self._buffer) < size and self.error is not None:
+                raise self.error
+            return ready and len(self._buffer) >= size
+
+    def read(self, size, timeout=None):
+        """
+        Read size bytes. Like serial.read, fewer bytes are returned if the timeout expires.
+
+        :param size: number of bytes
+        :param timeout: seconds to wait, None waits forever
+        :return: (bytes)
+        """
+        self.wait_for_bytes(size, timeout)
+        with self._condition:
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+        return data
+
+    def readline(self, timeout=None):
+        """
+        Read bytes up to and including the next newline.
+
+        :param timeout: seconds to wait, None waits forever
+        :return: (bytes) the line, or the buffered bytes if the timeout expires
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: b'\n' in self._buffer or not self._running, timeout)
+            if b'\n' not in self._buffer and self.error is not None:
+                raise self.error
+            end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+            line = bytes(self._buffer[:end])
+            del self._buffer[:end]
+        return line
+
+    def discard(self, quiet=0.05, timeout=1.0):
+        """
+        Drop the bytes not consumed yet (e.g. the rest of an unterminated stream), once nothing was received for
+        quiet seconds or timeout expired.
+
+        :return: (int) number of bytes dropped
+        """
+        end = time.monotonic() + timeout
+        with self._condition:
+            while self.last_arrival is not None:
+                wait = min(quiet - (time.perf_counter() - self.last_arrival), end - time.monotonic())
+                if wait <= 0:
+                    break
+                self._condition.wait(wait)
+            dropped = len(self._buffer)
+            self._buffer.clear()
+            if self.decoder is not None:
+                dropped += len(self.decoder.take_remainder())
+        return dropped
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+
+
+# Last port the Arduino was found on, tried before scanning all the ports
+PORT_CACHE = os.path.join(os.path.expanduser('~'), '.jumpstand', 'lickometer_port.json')
+
+# USB vendor ids of Arduino boards (Arduino LLC, Arduino SRL)
+ARDUINO_VIDS = (0x2341, 0x2A03)
+
+
+def _port_matches(port, vid=None, pid=None, serial_number=None):
+    if vid is None and pid is None and serial_number is None:
+        return (port.manufacturer is not None and 'Arduino' in port.manufacturer) or port.vid in ARDUINO_VIDS
+    return ((vid is None or port.vid == vid) and (pid is None or port.pid == pid) and
+            (serial_number is None or port.serial_number == serial_number))
+
+
+def find_arduinos(vid=None, pid=None, serial_number=None):
+    """
+    Scan the serial ports for all the Arduinos matching the given USB ids (see find_arduino).
+
+    Returns
+    -------
+    list of ListPortInfo
+    """
+    return [port for port in list_ports.comports() if _port_matches(port, vid, pid, serial_number)]
+
+
+def find_arduino(vid=None, pid=None, serial_number=None):
+    """
+    Scan the serial ports for the Arduino (the last one if more than one matches).
+
+    Parameters
+    ----------
+    vid, pid : int, optional
+        USB vendor & product id of the board.
+    serial_number : str, optional
+        USB serial number of the board.
+        If none of them is given, any port made by Arduino matches.
+
+    Returns
+    -------
+    ListPortInfo: the port or None if no Arduino found
+    """
+    found = None
+    for port in find_arduinos(vid, pid, serial_number):
+        tracer.info('Arduino found, port = {}', port.device, source='lickometer')
+        found = port
+    return found
+
+
+def find_arduino_port():
+    """
+    Find the serial port of the Arduino (the last one if more than one is connected).
+
+    Returns
+    -------
+    str: device name of the port or None if no Arduino found
+    """
+    port = find_arduino()
+    return None if port is None else port.device
+
+
+def _load_port_cache(path):
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return []
+    return cached if isinstance(cached, list) else [cached]
+
+
+def load_cached_port(vid=None, pid=None, serial_number=None, path=PORT_CACHE):
+    """
+    :return: (dict) device, vid, pid & serial_number of the last port a matching Arduino was found on, None if there
+        is no cached port matching the requested board
+    """
+    for cached in reversed(_load_port_cache(path)):
+        if ((vid is None or cached.get('vid') == vid) and (pid is None or cached.get('pid') == pid) and
+                (serial_number is None or cached.get('serial_number') == serial_number)):
+            return cached
+    return None
+
+
+def save_cached_port(port, path=PORT_CACHE):
+    """
+    :param port: (ListPortInfo) port the Arduino was found on, the cache keeps one entry per board
+    """
+    entry = {'device': port.device, 'vid': port.vid, 'pid': port.pid, 'serial_number': port.serial_number}
+    cache = [c for c in _load_port_cache(path)
+             if c.get('device') != port.device and (port.serial_number is None or
+                                                    c.get('serial_number') != port.serial_number)]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(cache + [entry], f)
+
+
+def _sysfs_port(device):
+    """
+    :return: (ListPortInfo) USB ids of the board on the port device read from sysfs (Linux), without enumerating the
+        other ports, None where sysfs is not available
+    """
+    if not os.path.isdir('/sys/class/tty'):
+        return None
+    from serial.tools.list_ports_linux import SysFS
+    return SysFS(device)
+
+
+def _lookup_port(device):
+    port = _sysfs_port(device)
+    if port is not None:
+        return port
+    for port in list_ports.comports():
+        if port.device == device:
+            return port
+    return None
+
+
+def cached_port_present(cached):
+    """
+    Check the cached device alone (its sysfs entry on Linux), the full scan of the ports is only done where the
+    USB ids of a single port cannot be read.
+
+    :param cached: (dict) entry of the port cache, see load_cached_port()
+    :return: (bool) True if the board recorded in the cache (vid, pid & serial_number) is still on the cached device,
+        e.g. False if the USB ports were enumerated again and another board got the device name
+    """
+    device = cached.get('device')
+    if not device or (os.name == 'posix' and not os.path.exists(device)):
+        return False
+    port = _lookup_port(device)
+    return (port is not None and port.vid == cached.get('vid') and port.pid == cached.get('pid') and
+            port.serial_number == cached.get('serial_number'))
+
+
+def port_serial_number(device):
+    """
+    :return: (str) USB serial number of the board on the port device, None if unknown (e.g. a pty)
+    """
+    port = _lookup_port(device)
+    return None if port is None else port.serial_number
+
+
+# Last configuration applied to each Lickometer, see Lickometer(state_cache=...)
+DEVICE_STATE_CACHE = os.path.join(os.path.expanduser('~'), '.jumpstand', 'lickometer_state.json')
+
+
+def _load_state_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def claim_device_state(key, initial_values, path=DEVICE_STATE_CACHE):
+    """
+    Take the cached configuration of a device out of the cache: it is written back by save_device_state() when the
+    session ends cleanly, so a crashed session never leaves a stale configuration behind.
+
+    Parameters
+    ----------
+    key : str
+        Device serial number and firmware version.
+    initial_values : str
+        Initial values sent by the device, the cached configuration is invalid if they changed.
+
+    Returns
+    -------
+    dict: configuration (see Lickometer.state) or None if nothing valid is cached
+    """
+    cache = _load_state_cache(path)
+    entry = cache.pop(key, None)
+    if entry is None:
+        return None
+    with open(path, 'w') as f:
+        json.dump(cache, f)
+    if entry.get('initial_values') != initial_values:
+        return None
+    state = entry['state']
+    state['calibration'] = {p: tuple(c) for p, c in state['calibration'].items()}
+    return state
+
+
+def save_device_state(key, initial_values, state, path=DEVICE_STATE_CACHE):
+    """
+    :param state: (dict) configuration applied to the device, see Lickometer.state
+    """
+    cache = _load_state_cache(path)
+    cache[key] = {'initial_values': initial_values, 'state': state}
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(cache, f)
+
+
+def reconnecting(method):
+    """
+    Decorator of the Lickometer orders: if the connection is lost during the order, the Arduino is reconnected
+    (its state replayed) and the order is repeated once. Only for orders that can be repeated safely (configuration,
+    WFL), not for the rewards: a reward repeated after its bytes were sent would be given twice.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except (serial.SerialException, OSError) as e:
+            tracer.warning('Connection lost during {}: {}', method.__name__, e, source=self.port)
+            self.reconnect()
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def unbatched(method):
+    """
+    Decorator of the orders that need their reply before anything else is sent (e.g. WFL waits for the lick): they
+    cannot be queued by Protocol.batch(), only the configuration orders can.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self._batch is not None:
+            raise RuntimeError(f'{method.__name__}() cannot be issued inside Lickometer.batch()')
+        return method(self, *args, **kwargs)
+    return wrapper
+
 
 class Arduino:
     def __init__(self, **kwargs):
         # print('Start __init__ of Arduino...')
         super(Arduino, self).__init__(**kwargs)
-        self.port = None
+        self.port = kwargs.get('port')
         self.rate = kwargs.get('rate')
         self.timeout = kwargs.get('timeout')
-        self.serial = self.__connect()
+        self.vid = kwargs.get('vid')
+        self.pid = kwargs.get('pid')
+        self.serial_number = kwargs.get('serial_number')
+        self.reconnect_timeout = kwargs.get('reconnect_timeout', 10)
+        self.rig = kwargs.get('rig')
+        self.forward_events = kwargs.get('forward_events')
+        self.transport = kwargs.get('transport')
+        if self.transport is not None:
+            self.port = self.transport.port
+        self.fixed_port = self.port is not None
+        try:
+            self.serial = self.__connect()
+        except serial.SerialException as e:
+            tracer.error('{}, exit', e, source='lickometer')
+            exit(1)
+        self._start_reader()
         time.sleep(1)
         # print('End __init__ of Arduino')
 
     def __connect(self):
-        com_ports = list_ports.comports()
-        for port in com_ports:
-            name = port.manufacturer
-            if name and 'Arduino' in name:
-                print(f'Arduino found, port = {port.device}')
-                self.port = port.device
-        if self.port is None:
-            print('No Arduino found, exit')
-            exit(1)
-        return serial.Serial(self.port, self.rate, timeout=self.timeout)
+        """
+        Open the port given explicitly (serial port or URL, see transports.open_transport), else the cached port if
+        the same board is still on it and it can be opened, else scan for the Arduino.
+        """
+        if self.transport is not None:
+            if not self.transport.is_open:
+                raise serial.SerialException(f'{self.port} is closed and cannot be reopened')
+            return self.transport
+        if self.fixed_port:
+            return open_transport(self.port, self.rate, self.timeout)
+
+        cached = load_cached_port(self.vid, self.pid, self.serial_number)
+        if cached is not None and cached_port_present(cached):
+            try:
+                connection = serial.Serial(cached['device'], self.rate, timeout=self.timeout)
+                self.port = cached['device']
+                return connection
+            except serial.SerialException:
+                pass
+
+        found = find_arduino(self.vid, self.pid, self.serial_number)
+        if found is None:
+            raise serial.SerialException('No Arduino found')
+        self.port = found.device
+        connection = serial.Serial(self.port, self.rate, timeout=self.timeout)
+        save_cached_port(found)
+        return connection
+
+    def _start_reader(self, events=None):
+        self.reader = SerialReader(self.serial, events, forward=self.forward_events, rig=self.rig)
+        self.reader.start()
+
+    def reconnect(self):
+        """
+        Reopen the connection after it was lost (e.g. USB hiccup), retrying until reconnect_timeout.
+        """
+        events = self.reader.events
+        orders = self.reader.orders
+        self.reader.stop()
+        try:
+            self.serial.close()
+        except (serial.SerialException, OSError):
+            pass
+        if self.transport is not None:
+            raise serial.SerialException(f'{self.port}: a transport given to the Lickometer cannot be reopened')
+
+        deadline = time.monotonic() + self.reconnect_timeout
+        while True:
+            try:
+                self.serial = self.__connect()
+                break
+            except serial.SerialException:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+
+        self._start_reader(events)
+        self.reader.orders = orders
+        tracer.info('Reconnected to {}', self.port, source=self.port)
+        self._on_reconnect()
+
+    def _on_reconnect(self):
+        """
+        Called after reconnecting, subclasses restore the state of the device.
+        """
+        pass
 
     def input(self):
-        return self.serial.inWaiting()
+        return self.reader.in_waiting()
 
     def read_line(self):
-        while self.input() == 0:
-            pass
-        line = self.serial.readline()
+        line = self.reader.readline()
         return line.strip().decode()
 
     def close(self):
+        self.reader.stop()
         self.serial.close()
+        self.reader.join(timeout=self.timeout)
         time.sleep(0.5)
-        print(f'Port {self.port} is closed')
+        tracer.info('Port {} is closed', self.port, source=self.port)
 
 
 class RewardAmount:
     ''' Handles reward size (small, big) and contingency (e.g. 80% of reward calls actually deliver the reward).
-    Both can change with time. '''
+    Both can change with time.
+    Contingency is computed from running counters over the whole session or, if contingency_window is given,
+    over the last contingency_window reward calls. The last history_size reward sizes are kept for export. '''
 
     def __init__(self, **kwargs):
         # print('Start __init__ of RewardAmount...')
         super(RewardAmount, self).__init__()
         self.contingency_percent = kwargs.get('contingency_percent')
         self.rew_size = kwargs.get('rew_size')
+        self.contingency_window = kwargs.get('contingency_window')
         self.time_since_start = time.time()
-        self.history = []
+        self.history = deque(maxlen=kwargs.get('history_size', 10000))
+
+        # running counters: whole session and sliding window
+        self.n_calls = 0
+        self.n_rewarded = 0
+        self._window = deque(maxlen=self.contingency_window) if self.contingency_window else None
+        self._window_rewarded = 0
         # print('End __init__ of RewardAmount')
 
     # @property
     def current_size(self):
-        print('-----------------')
-        self.history.append(self.calculate_size())
-        print(f"self.history: {self.history}")
-        print('-----------------\n')
-        return self.history[-1]
+        size = self.calculate_size()
+        self._add(size)
+        return size
+
+    def _add(self, size):
+        rewarded = size > 0  # size can vary, count the occurrences of nonzero rewards
+        self.n_calls += 1
+        self.n_rewarded += rewarded
+        if self._window is not None:
+            if len(self._window) == self._window.maxlen:
+                self._window_rewarded -= self._window[0]
+            self._window.append(rewarded)
+            self._window_rewarded += rewarded
+        self.history.append(size)
 
     def calculate_size(self):
-        rewarded = [v1 > 0 for v1 in self.history]  # size can vary, get the occurrences of nonzero rewards
-        print(f"rewarded: {rewarded} --> sum: {sum(rewarded)}")
-        print(f"len(self.history): {len(self.history)}\nself.contingency_percent: {self.contingency_percent}")
-        if len(rewarded) == 0:
+        if self._window is None:
+            n_calls, n_rewarded = self.n_calls, self.n_rewarded
+        else:
+            n_calls, n_rewarded = len(self._window), self._window_rewarded
+
+        if n_calls == 0:
             return self.rew_size
-        if sum(rewarded) < len(self.history) * self.contingency_percent / 100:
+        if n_rewarded < n_calls * self.contingency_percent / 100:
             return self.rew_size
         else:
             return 0
 
+    def export_history(self, path=None):
+        """
+        Export the reward sizes of the reward calls.
+
+        Parameters
+        ----------
+        path : str, optional
+            If given, the history is also written into this file (one reward size per line).
+
+        Returns
+        -------
+        list: reward sizes, oldest first
+        """
+        history = list(self.history)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write('reward_size\n')
+                f.writelines(f'{size}\n' for size in history)
+        return history
+
+
+class OrderStats:
+    """
+    Latency histograms and counters of the Lickometer exchanges (see Protocol.stats).
+
+    The latency of an exchange (write_order --> read_order of the reply) is counted into a fixed histogram of the
+    order (the echo of a pump or side parameter is timed under that order, e.g. ALL): bucket i holds the latencies
+    in [2^(i-1), 2^i) us, bucket 0 below 1 us. Recording is a few integer
+    operations on a list, so the statistics can stay on during the experiments.
+    """
+    N_BUCKETS = 32
+    TOTAL = N_BUCKETS       # index of the summed latency (ns) in a histogram
+    MAX = N_BUCKETS + 1     # index of the maximum latency (ns)
+
+    def __init__(self, names=None):
+        """
+        :param names: (dict) order value --> name used by snapshot()
+        """
+        self.names = names or {}
+        self.histograms = {}  # order value --> bucket counts, total, max
+        self.timeouts = 0
+        self.invalid_orders = 0
+
+    def add(self, order: int, latency_ns: int):
+        histogram = self.histograms.get(order)
+        if histogram is None:
+            histogram = self.histograms[order] = [0] * (self.N_BUCKETS + 2)
+        bucket = (latency_ns // 1000).bit_length()
+        histogram[bucket if bucket < self.N_BUCKETS else self.N_BUCKETS - 1] += 1
+        histogram[self.TOTAL] += latency_ns
+        if latency_ns > histogram[self.MAX]:
+            histogram[self.MAX] = latency_ns
+
+    @staticmethod
+    def bucket_limit_us(bucket: int):
+        """
+        :return: (int) upper limit of the bucket in us
+        """
+        return 1 << bucket
+
+    @classmethod
+    def percentile_us(cls, counts, percent: float):
+        """
+        :return: (int) upper limit (us) of the bucket holding the percentile
+        """
+        rank = max(1, round(percent / 100 * sum(counts)))
+        count = 0
+        for bucket, n in enumerate(counts):
+            count += n
+            if count >= rank:
+                return cls.bucket_limit_us(bucket)
+        return cls.bucket_limit_us(len(counts) - 1)
+
+    def snapshot(self):
+        """
+        Returns
+        -------
+        dict: {'orders': {order name: count, mean_us, p50_us, p95_us, p99_us, max_us, buckets {limit us: count}},
+               'timeouts': int, 'invalid_orders': int}
+        """
+        orders = {}
+        for order, histogram in list(self.histograms.items()):
+            counts = histogram[:self.N_BUCKETS]
+            count = sum(counts)
+            orders[self.names.get(order, str(order))] = {
+                'count': count,
+                'mean_us': histogram[self.TOTAL] / count / 1000 if count else 0.0,
+                'p50_us': self.percentile_us(counts, 50),
+                'p95_us': self.percentile_us(counts, 95),
+                'p99_us': self.percentile_us(counts, 99),
+                'max_us': histogram[self.MAX] / 1000,
+                'buckets': {self.bucket_limit_us(b): n for b, n in enumerate(counts) if n},
+            }
+        return {'orders': orders, 'timeouts': self.timeouts, 'invalid_orders': self.invalid_orders}
+
 
 class Protocol(Arduino, RewardAmount):
-    def __init__(self, rate=19200, timeout=1, contingency_percent=80, rew_size=1):
+    def __init__(self, rate=19200, timeout=1, contingency_percent=80, rew_size=1, contingency_window=None, port=None,
+                 **kwargs):
+        """
+        :param port: serial port of the Lickometer (e.g. the port of a VirtualLickometer) or 'tcp://host:port' /
+            'unix:///path' of a bridge, None: find the Arduino
+        :param kwargs: transport: already open transport (e.g. transports.SocketTransport) used instead of port,
+            vid, pid, serial_number: USB ids of the Arduino to find, reconnect_timeout: seconds,
+            rig: id of the device, forward_events: queue receiving a copy of the decoded Events,
+            stats_path: JSON file the exchange statistics (self.stats) are dumped into by close()
+        """
         # print('Start __init__ of Protocol...')
-        super(Protocol, self).__init__(rate=rate, timeout=timeout, contingency_percent=contingency_percent, rew_size=rew_size)
+        self.stats_path = kwargs.pop('stats_path', None)
+        super(Protocol, self).__init__(port=port, rate=rate, timeout=timeout, contingency_percent=contingency_percent,
+                                       rew_size=rew_size, contingency_window=contingency_window, **kwargs)
+        self._deadline = None
+        self.stats = OrderStats({o.value: o.name for o in self.Order})
+        self._exchange = None  # (order value, start ns) of the exchange waiting for its reply
         self.version = self.read_line()
         self.initial_values = self.read_line()
         self.command = {i.name.lower(): i for i in self.Order}
-        self.printing = False
+        self.events = self.reader.events
+        self.reader.orders = {o.value: o for o in self.Order}
+        self._batch = None
+        self._batch_reads = None
+        self._batch_echoes = None
+        self.batch_replies = []
+        self.bytes_written = 0
         # print('End __init__ of Protocol')
-        print(f"\tv: {self.version}\n\tinit.val: {self.initial_values}")
+        tracer.info('\tv: {}\n\tinit.val: {}', self.version, self.initial_values, source=self.port)
+
+    @property
+    def printing(self):
+        """
+        Debug traces of the exchanges, see tracing.tracer (shared by all the devices).
+        """
+        return tracer.debugging
+
+    @printing.setter
+    def printing(self, enabled: bool):
+        tracer.set_level(tracing.DEBUG if enabled else tracing.INFO)
+
+    def _on_reconnect(self):
+        # the Arduino restarts when the port is opened
+        self.version = self.reader.readline(self.reconnect_timeout).strip().decode()
+        self.initial_values = self.reader.readline(self.reconnect_timeout).strip().decode()
+
+    def close(self):
+        if self.stats_path is not None:
+            with open(self.stats_path, 'w') as f:
+                json.dump({'port': self.port, 'version': self.version, 'bytes_written': self.bytes_written,
+                           'bytes_read': self.reader.bytes_read, **self.stats.snapshot()}, f, indent=2)
+        super(Protocol, self).close()
+
+    def read_line(self):
+        # without deadline wait for the line (e.g. the banner sent after the restart of the Arduino)
+        line = self.reader.readline(self._timeout(None))
+        if self._exchange is not None:
+            # text reply, e.g. of NOR
+            order, start = self._exchange
+            self._exchange = None
+            if line.endswith(b'\n'):
+                self.stats.add(order, time.perf_counter_ns() - start)
+        return line.strip().decode()
 
     class Order(Enum):
         """
@@ -101,6 +910,7 @@ class Protocol(Arduino, RewardAmount):
         WFL = 3
         NOR = 4
         REW = 5
+        STREAM = 6
 
         # sides (pump & lick sensor)
         ALL = 20
@@ -115,68 +925,205 @@ class Protocol(Arduino, RewardAmount):
         CALIBRATE = 33
         SET_WASHSPEED = 34
 
+        # composite orders
+        REW_SIDE_SIZE = 40
+
         # control
         INVALID_ORDER = 90
         TIMEOUT = 91
         DONE = 92
+        PING = 93
 
         NONE = 100
 
-    def read_order(self):
+    @contextmanager
+    def deadline(self, timeout):
         """
-        :return: (Order Enum Object)
+        Bound all the reads inside the with block by a single deadline, e.g. a whole order exchange. Every read waits
+        at most until the deadline (and at most self.timeout), the reads after it return Order.TIMEOUT or None.
+
+        Example
+        -------
+        with lick_o_meter.deadline(0.05):
+            lick_o_meter.set_size(2)
         """
-        order_read = self.read_i8()
+        previous = self._deadline
+        deadline = Deadline(timeout)
+        if previous is not None and previous.end is not None and (deadline.end is None or previous.end < deadline.end):
+            deadline = previous
+        self._deadline = deadline
         try:
-            return self.Order(order_read)
-        except:
-            # logging.warning(f"\nNot a valid order: {order_read}")
-            return order_read # self.Order.INVALID_ORDER
+            yield deadline
+        finally:
+            self._deadline = previous
+
+    def _timeout(self, timeout=-1):
+        """
+        :param timeout: seconds, None: forever (Default: self.timeout)
+        :return: (float) seconds a read may wait: timeout, shortened by the active deadline
+        """
+        if timeout == -1:
+            timeout = self.timeout
+        if self._deadline is not None and self._deadline.end is not None:
+            remaining = self._deadline.remaining()
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        return timeout
+
+    def to_order(self, value):
+        """
+        :param value: (int8_t) order read from the Lickometer
+        :return: (Order Enum Object) or value if it is not a valid order
+        """
+        try:
+            return self.Order(value)
+        except ValueError:
+            # logging.warning(f"\nNot a valid order: {value}")
+            return value  # self.Order.INVALID_ORDER
+
+    def read_order(self):
+        """
+        :return: (Order Enum Object) Order.TIMEOUT if nothing was received in time
+        """
+        if self._batch is not None:
+            self._batch_reads.append((I8, True))
+            return None
+        value = self.read_i8()
+        if self._exchange is not None:
+            order, start = self._exchange
+            self._exchange = None
+            if value is not None:
+                self.stats.add(order, time.perf_counter_ns() - start)
+        if value is None:
+            return self.Order.TIMEOUT
+        order = self.to_order(value)
+        if order is self.Order.INVALID_ORDER or order is value:
+            self.stats.invalid_orders += 1
+        return order
+
+    def _read_value(self, encoding):
+        if self._batch is not None:
+            # reply is read when the batch is flushed
+            self._batch_reads.append((encoding, False))
+            return None
+        data = self.reader.read(encoding.size, self._timeout())
+        if len(data) < encoding.size:
+            # timeout: the partial value is dropped
+            self.stats.timeouts += 1
+            return None
+        return encoding.unpack(data)[0]
 
     def read_i8(self):
         """
-        :return: (int8_t)
+        :return: (int8_t) None on timeout
         """
-        return struct.unpack('<b', bytearray(self.serial.read(1)))[0]
+        return self._read_value(I8)
 
     def read_i16(self):
         """
-        :return: (int16_t)
+        :return: (int16_t) None on timeout
         """
-        return struct.unpack('<h', bytearray(self.serial.read(2)))[0]
+        return self._read_value(I16)
 
     def read_i32(self):
         """
-        :return: (int32_t)
+        :return: (int32_t) None on timeout
+        """
+        return self._read_value(I32)
+
+    def _write(self, data):
+        if self._batch is not None:
+            self._batch += data
+        else:
+            self._send(data)
+
+    def _send(self, data):
+        self.serial.write(data)
+        self.bytes_written += len(data)
+
+    @contextmanager
+    def batch(self):
+        """
+        Queue the orders written inside the with block and send them to the Lickometer in a single write when the
+        block exits. Reads inside the block return None, the replies are read after the flush and stored in
+        self.batch_replies in the order they were requested. Only the configuration orders can be batched, the others
+        (watch_licks, reward, ping...) raise RuntimeError.
+
+        Example
+        -------
+        with lick_o_meter.batch():
+            lick_o_meter.set_size(2, ['left'])
+            lick_o_meter.calibrate_pump(0.5, 200, ['left'])
         """
-        return struct.unpack('<l', bytearray(self.serial.read(4)))[0]
+        self._batch = bytearray()
+        self._batch_reads = []
+        self._batch_echoes = []
+        try:
+            yield self
+        finally:
+            data, reads, echoes = self._batch, self._batch_reads, self._batch_echoes
+            self._batch = None
+            self._batch_reads = None
+            self._batch_echoes = None
+
+        self._send(data)
+        self.batch_replies = []
+        for encoding, is_order in reads:
+            value = self._read_value(encoding)
+            if is_order:
+                value = self.Order.TIMEOUT if value is None else self.to_order(value)
+            self.batch_replies.append(value)
+        for start, expected, callback in echoes:
+            self._when_echoed(expected, self.batch_replies[start:start + len(expected)], callback)
+
+    def _when_echoed(self, expected, replies, callback):
+        """
+        Call callback() once the replies of an exchange are confirmed to be the expected echoes, e.g. to remember a
+        configuration only if the Lickometer applied it. Inside batch() the replies are only known when the batch is
+        flushed, the check is done then.
+
+        :param expected: (list) expected replies, in the order they were read
+        :param replies: (list) replies read (ignored inside a batch)
+        :return: (bool) True if callback() was called
+        """
+        if self._batch is not None:
+            self._batch_echoes.append((len(self._batch_reads) - len(expected), list(expected), callback))
+            return False
+        if list(replies) != list(expected):
+            tracer.warning('Unexpected replies {} instead of {}', list(replies), list(expected), source=self.port)
+            return False
+        callback()
+        return True
 
     def write_order(self, order):
         """
         :param order: (Order Enum Object)
         """
-        self.write_i8(order.value)
+        value = order.value
+        start = time.perf_counter_ns()
+        self.write_i8(value)
+        # the reply read by the next read_order() closes the exchange (replies of a batch are not timed)
+        self._exchange = (value, start) if self._batch is None else None
 
     def write_i8(self, value):
         """
         :param value: (int8_t)
         """
         if -128 <= value <= 127:
-            self.serial.write(struct.pack('<b', value))
+            self._write(I8.pack(value))
         else:
-            print("Value error:{}".format(value))
+            tracer.error('Value error:{}', value, source=self.port)
 
     def write_i16(self, value):
         """
         :param value: (int16_t)
         """
-        self.serial.write(struct.pack('<h', value))
+        self._write(I16.pack(value))
 
     def write_i32(self, value):
         """
         :param value: (int32_t)
         """
-        self.serial.write(struct.pack('<l', value))
+        self._write(I32.pack(value))
 
     def write_ov(self, o, v):
         """
@@ -185,36 +1132,210 @@ class Protocol(Arduino, RewardAmount):
         :param v: value
         """
         try:
-            print(f"Send order: {self.Order(o).name}")
-            self.write_order(self.Order(o))
-        except:
-            print(f"Send order: {o}")
-            self.write_i8(o)
-        print(f"Send value: {v}")
-        self.write_i16(v)
-
+            order = self.Order(o)
+            o = order.value
+        except ValueError:
+            order = None
+        if tracer.debugging: tracer.debug('Send order: {} value: {}', order.name if order else o, v, source=self.port)
+        start = time.perf_counter_ns()
+        # order & value in one write (one system call, one TCP segment)
+        self._write(OV_FRAME.pack(o, v))
+        if order is not None:
+            self._exchange = (o, start) if self._batch is None else None
+
+    @unbatched
     def read_ovt(self, timeout=1):
         """
         Read order, value, time
         :param timeout:
         :return:
         """
-        t = time.time()
-        out_of_time = False
-        while self.input() < 7 and not out_of_time:
-            if time.time() - t > timeout:
-                out_of_time = True
-        if out_of_time:
+        event = self.wait_event(timeout)
+        if event is None:
             return self.Order.TIMEOUT, 0, -1
         else:
-            return self.read_order(), self.read_i16(), self.read_i32()
+            return event.order, event.value, event.device_time
+
+    @unbatched
+    def ping(self):
+        """
+        Exchange a PING with the Lickometer, which answers with an order/value/time record holding its clock
+        (micros()). Used by clock_sync.ClockSync, requires request/response mode (see stop_events()).
+
+        Returns
+        -------
+        tuple: (host send time, host receive time, device time) host times in time.perf_counter() seconds, device time
+            as sent (int32, wraps around), None on timeout
+        """
+        send = time.perf_counter()
+        self._write(I8.pack(self.Order.PING.value))
+        data = self.reader.read(OVT_FRAME.size, self._timeout())
+        if len(data) < OVT_FRAME.size:
+            self.stats.timeouts += 1
+            return None
+        # the reader stamps the bytes when they arrive, before waking this thread
+        receive = max(self.reader.last_arrival, send)
+        order, value, device_time = OVT_FRAME.unpack(data)
+        if order != self.Order.PING.value:
+            self.stats.invalid_orders += 1
+            return None
+        self.stats.add(order, int((receive - send) * 1e9))
+        return send, receive, device_time
+
+    @unbatched
+    def wait_event(self, timeout=None):
+        """
+        Wait for the next order/value/time record decoded by the reader thread.
+        The reader is switched to event mode while waiting and back to the previous mode afterwards, so the
+        request/response orders keep their replies (see start_events() to stay in event mode).
+        :param timeout: seconds to wait, None waits forever
+        :return: (Event) or None on timeout
+        """
+        previous = self.reader.event_mode
+        self.reader.set_event_mode(True)
+        try:
+            return self.events.get(timeout=self._timeout(timeout))
+        except queue.Empty:
+            return None
+        finally:
+            self.reader.set_event_mode(previous)
+
+    def start_events(self):
+        """
+        Keep the reader in event mode: every received record is put into the event queue, the request/response
+        orders get no reply until stop_events().
+        """
+        self.reader.set_event_mode(True)
+
+    def stop_events(self):
+        """
+        Switch the reader back from event mode to raw reads used by the request/response orders.
+        """
+        self.reader.set_event_mode(False)
 
 
 class Lickometer(Protocol):
     def __init__(self, **kwargs):
+        # composite_reward: the firmware understands REW_SIDE_SIZE, see reward()
+        self.composite_reward = kwargs.pop('composite_reward', False)
+        # delta_sync: only the pump parameters differing from self.state are sent to the Lickometer
+        self.delta_sync = kwargs.pop('delta_sync', True)
+        # state_cache: file keeping self.state between sessions for firmware that keeps its configuration when the
+        # port is opened (None: the configuration is only known from the orders sent in this session)
+        self.state_cache = kwargs.pop('state_cache', None)
         super(Lickometer, self).__init__(**kwargs)
         self.allowed_pumps = ['up', 'left', 'right']
+        # last applied configuration, replayed after reconnecting
+        self.state = {'calibration': {}, 'wash_speed': {}, 'size': {}, 'timeout': None}
+        self.samples = None
+        self.capture = None
+        self._stream_end = threading.Event()
+
+        if self.state_cache is not None:
+            serial_number = self.serial_number or port_serial_number(self.port) or self.port
+            self._state_key = f'{serial_number}|{self.version}'
+            cached = claim_device_state(self._state_key, self.initial_values, self.state_cache)
+            if cached is not None:
+                self.state = cached
+
+    def _record(self, key, pump, value):
+        if pump is None:
+            # setting of the whole device, e.g. timeout
+            self.state[key] = value
+            return
+        for p in (self.allowed_pumps if pump == 'all' else [pump]):
+            self.state[key][p] = value
+
+    def _changed(self, key, value, pumps):
+        """
+        :return: (list) the pumps whose key in self.state differs from value, ['all'] if all of them were requested
+            and differ (every pump if delta_sync is off)
+        """
+        if not self.delta_sync:
+            return pumps
+        known = self.state[key]
+        changed = []
+        for p in pumps:
+            for pump in (self.allowed_pumps if p == 'all' else [p]):
+                if known.get(pump) != value and pump not in changed:
+                    changed.append(pump)
+        if 'all' in pumps and len(changed) == len(self.allowed_pumps):
+            return ['all']
+        return changed
+
+    def invalidate_state(self):
+        """
+        Forget the known configuration of the Lickometer: the next configuration orders are all sent.
+        """
+        self.state = {'calibration': {}, 'wash_speed': {}, 'size': {}, 'timeout': None}
 
+    def _group_pumps(self, settings):
+        """
+        :param settings: (dict) {pump or 'all': value}, later entries override earlier ones
+        :return: (list) (*value, pumps) per distinct value, pumps is ['all'] if every pump gets the value
+        """
+        target = {}
+        for p, value in settings.items():
+            for pump in (self.allowed_pumps if p == 'all' else [p]):
+                target[pump] = tuple(value) if isinstance(value, (list, tuple)) else (value,)
+        groups = {}
+        for pump, value in target.items():
+            groups.setdefault(value, []).append(pump)
+        return [(*value, ['all'] if len(pumps) == len(self.allowed_pumps) else pumps)
+                for value, pumps in groups.items()]
+
+    def apply_profile(self, profile: dict):
+        """
+        Apply a whole configuration, only the parameters differing from the known state are sent, in a single write.
+
+        Parameters
+        ----------
+        profile : dict
+            Same layout as self.state (e.g. a saved copy of it): {'calibration': {pump: (motor_time, motor_speed)},
+            'wash_speed': {pump: speed}, 'size': {pump: size}, 'timeout': seconds or None}. Pumps may be 'all'.
+
+        Returns
+        -------
+        int: number of orders sent
+        """
+
+        sent = self.bytes_written
+        with self.batch():
+            for motor_time, motor_speed, pumps in self._group_pumps(profile.get('calibration', {})):
+                self.calibrate_pump(motor_time, motor_speed, pumps)
+            for speed, pumps in self._group_pumps(profile.get('wash_speed', {})):
+                self.set_wash_speed(speed, pumps)
+            for size, pumps in self._group_pumps(profile.get('size', {})):
+                self.set_size(size, pumps)
+            if profile.get('timeout') is not None:
+                self.set_timeout(profile['timeout'])
+        n_orders = sum(1 for reply in self.batch_replies if reply in (self.Order.CALIBRATE, self.Order.SET_WASHSPEED,
+                                                                       self.Order.SET_SIZE, self.Order.SET_TIMEOUT))
+        if tracer.debugging:
+            tracer.debug('Lickometer.apply_profile: {} orders, {} bytes', n_orders, self.bytes_written - sent,
+                         source=self.port)
+        return n_orders
+
+    def close(self):
+        if self.state_cache is not None:
+            save_device_state(self._state_key, self.initial_values, self.state, self.state_cache)
+        super(Lickometer, self).close()
+
+    def _on_reconnect(self):
+        super(Lickometer, self)._on_reconnect()
+        # the Arduino restarted with its initial values: replay the configuration
+        state = self.state
+        self.invalidate_state()
+        for p, (motor_time, motor_speed) in state['calibration'].items():
+            self.calibrate_pump(motor_time, motor_speed, [p])
+        for p, speed in state['wash_speed'].items():
+            self.set_wash_speed(speed, [p])
+        for p, size in state['size'].items():
+            self.set_size(size, [p])
+        if state['timeout'] is not None:
+            self.set_timeout(state['timeout'])
+
+    @reconnecting
     def set_wash_speed(self, speed: int, pumps=None):
         """
         Set the motor speed for washing and TTL-controlled rewarding.
@@ -234,11 +1355,11 @@ class Lickometer(Protocol):
         if not pumps:
             pumps = ['all']
 
-        for p in pumps:
+        for p in self._changed('wash_speed', speed, pumps):
             # Order
             self.write_order(self.Order.SET_WASHSPEED)
             order_result = self.read_order()
-            if self.printing: print(f'Lickometer.set_wash_speed: {order_result}')
+            if tracer.debugging: tracer.debug('Lickometer.set_wash_speed: {}', order_result, source=self.port)
 
             # Parameters
             #   pump
@@ -247,8 +1368,13 @@ class Lickometer(Protocol):
             #   wash speed
             self.write_i16(speed)
             speed_result = self.read_i16()
-            if self.printing: print(f'Lickometer.set_wash_speed({pump_result}, {speed_result})\n')
+            if tracer.debugging:
+                tracer.debug('Lickometer.set_wash_speed({}, {})', pump_result, speed_result, source=self.port)
+            self._when_echoed([self.Order.SET_WASHSPEED, self.command[p], speed],
+                              [order_result, pump_result, speed_result],
+                              functools.partial(self._record, 'wash_speed', p, speed))
 
+    @reconnecting
     def set_size(self, size: int, pumps=None):
         """
         Set the reward size of requested pumps.
@@ -268,11 +1394,11 @@ class Lickometer(Protocol):
         if not pumps:
             pumps = ['all']
 
-        for p in pumps:
+        for p in self._changed('size', size, pumps):
             # Order
             self.write_order(self.Order.SET_SIZE)
             order_result = self.read_order()
-            if self.printing: print(f'Lickometer.set_size: {order_result}')
+            if tracer.debugging: tracer.debug('Lickometer.set_size: {}', order_result, source=self.port)
 
             # Parameters
             #   pump
@@ -281,8 +1407,11 @@ class Lickometer(Protocol):
             #   size
             self.write_i16(size)
             size_result = self.read_i16()
-            if self.printing: print(f'Lickometer.set_size({pump_result}, {size_result})\n')
+            if tracer.debugging: tracer.debug('Lickometer.set_size({}, {})', pump_result, size_result, source=self.port)
+            self._when_echoed([self.Order.SET_SIZE, self.command[p], size], [order_result, pump_result, size_result],
+                              functools.partial(self._record, 'size', p, size))
 
+    @reconnecting
     def calibrate_pump(self, motor_time, motor_speed, pumps=None):
         """
         Set reward's motor time and motor speed of requested pumps.
@@ -303,6 +1432,7 @@ class Lickometer(Protocol):
 
         if not pumps:
             pumps = ['all']
+        calibration = (motor_time, motor_speed)
 
         # Validate motor_time and motor_speed
         if motor_time > 0 and motor_time != float('inf'):
@@ -316,11 +1446,11 @@ class Lickometer(Protocol):
         if motor_speed > 255:
             motor_speed = 255
 
-        for p in pumps:
+        for p in self._changed('calibration', calibration, pumps):
             # Order
             self.write_order(self.Order.CALIBRATE)
             order_result = self.read_order()
-            if self.printing: print(f'Lickometer.calibrate_pump: {order_result}')
+            if tracer.debugging: tracer.debug('Lickometer.calibrate_pump: {}', order_result, source=self.port)
 
             # Parameters
             #   pump
@@ -332,8 +1462,14 @@ class Lickometer(Protocol):
             #   motor_speed
             self.write_i16(motor_speed)
             speed_result = self.read_i16()
-            if self.printing: print(f'Lickometer.calibrate_pump({pump_result}, {time_result}, {speed_result})\n')
-
+            if tracer.debugging:
+                tracer.debug('Lickometer.calibrate_pump({}, {}, {})', pump_result, time_result, speed_result,
+                             source=self.port)
+            self._when_echoed([self.Order.CALIBRATE, self.command[p], motor_time, motor_speed],
+                              [order_result, pump_result, time_result, speed_result],
+                              functools.partial(self._record, 'calibration', p, calibration))
+
+    @reconnecting
     def set_timeout(self, timeout):
         """
         Set duration of waiting for licking in WFL state.
@@ -348,6 +1484,10 @@ class Lickometer(Protocol):
 
         """
 
+        if self.delta_sync and self.state['timeout'] == timeout:
+            return
+        requested = timeout
+
         # Validate timeout
         if timeout > 0 and timeout != float('inf'):
             timeout *= 1000     # convert timeout: s --> ms
@@ -357,14 +1497,20 @@ class Lickometer(Protocol):
         # Order
         self.write_order(self.Order.SET_TIMEOUT)
         order_result = self.read_order()
-        if self.printing: print(f'Lickometer.set_timeout: {order_result}')
+        if tracer.debugging: tracer.debug('Lickometer.set_timeout: {}', order_result, source=self.port)
 
         # Parameters
         self.write_i32(timeout)
         time_result = self.read_i32()
         inf_result = self.read_order()
-        if self.printing: print(f'Lickometer.set_timeout({time_result}, finite timeout={inf_result})\n')
-
+        if tracer.debugging:
+            tracer.debug('Lickometer.set_timeout({}, finite timeout={})', time_result, inf_result, source=self.port)
+        self._when_echoed([self.Order.SET_TIMEOUT, timeout, self.Order.DONE if timeout > 0 else self.Order.NONE],
+                          [order_result, time_result, inf_result],
+                          functools.partial(self._record, 'timeout', None, requested))
+
+    @unbatched
+    @reconnecting
     def watch_licks(self):
         """
         Set Lickometer in WFL (wait for licking) state and give feedback
@@ -377,20 +1523,23 @@ class Lickometer(Protocol):
         # Order
         self.write_order(self.Order.WFL)
         order_result = self.read_order()
-        if self.printing: print(f'Lickometer.watch_licks: {order_result}')
+        if tracer.debugging: tracer.debug('Lickometer.watch_licks: {}', order_result, source=self.port)
 
-        # Wait for response
-        while self.input() < 1:
-            pass
+        # Wait for response (the Lickometer answers after a lick or its own timeout)
+        self.reader.wait_for_bytes(1, self._timeout(None))
 
         # Parameters
         lick_result = self.read_i8()
+        if lick_result is None:
+            # deadline expired: no lick
+            lick_result = 0
         # lick_result2 = self.read_line()
-        if self.printing: print(f'Lickometer.watch_licks({lick_result}-->{lick_result:03})\n')
+        if tracer.debugging: tracer.debug('Lickometer.watch_licks({0}-->{0:03})', lick_result, source=self.port)
         # print(f'Lickometer.watch_licks({lick_result2})')
 
         return f"{lick_result:03}"
 
+    @reconnecting
     def set_side(self, side: str):
         """
         Set the next rewarded side before rewarding.
@@ -408,19 +1557,24 @@ class Lickometer(Protocol):
         # Order
         self.write_order(self.Order.SET_SIDE)
         order_result = self.read_order()
-        if self.printing: print(f'Lickometer.set_side: {order_result}')
+        if tracer.debugging: tracer.debug('Lickometer.set_side: {}', order_result, source=self.port)
 
         # Parameter
         self.write_order(self.command[side])
         side_selected = self.read_order()
         side_result = self.read_order()
-        if self.printing: print(f'Lickometer.set_side({side_selected}, {side_result})\n')
+        if tracer.debugging: tracer.debug('Lickometer.set_side({}, {})', side_selected, side_result, source=self.port)
 
+    @unbatched
     def reward(self, side: str, size=-1):
         """
         Give reward by the requested pump. Up always rewarding but left & right use current size.
         If size specified that will be set (not current size).
 
+        The size is computed once. Setting it and the side is repeated after reconnecting, the REW order is not: if
+        the connection is lost once REW was sent, the reward may have been given and serial.SerialException is raised
+        to the caller (the next order reconnects).
+
         Parameters
         ----------
         side: str
@@ -432,15 +1586,19 @@ class Lickometer(Protocol):
         -------
 
         """
-        # Set reward size
+        # Reward size
         if not size == -1:
-            self.set_size(size)
+            pass
         # 'up' lickometer: 100%
         elif side == 'up':
-            self.set_size(self.rew_size)
+            size = self.rew_size
         elif side != 'up':
-            s = self.current_size()
-            self.set_size(s)
+            size = self.current_size()
+
+        if self.composite_reward:
+            return self.reward_composite(side, size)
+
+        self.set_size(size)
 
         # Set rewarding side
         self.set_side(side=side)
@@ -449,18 +1607,129 @@ class Lickometer(Protocol):
         # Order
         self.write_order(self.Order.REW)
         order_result = self.read_order()
-        if self.printing: print(f'Lickometer.reward: {order_result}')
+        if tracer.debugging: tracer.debug('Lickometer.reward: {}', order_result, source=self.port)
         time.sleep(0.1)
 
         # Results
         reward_result = self.read_order()
-        if self.printing: print(f'Lickometer.reward({reward_result})\n')
+        if tracer.debugging: tracer.debug('Lickometer.reward({})', reward_result, source=self.port)
         return reward_result
 
+    @unbatched
+    def reward_composite(self, side: str, size: int):
+        """
+        Give reward in a single round trip: REW_SIDE_SIZE, side and size are sent in one write and the Lickometer
+        answers once with the result of rewarding. Requires firmware supporting REW_SIDE_SIZE
+        (Lickometer(composite_reward=True) makes reward() use it). Like reward(), it is not repeated if the
+        connection is lost.
+
+        Parameters
+        ----------
+        side: str
+            Where the reward must be given.
+        size : int
+            reward_length = motor_time * size
+
+        Returns
+        -------
+        Order: result of rewarding
+        """
+
+        start = time.perf_counter_ns()
+        self._write(REW_SIDE_SIZE_FRAME.pack(self.Order.REW_SIDE_SIZE.value, self.command[side].value, size))
+        self._exchange = (self.Order.REW_SIDE_SIZE.value, start) if self._batch is None else None
+        reward_result = self.read_order()
+        if tracer.debugging:
+            tracer.debug('Lickometer.reward_composite({}, {}): {}', side, size, reward_result, source=self.port)
+        self._when_echoed([self.Order.DONE], [reward_result], functools.partial(self._record, 'size', side, size))
+        return reward_result
+
+    @unbatched
+    def start_stream(self, capture_path=None, ring_seconds=10, sampling=2000):
+        """
+        Set Lickometer in STREAM state: the raw sensor samples of up, left and right are streamed continuously.
+        The samples are decoded by the reader thread into self.samples (SampleRing of the last ring_seconds) and,
+        if capture_path is given, appended to a memory-mapped file (SampleCapture) for the whole session.
+
+        Parameters
+        ----------
+        capture_path : str, optional
+            File of the session's samples.
+        ring_seconds : float, optional
+            Length of the live ring buffer in seconds.
+        sampling : int, optional
+            Sampling rate of the Lickometer (Lickometer_sampling of the initial values). The stream must fit in the
+            baud rate of the port: sampling * SAMPLE_DTYPE.itemsize * 10 <= rate, e.g. at most 192 Hz at 19200 baud
+            and 2304 Hz at 230400 baud, the Lickometer has to be opened (and its firmware built) with such a rate.
+
+        Raises
+        ------
+        ValueError
+            If the stream does not fit in the baud rate, it would overrun the line and lose or desynchronise samples.
+        """
+
+        needed = sampling * SAMPLE_DTYPE.itemsize * LINE_BITS_PER_BYTE
+        if self.rate is not None and needed > self.rate:
+            raise ValueError(f'streaming at {sampling} Hz needs {needed} baud, the port is opened at {self.rate} baud')
+
+        # Order
+        self.write_order(self.Order.STREAM)
+        order_result = self.read_order()
+        if tracer.debugging: tracer.debug('Lickometer.start_stream: {}', order_result, source=self.port)
+
+        # Parameter: on
+        self.samples = SampleRing(int(ring_seconds * sampling))
+        self.capture = SampleCapture(capture_path) if capture_path else None
+        self._stream_end.clear()
+        self.write_i16(1)
+        stream_result = self.read_i16()
+        self.reader.set_frame_mode(FrameDecoder(dtype=SAMPLE_DTYPE), self._store_samples)
+        if tracer.debugging: tracer.debug('Lickometer.start_stream({})', stream_result, source=self.port)
+
+    def _store_samples(self, samples, host_time):
+        end = numpy.flatnonzero(samples['index'] == STREAM_END)
+        if len(end):
+            samples = samples[:end[0]]
+            self._stream_end.set()
+        if len(samples):
+            self.samples.extend(samples)
+            if self.capture is not None:
+                self.capture.append(samples)
+
+    @unbatched
+    def stop_stream(self):
+        """
+        Stop streaming: the Lickometer closes the stream with a STREAM_END record and goes back to request/response.
+
+        Returns
+        -------
+        int: number of samples received
+        """
+
+        if self.samples is None or self.reader.handler != self._store_samples:
+            tracer.warning('Lickometer.stop_stream: not streaming', source=self.port)
+            return 0
+        self._write(OV_FRAME.pack(self.Order.STREAM.value, 0))
+        self._exchange = None  # the reply is the end of the stream
+        stopped = self._stream_end.wait(self._timeout())
+        self.reader.set_frame_mode()
+        if not stopped:
+            # the rest of the stream would be read as the replies of the next orders
+            dropped = self.reader.discard(timeout=self.timeout)
+            tracer.warning('Lickometer.stop_stream: no end of stream, {} bytes dropped', dropped, source=self.port)
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
+        if tracer.debugging:
+            tracer.debug('Lickometer.stop_stream({} samples, closed={})', self.samples.count, stopped, source=self.port)
+        return self.samples.count
+
+    @unbatched
+    @reconnecting
     def punish(self):
         self.write_order(self.Order.NOR)
         result = self.read_line()
-        if self.printing: print(f'Lickometer.punish: {result}')
+        if tracer.debugging: tracer.debug('Lickometer.punish: {}', result, source=self.port)
 
 
 if __name__ == '__main__':
@@ -1,19 +1,158 @@
 """
 Definition of the parameters of the monitors used in the lab.
 Add to this dictionary and run main if you want to use a new screen!
+
+The frame rate and unit conversions measured on a monitor are cached in ~/.jumpstand/monitor_calibration.json by
+monitor name, resolution and screen, see monitor_calibration().
 """
 
+import json
+import os
+import time
+
+import numpy
 from psychopy import monitors
+from psychopy.tools import monitorunittools
+
+from tracing import tracer
 
 mymonitors = {'Samsung_LE40C530': {'width': 97.0, 'resolution': (1920, 1080)},
               'Small_LG': {'width': 45.0, 'resolution': (1920, 1080)},
               'Fujitsu_rodent': {'width': 47.5, 'resolution': (1920, 1080)},
               'Dell_24_inch': {'width': 52.5, 'resolution': (1920, 1080)}}
 
+CALIBRATION_CACHE = os.path.join(os.path.expanduser('~'), '.jumpstand', 'monitor_calibration.json')
+
+
+def calibration_key(name, resolution, screen):
+    return f'{name}:{resolution[0]}x{resolution[1]}:{screen}'
+
+
+def _load_calibrations(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def load_calibration(name, resolution, screen, path=CALIBRATION_CACHE):
+    """
+    :return: (dict) cached calibration of the monitor (see measure_calibration()), None if not measured yet
+    """
+    return _load_calibrations(path).get(calibration_key(name, resolution, screen))
+
+
+def save_calibration(name, resolution, screen, calibration, path=CALIBRATION_CACHE):
+    calibrations = _load_calibrations(path)
+    calibrations[calibration_key(name, resolution, screen)] = calibration
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(calibrations, f, indent=1)
+
+
+def measure_frame_intervals(win, n_frames, n_warmup=10):
+    """
+    Flip the window n_warmup + n_frames times (waiting for the vertical blank).
+
+    Returns
+    -------
+    numpy.ndarray: n_frames intervals between the flips (s)
+    """
+    wait_blanking = win.waitBlanking
+    win.waitBlanking = True
+    try:
+        for _ in range(n_warmup):
+            win.flip()
+        times = numpy.array([win.flip() for _ in range(n_frames + 1)])
+    finally:
+        win.waitBlanking = wait_blanking
+    return numpy.diff(times)
+
+
+def frame_jitter(intervals, drop_factor=1.5):
+    """
+    :return: (float, int) standard deviation of the frame intervals (s) without the dropped frames (intervals above
+        drop_factor * median), number of dropped frames
+    """
+    kept = intervals[intervals <= drop_factor * numpy.median(intervals)]
+    return float(kept.std()), len(intervals) - len(kept)
+
+
+def measure_calibration(win, mon, n_frames=200, threshold=0.001):
+    """
+    Measure the frame rate of the window and the unit conversions of its monitor.
+
+    Parameters
+    ----------
+    win : psychopy.visual.Window
+    mon : psychopy.monitors.Monitor
+    n_frames : int, optional
+        Frames measured.
+    threshold : float, optional
+        The measure is not reliable if the standard deviation of the frame intervals is above threshold (s). The
+        dropped frames are left out (see frame_jitter()), a few of them do not spoil the measure.
+
+    Returns
+    -------
+    dict: framerate (Hz), frame_dur (s, of the rounded frame rate), jitter (s, standard deviation of the frame
+        intervals), dropped (frames dropped during the measure), pix_per_deg, deg_per_pix (at the centre of the screen),
+        measured (time of the measure), None if the frame rate is not reliable
+    """
+    intervals = measure_frame_intervals(win, n_frames)
+    jitter, dropped = frame_jitter(intervals)
+    if jitter > threshold:
+        tracer.warning('Frame intervals too variable to measure the frame rate: {:.2f} ms', jitter * 1e3)
+        return None
+    framerate = float(1 / numpy.median(intervals))
+    pix_per_deg = float(monitorunittools.deg2pix(1.0, mon, correctFlat=False))
+    return {'framerate': framerate, 'frame_dur': 1.0 / round(framerate), 'jitter': jitter, 'dropped': dropped,
+            'pix_per_deg': pix_per_deg, 'deg_per_pix': 1.0 / pix_per_deg, 'measured': time.time()}
+
+
+def monitor_calibration(win, mon, name, screen, remeasure=False, verify_frames=30, verify_after=7 * 24 * 3600,
+                        tolerance=0.05, path=CALIBRATION_CACHE):
+    """
+    Calibration of the monitor from the cache, measured and cached if there is none. A cached calibration older than
+    verify_after is checked by a short verification pass (verify_frames frames), measured again if the frame rate of
+    the monitor changed, else marked as verified so the next start-ups skip the pass.
+
+    Parameters
+    ----------
+    win : psychopy.visual.Window
+    mon : psychopy.monitors.Monitor
+    name : str
+        Name of the monitor in mymonitors.
+    screen : int
+        Screen of the window.
+    remeasure : bool, optional
+        Measure again even if the monitor is in the cache.
+    verify_frames : int, optional
+        Frames of the verification pass, 0: trust the cache.
+    verify_after : float, optional
+        Age (s) of the last measure or verification above which the cached calibration is verified.
+    tolerance : float, optional
+        Relative difference of the frame duration that triggers a new measure.
+
+    Returns
+    -------
+    dict: see measure_calibration(), None if the frame rate could not be measured
+    """
+    resolution = mymonitors[name]['resolution'] if name in mymonitors else tuple(win.size)
+    calibration = None if remeasure else load_calibration(name, resolution, screen, path)
+
+    if calibration is not None and verify_frames and time.time() - calibration.get('measured', 0) > verify_after:
+        frame_dur = float(numpy.median(measure_frame_intervals(win, verify_frames, n_warmup=2)))
+        if abs(frame_dur - 1 / calibration['framerate']) > tolerance / calibration['framerate']:
+            tracer.warning('Frame rate of {} changed: {:.2f} Hz cached, {:.2f} Hz measured', name,
+                           calibration['framerate'], 1 / frame_dur)
+            calibration = None
+        else:
+            calibration['measured'] = time.time()
+            save_calibration(name, resolution, screen, calibration, path)
 
-if __name__ == '__main__':
-    for mon in mymonitors.keys():
-        psychopy_mon = monitors.Monitor(mon, width=mymonitors[mon]['width'],
-                                        currentCalib={'sizePix': mymonitors[mon]['resolution']})
-        psychopy_mon.setSizePix(mymonitors[mon]['resolution'])
-        psychopy_mon.save()
+    if calibration is None:
+        calibration = measure_calibration(win, mon)
+        if calibration is not None:
+            save_calibration(name, resolution, screen, calibration, path)
+    return calibration
@@ -0,0 +1,110 @@
+"""
+Present the frames of two windows (one per screen) at the same vertical blank and measure the inter-screen skew.
+
+Flipping the windows one after the other with waitBlanking blocks on the first window until its vertical blank, so the
+second window swaps a frame later. DualPresenter issues the swaps of both windows without waiting, then waits for the
+blank of each window once: the time between the two waits returning is the skew of the frame (~0 when both screens
+showed the frame at the same blank, ~1 frame when the second screen lagged):
+
+    presenter = DualPresenter({'left': win_l, 'right': win_r}, frames)
+    presenter.flip()
+    ...
+    presenter.report()   # skew distribution of the session
+"""
+
+import numpy
+
+from psychopy import core
+
+from tracing import tracer
+
+
+def wait_blanking(win):
+    """
+    Block until the last swap of win is done, like psychopy Window.flip() does when waitBlanking is True.
+
+    Returns
+    -------
+    float: core.getTime() when the swap is done
+    """
+    if hasattr(win, 'wait_blanking'):
+        # headless.Window
+        return win.wait_blanking()
+    win._setCurrent()
+    GL = win.backend.GL
+    GL.glBegin(GL.GL_POINTS)
+    GL.glColor4f(0, 0, 0, 0)
+    GL.glVertex2i(10, 10)
+    GL.glEnd()
+    GL.glFinish()
+    return core.getTime()
+
+
+class DualPresenter:
+    def __init__(self, windows, frames=None, capacity=1 << 16):
+        """
+        Parameters
+        ----------
+        windows : dict
+            {name: psychopy.visual.Window}, the windows are swapped in this order.
+        frames : frame_timing.FrameRecorder, optional
+            Records the time every window finished its swap.
+        capacity : int, optional
+            Frames preallocated for the skew (the array grows if a session is longer).
+        """
+        self.windows = {name: win for name, win in windows.items() if win is not None}
+        self.frames = frames
+        self.skew = numpy.empty(capacity)
+        self.count = 0
+        self.flip_time = None  # core.getTime() of the vertical blank of the last frame
+        # swaps are issued by flip() and waited for once per window
+        for win in self.windows.values():
+            win.waitBlanking = False
+
+    def flip(self, clear_buffer=True):
+        """
+        Swap all the windows, then wait for their vertical blanks.
+
+        Returns
+        -------
+        float: skew of the frame (s), time between the first and the last window finishing its swap
+        """
+        for win in self.windows.values():
+            win.flip(clearBuffer=clear_buffer)
+        done = [wait_blanking(win) for win in self.windows.values()]
+        self.flip_time = done[0]
+        if self.frames is not None:
+            for name, t in zip(self.windows, done):
+                self.frames.record(name, t)
+
+        skew = done[-1] - done[0]
+        if self.count == len(self.skew):
+            self.skew = numpy.resize(self.skew, 2 * len(self.skew))
+        self.skew[self.count] = skew
+        self.count += 1
+        return skew
+
+    def skew_stats(self):
+        """
+        Returns
+        -------
+        dict: frames, mean, median, p95, max skew (s) of the session
+        """
+        skew = self.skew[:self.count]
+        if not len(skew):
+            return {'frames': 0, 'mean': 0.0, 'median': 0.0, 'p95': 0.0, 'max': 0.0}
+        return {'frames': self.count, 'mean': float(skew.mean()), 'median': float(numpy.median(skew)),
+                'p95': float(numpy.percentile(skew, 95)), 'max': float(skew.max())}
+
+    def report(self):
+        """
+        Trace the skew distribution of the session.
+
+        Returns
+        -------
+        dict: see skew_stats()
+        """
+        stats = self.skew_stats()
+        tracer.info('Inter-screen skew of {frames} frames: mean {mean:.5f} s, median {median:.5f} s, '
+                    'p95 {p95:.5f} s, max {max:.5f} s', **stats)
+        return stats
@@ -12,17 +12,30 @@ from psychopy import sound, monitors
 import numpy
 import random
 import pytest
-from screeninfo import get_monitors
-detected_monitors = get_monitors()
+from screeninfo import get_monitors, Monitor
+try:
+    detected_monitors = get_monitors()
+except Exception:  # no display, e.g. headless
+    detected_monitors = []
+# screens of the headless mode (see headless.py)
+HEADLESS_MONITORS = [Monitor(x=0, y=0, width=1920, height=1080, width_mm=527, height_mm=296, name='headless')] * 2
 # print(f"Detected monitors:")
 # [print(f"\t{mon}") for mon in detected_monitors]
 from psychopy import core, visual, gui, data, event
 from psychopy.tools.filetools import fromFile, toFile
 
+from frame_timing import FrameRecorder
+from gratings import textures
+import headless as headless_rendering
+from monitors import monitor_calibration
+from presenter import DualPresenter
+from tracing import tracer
+
 import sys
 import pdb
 import traceback
 def debughook(etype, value, tb):
+    tracer.flush()  # write the pending traces before the traceback
     traceback.print_exception(etype, value, tb)
     print() # make a new line before launching post-mortem
     # pdb.pm() # post-mortem debugger
@@ -40,29 +53,36 @@ machine_dict = {'LabThinkpadStim': 101707888628436,
 
 
 class TwoAFC:
-    def __init__(self, lickemu, touchscreen=False, show_messages=False, windowed=None):
+    def __init__(self, lickemu, touchscreen=False, show_messages=False, windowed=None, headless=False):
         self.lickemu = lickemu
-        print(self.lickemu)
+        tracer.debug('{}', self.lickemu)
         self.touchsc = touchscreen
         self.show_messages = show_messages
         self.windowed = windowed
+        # headless: offscreen NumPy windows and stimuli instead of psychopy (see headless.py)
+        self.headless = headless
+        self.visual = headless_rendering if headless else visual
         self.init_environment()
 
     def init_environment(self):
         if not self.lickemu:
             try:
                 import lickometer
+                from device_manager import DeviceWorker
                 self.lick_o_meter = lickometer.Lickometer()
+                # runs the Lickometer orders one after the other off the render thread
+                self.lick_worker = DeviceWorker(self.lick_o_meter)
                 trialtext = ''
             except:
                 self.lickemu = 1
-        print(f'lickemu: {self.lickemu}')
+        tracer.info('lickemu: {}', self.lickemu)
+        screens = HEADLESS_MONITORS if self.headless else detected_monitors
         computer = uuid.getnode()
-        print(f"Running on computer with mac address: {computer}")
+        tracer.info("Running on computer with mac address: {}", computer)
         if computer == 101707888628436:
             # jump stand with two monitors
             monitor_params = {'distance_cm': 40}
-            screen_ids = (2, 1) # if len(detected_monitors) == 1 else (1, 0)
+            screen_ids = (2, 1) # if len(screens) == 1 else (1, 0)
         elif computer == 93181002139480:
             # 2pgoe
             monitor_params = {'distance_cm': 40}
@@ -76,33 +96,33 @@ class TwoAFC:
         else:
             # Gazsi added monitor_params
             monitor_params = {'distance_cm': 40}
-            screen_ids = (0, 0) if len(detected_monitors) == 1 else (1, 0)
+            screen_ids = (0, 0) if len(screens) == 1 else (1, 0)
         mon={}
-        for i1, k1 in zip(range(len(detected_monitors)), ['left','right']):
-            mon[k1] = monitors.Monitor(detected_monitors[i1].name, width=detected_monitors[i1].width_mm/10, distance=monitor_params['distance_cm'])
-            mon[k1].setSizePix((detected_monitors[i1].width, detected_monitors[i1].height))
+        for i1, k1 in zip(range(len(screens)), ['left','right']):
+            mon[k1] = monitors.Monitor(screens[i1].name, width=screens[i1].width_mm/10, distance=monitor_params['distance_cm'])
+            mon[k1].setSizePix((screens[i1].width, screens[i1].height))
 
         if self.windowed:
-            print('windowed mode')
+            tracer.info('windowed mode')
             self.window_p = {
                 'size' : {'height': 600, 'width': 800},
                 'pos' : {'left': (0, 0), 'right': (0, 0)},
                 'unit': 'pix'
             }
         else:
-            print('fullscreen mode')
+            tracer.info('fullscreen mode')
             self.window_p = {
-                'size': {mk: getattr(detected_monitors[-1], mk) for mk in ['height', 'width']},
+                'size': {mk: getattr(screens[-1], mk) for mk in ['height', 'width']},
                 'pos': {'left': (0, 0), 'right': (0, 0)},
                 'unit': 'pix'
             }
         if computer == 220292358129433 or computer == 101707888628436:
             # my laptop monitor is much smaller then externals
-            monitor_pixelsize = detected_monitors[1].width_mm / detected_monitors[1].width  # mm
+            monitor_pixelsize = screens[1].width_mm / screens[1].width  # mm
         else:
-            monitor_pixelsize = detected_monitors[0].width_mm/detected_monitors[0].width  # mm
-        grating_size_deg = numpy.arctan(detected_monitors[0].width_mm/10/2 / monitor_params['distance_cm'])
-        print(detected_monitors)
+            monitor_pixelsize = screens[0].width_mm/screens[0].width  # mm
+        grating_size_deg = numpy.arctan(screens[0].width_mm/10/2 / monitor_params['distance_cm'])
+        tracer.debug('{}', screens)
 
         # half pixel is viewed in right angled triangle -> multiply by 2 at the end to get visual degree for a full pixel
         one_pixel_in_visual_degrees = numpy.arctan(monitor_pixelsize/2/monitor_params['distance_cm']/10) * 180/numpy.pi * 2
@@ -122,10 +142,31 @@ class TwoAFC:
                                'punish': sound.Sound('pinknoise.wav', volume=self.feedback_sound_absolute_volume['punish'], stopTime=0.6)}
 
         # create window(s): if only one screen detected, use the same screen for both 'left' and 'right' stimulus windows
-        self.win = {sk1: visual.Window([self.window_p['size']['width'], self.window_p['size']['height']], allowGUI=True, screen=si1,
+        self.win = {sk1: self.visual.Window([self.window_p['size']['width'], self.window_p['size']['height']], allowGUI=True, screen=si1,
                                           monitor=mon[sk1], units=self.window_p['unit'], pos=self.window_p['pos'][sk1]) for si1, sk1 in
                        zip(screen_ids,self.window_p['pos'].keys())}  # emulation mode on single screen
-        self.mouse = {wk: event.Mouse(win=wv) for wk,wv in self.win.items()}
+        Mouse = headless_rendering.Mouse if self.headless else event.Mouse
+        self.mouse = {wk: Mouse(win=wv) for wk,wv in self.win.items()}
+
+        # frame duration of the screens (measured once per monitor, resolution and screen, then cached)
+        self.calibration = None if self.headless else monitor_calibration(self.win['left'], mon['left'],
+                                                                          screens[0].name, screen_ids[0])
+        if self.calibration is not None:
+            frame_dur = self.calibration['frame_dur']
+        else:
+            frame_dur = self.win['left'].monitorFramePeriod  # no reliable measure, psychopy's default
+            if not self.headless:
+                tracer.warning('Frame rate not measured, dropped frames counted at {:.1f} Hz', 1 / frame_dur)
+        # flip timestamps of the windows, dropped frames per trial
+        self.frames = FrameRecorder(frame_dur, list(self.win.keys()))
+        # both screens swap at the same vertical blank
+        self.presenter = DualPresenter(self.win, self.frames)
+
+    def flip(self):
+        """
+        Flip all the windows together and record their flip timestamps and inter-screen skew.
+        """
+        self.presenter.flip()
 
     def punish(self, volume=1):
         """
@@ -146,8 +187,8 @@ class TwoAFC:
         else:
             self.feedback_sound['punish'].volume = volume
             self.feedback_sound_absolute_volume['punish'] *= volume
-            print(f"Punish sound's volume: {volume}x last_punish_played_volume, absolute volume: "
-                  f"{self.feedback_sound_absolute_volume['punish']}")
+            tracer.info("Punish sound's volume: {}x last_punish_played_volume, absolute volume: {}", volume,
+                        self.feedback_sound_absolute_volume['punish'])
 
         self.feedback_sound['punish'].stop()
         self.feedback_sound['punish'].play()
@@ -172,20 +213,44 @@ class TwoAFC:
         else:
             self.feedback_sound['reward'].volume = volume
             self.feedback_sound_absolute_volume['reward'] *= volume
-            print(f"Reward sound's volume: {volume}x last_reward_played_volume, absolute volume: "
-                  f"{self.feedback_sound_absolute_volume['reward']}")
+            tracer.info("Reward sound's volume: {}x last_reward_played_volume, absolute volume: {}", volume,
+                        self.feedback_sound_absolute_volume['reward'])
 
         self.feedback_sound['reward'].stop()
         self.feedback_sound['reward'].play()
 
     def deliver_reward(self, side: str):
         """
-        Delivers reward with lickometer
+        Delivers reward with lickometer without blocking the caller.
+
+        Returns
+        -------
+        concurrent.futures.Future or None: result of Lickometer.reward (None in emulation mode)
         """
 
         self.bridge_reward()
-        if not self.lickemu:
-            self.lick_o_meter.reward(side)
+        return self.reward(side)
+
+    def reward(self, side: str):
+        """
+        Submit a reward to the lickometer worker: the pump handshake runs in the background while the windows keep
+        flipping, the returned future can be waited for or ignored.
+
+        Returns
+        -------
+        concurrent.futures.Future or None: result of Lickometer.reward (None in emulation mode)
+        """
+
+        if self.lickemu:
+            return None
+        def report_failure(f):
+            exc = f.exception()
+            if exc is not None:
+                tracer.error('reward({}) failed: {}', side, exc)
+
+        future = self.lick_worker.submit('reward', side)
+        future.add_done_callback(report_failure)
+        return future
 
     def wait_for_lickometer(self, enabled_lickometers:list, timeout=float('inf')):
         """
@@ -204,33 +269,33 @@ class TwoAFC:
         """
 
         kopt = ['up', 'left', 'right']
-        print(f"Waiting for lick for {timeout} seconds")
+        tracer.info("Waiting for lick for {} seconds", timeout)
 
         # wait for pressed keys
         if self.lickemu:
             tc = core.Clock()
-            print(f"started! {tc.getTime()}")
+            tracer.debug("started! {}", tc.getTime())
             key = event.waitKeys(maxWait=timeout, clearEvents=True)  # wait for participant to respond
-            print(f"Got {key}, timeout {timeout}")
+            tracer.debug("Got {}, timeout {}", key, timeout)
             if key is not None and 'q' in key:
-                print("'q' key detected, quit")
+                tracer.info("'q' key detected, quit")
                 core.quit()
             event.clearEvents()
 
             # no key hit (timeout)
             if key is None:
-                print('no lickometer response (timeout)')
+                tracer.info('no lickometer response (timeout)')
                 return  # there was no lick, timeout
             #  key is not left/right/up
             elif not any([k1 in key for k1 in kopt]):
-                print('wrong response (invalid, e.g. wrong keyboard key hit)')
+                tracer.info('wrong response (invalid, e.g. wrong keyboard key hit)')
                 return
             # activated lickometer was disabled
             elif any([k2 not in enabled_lickometers for k2 in key]):
-                print(f'lickometer acitvated: {key[-1]} but this lickometer was actually disabled!')
+                tracer.info('lickometer acitvated: {} but this lickometer was actually disabled!', key[-1])
                 return key[-1]  # since it was a lick, return it
             else:
-                print(f'good: {key[-1]}')
+                tracer.info('good: {}', key[-1])
                 return key[-1]
 
         # wait for mouse press
@@ -238,15 +303,21 @@ class TwoAFC:
             # if cat licks into non-valid lickometers, give punishment
             tc = core.Clock()
             # print(f"started! {tc.getTime()}")
-            self.lick_o_meter.set_timeout(timeout)
+            # after the rewards still being delivered
+            configured = self.lick_worker.submit('set_timeout', timeout)
+            try:
+                # set_timeout may reconnect once
+                configured.result(timeout=self.lick_o_meter.reconnect_timeout + 2 * self.lick_o_meter.timeout)
+            except Exception as e:
+                tracer.error('set_timeout({}) failed: {!r}', timeout, e)
             t = time.time()
-            licks = self.lick_o_meter.watch_licks()
+            licks = self.lick_worker.submit('watch_licks').result()
             t = time.time()-t
-            print(f"-----> waited for: {t}s")
+            tracer.debug("-----> waited for: {}s", t)
 
             # Quit if Esc pressed
             if event.getKeys(keyList=["escape"]):
-                print("'ESC' key detected, quit")
+                tracer.info("'ESC' key detected, quit")
                 core.quit()
 
             # Transform licks to resp
@@ -258,13 +329,13 @@ class TwoAFC:
 
             # Return None or resp
             if resp is None:
-                print('no lickometer response (timeout)')
+                tracer.info('no lickometer response (timeout)')
                 return  # there was no lick, timeout
             if resp not in enabled_lickometers:
-                print(f'lickometer acitvated: {resp} but this lickometer was actually disabled!')
+                tracer.info('lickometer acitvated: {} but this lickometer was actually disabled!', resp)
                 return resp  # since it was a lick, return it
             else:
-                print(f'good: {resp}')
+                tracer.info('good: {}', resp)
                 return resp
 
     def is_touched(self, stimuli: dict, m_loc):
@@ -294,17 +365,19 @@ class TwoAFC:
             else:
                 s_contain = [stimuli[k].contains(self.mouse[k]) for k in win_keys]
                 if all(s_contain):
-                    print(f"both stimulus touched, pos: {m_pos}, contains: {s_contain} << {[stimuli[k].contains(self.mouse[k]) for k in win_keys]}")
+                    if tracer.debugging:
+                        tracer.debug("both stimulus touched, pos: {}, contains: {} << {}", m_pos, s_contain,
+                                     [stimuli[k].contains(self.mouse[k]) for k in win_keys])
                     sys.modules['debugmp'] = [m_pos[0], m_pos[1], stimuli.values()]
                     # print(sys.modules['debugmp'])
                     k1 = list(stimuli.keys())[1]
                     [self.mouse[k1].setPos(fix_pos) for k1 in win_keys]
                     s_contain = [stimuli[k1].contains(self.mouse[k1]) for k1 in win_keys]
-                    print(f"  '>s_contain: {s_contain}")
+                    tracer.debug("  '>s_contain: {}", s_contain)
                     return [0, 0]
 
                 if any(s_contain):
-                    print(f"single touch detected: {s_contain}")
+                    tracer.debug("single touch detected: {}", s_contain)
                     m_press = s_contain
                     # move mice out of grating stimuli
                     [self.mouse[k1].setPos(fix_pos) for k1 in win_keys]
@@ -344,15 +417,15 @@ class TwoAFC:
         # TODO: save data as train_jumping
 
         if messages: messages['pre'].draw()
-        [self.win[sk1].flip() for sk1 in self.win.keys() if self.win[sk1] is not None]
+        self.flip()
         core.wait(time_dict['message'])
 
         # keep screens blank until subject licks into lickometer on the stand
         # TODO: after timeout, no need to lick
         entry_response = self.wait_for_lickometer(['up'])
         if not self.lickemu and entry_response == 'up':
-            self.lick_o_meter.reward('up')
-        print(f"licked at {entry_response}, entry response")
+            self.reward('up')
+        tracer.info("licked at {}, entry response", entry_response)
 
         # animal licked into stand-lickometer: show stimulus
         # set orientation of gratings on two screens
@@ -360,15 +433,16 @@ class TwoAFC:
 
         # set duration of motion as the staircase sets the next value
         if messages: messages['trial'].draw()
-        [self.win[sk1].flip() for sk1 in self.win.keys() if self.win[sk1] is not None]
+        self.flip()
         core.wait(time_dict['message'])
         # show moving grating on both screens
         trial_clock.reset()
+        self.frames.start_trial()
         mpress = [0, 0]
         ctime = trial_clock.getTime()
         [self.mouse[k1].getPos() for k1 in self.mouse.keys()]
         mouse_loc = [self.mouse[k1].getPos() for k1 in grating.keys()]
-        print(mouse_loc)
+        tracer.debug('{}', mouse_loc)
         while (ctime < time_dict['jump_timeout']) and not any(mpress):
             for sk in grating.keys():
                 # move grating until specified time then leave last grating phase constant until timeout time
@@ -387,8 +461,10 @@ class TwoAFC:
                     break
 
             ctime = trial_clock.getTime()
-            [self.win[sk1].flip() for sk1 in self.win.keys() if self.win[sk1] is not None]
+            self.flip()
 
+        frame_stats = self.frames.end_trial()
+        tracer.info('Frames: {frames}, dropped: {dropped}, max interval: {max_interval:.4f} s', **frame_stats)
         return mpress, trial_clock.getTime()  # [True False] if first screen chosen
 
     def train_jumping(self, jump_within_s: float, percent_correct_required: int, enter_timeout_s: int = 10, remind_to_target_s: int = 5):
@@ -432,8 +508,8 @@ class TwoAFC:
             Times elapsed between trials
         """
 
-        print("\n\tStarting train_jumping()...")
-        print(f"within: {jump_within_s}\n%: {percent_correct_required}\nenter: {enter_timeout_s}")
+        tracer.info("\n\tStarting train_jumping()...")
+        tracer.info("within: {}\n%: {}\nenter: {}", jump_within_s, percent_correct_required, enter_timeout_s)
 
         # TODO: add self.init_train_jumping_stimulus()
 
@@ -445,11 +521,12 @@ class TwoAFC:
         # define stimuli
         win_keys = [sk1 for sk1 in self.win.keys()]
 
-        gray_stim = {k: visual.GratingStim(self.win[k], sf=0, color=0, colorSpace='rgb', size=self.win[k].size[0],
-                                           name='gray', tex=None) for k in win_keys}
-        grating_stim = {k: visual.GratingStim(self.win[k], sf=self.grating_p['spatial_freq_deg_per_pix'],
-                                              size=self.grating_p['size'][k], pos=self.grating_p['pos'][k],
-                                              mask='gauss', ori=0, name='grating') for k in win_keys}
+        gray_stim = {k: self.visual.GratingStim(self.win[k], sf=0, color=0, colorSpace='rgb', size=self.win[k].size[0],
+                                                name='gray', tex=None) for k in win_keys}
+        grating_stim = {k: self.visual.GratingStim(self.win[k], sf=self.grating_p['spatial_freq_deg_per_pix'],
+                                                   size=self.grating_p['size'][k], pos=self.grating_p['pos'][k],
+                                                   ori=0, name='grating', **textures.stim_kwargs('sin', 'gauss'))
+                        for k in win_keys}
 
         stim_list = [gray_stim, grating_stim]
 
@@ -458,10 +535,10 @@ class TwoAFC:
 
         # draw gray stimulus on both side
         [sv.draw() for sv in gray_stim.values()]
-        [self.win[sk1].flip() for sk1 in win_keys if self.win[sk1] is not None]
+        self.flip()
 
         # deliver small reward to attract attention/lure animal to lickometer
-        self.lick_o_meter.reward('up')
+        self.reward('up')
 
         # jump to striped side (other side is uniform gray) and add reward with 80% contingency, 20% leads to silent omission (no sound, no reward)
         # TODO: if needed add randomness into the process
@@ -475,13 +552,13 @@ class TwoAFC:
         eval_win = 5  # look at the outcomes of the last 5 trials (or any other number set here)
         motion_time = 0.5  # short moving grating to elicit attention
 
-        print(f">>> Train jumping started...")
+        tracer.info(">>> Train jumping started...")
 
         # keep doing trials until N successful trials in the last 5 trials is less than the percent_correct_required
         while len(trial_outcome) < eval_win or sum(trial_outcome[-eval_win:])/eval_win < percent_correct_required/100:
 
             # Entry by licking into 'up' (if not timeout before = (entry_response is not None))
-            print(f"\n>>> Wait for initiating licking... iteration: {len(trial_outcome)-1}.")
+            tracer.info("\n>>> Wait for initiating licking... iteration: {}.", len(trial_outcome)-1)
             entry_times.append([])
             while entry_response is None:
                 entry_response = self.wait_for_lickometer(['up'], timeout=enter_timeout_s)
@@ -489,25 +566,26 @@ class TwoAFC:
                 if not self.lickemu and entry_response == 'up':
                     self.bridge_reward()
                     # TODO: after wrong jump, no reward?
-                    self.lick_o_meter.reward('up')
-                    print(f"licked at {entry_response}, entry response")
+                    self.reward('up')
+                    tracer.info("licked at {}, entry response", entry_response)
 
                 if entry_response is None:
                     self.punish()
-                    print(f"\n PUSH CAT HEAD GENTLY TOWARDS LICKOMETER!\n")
+                    tracer.info("\n PUSH CAT HEAD GENTLY TOWARDS LICKOMETER!\n")
 
                 entry_times[-1].append(trialclock.getTime())
             entry_response = None  # reset so that licking into 'up' lickometer is required in next trial again
 
             trialclock.reset()
+            self.frames.start_trial()
             m_press = [0, 0]  # initialize screen responses
 
             # one screen gray full field, other screen: grating
             [sv.draw() for sv in t_stim.values()]
-            [self.win[sk1].flip() for sk1 in win_keys if self.win[sk1] is not None]  # show phase 0 of moving grating
+            self.flip()  # show phase 0 of moving grating
 
             # wait for touch on screens
-            print(f"\n>>> Training loop, iteration: {len(trial_outcome)-1}.")
+            tracer.info("\n>>> Training loop, iteration: {}.", len(trial_outcome)-1)
             while (trial_time_elapsed < jump_within_s) and not any(m_press):
                 """
                 After no-jump trials we punish, wait 3s and restart next trial without wait_for_lickometer
@@ -526,7 +604,7 @@ class TwoAFC:
                         t_stim[sk].phase = numpy.mod(trialclock.getTime(), 1)
 
                     [sv.draw() for sv in t_stim.values()]
-                    [self.win[sk1].flip() for sk1 in win_keys if self.win[sk1] is not None]
+                    self.flip()
 
                     # read touches
                     m_press = self.is_touched(t_stim, m_loc)
@@ -536,14 +614,17 @@ class TwoAFC:
 
                     trial_time_elapsed = trialclock.getTime()
 
+            frame_stats = self.frames.end_trial()
+            tracer.info('Frames: {frames}, dropped: {dropped}, max interval: {max_interval:.4f} s', **frame_stats)
+
             [sv.draw() for sv in gray_stim.values()]  # after cat jumps or timeout: switch both screens to gray
-            [self.win[sk1].flip() for sk1 in win_keys if self.win[sk1] is not None]
+            self.flip()
 
-            print(f">>> Result:")
+            tracer.info(">>> Result:")
 
             # Evaluation of response
             j_choice = 'left' if m_press[0] else 'right'
-            print(f"j_choice: {j_choice}, t_stim[j_choice].name: {t_stim[j_choice].name}")
+            tracer.debug("j_choice: {}, t_stim[j_choice].name: {}", j_choice, t_stim[j_choice].name)
 
             # add fail trial and punish if timeout, it has to restart from licking into the 'up' lickometer
             if trial_time_elapsed > jump_within_s:
@@ -552,7 +633,7 @@ class TwoAFC:
                 trial_outcome.append(False)
                 trial_times.append(trialclock.getTime())
 
-                print("timeout, you are too slow...")
+                tracer.info("timeout, you are too slow...")
 
                 # in next trial, do not wait for entry response
                 entry_response = ''
@@ -564,7 +645,7 @@ class TwoAFC:
                 trial_outcome.append(False)
                 trial_times.append(trialclock.getTime())
 
-                print(f"bad choice")
+                tracer.info("bad choice")
 
             # add success trial if jumped within time, has to restart from 'up' lickometer
             else:
@@ -573,7 +654,7 @@ class TwoAFC:
                 trial_outcome.append(True)
                 trial_times.append(trialclock.getTime())
 
-                print("good job, level up")
+                tracer.info("good job, level up")
 
                 # active rewarding: reward delivered only if cat licks
                 jump_rew_response = self.wait_for_lickometer([j_choice], timeout=enter_timeout_s)
@@ -587,10 +668,12 @@ class TwoAFC:
             trialclock.reset()
             trial_time_elapsed = trialclock.getTime()
 
-        print(f"Trial successes: {trial_outcome} --> percent correct: {sum(trial_outcome[-eval_win:])/eval_win}\n"
-              f"\t>>> result: {sum(trial_outcome[-eval_win:])/eval_win >= percent_correct_required/100}\n"
-              f"Trial completed (s): {trial_times}\n Trial init times (up lick):{entry_times}")
+        tracer.info("Trial successes: {} --> percent correct: {}\n\t>>> result: {}\n"
+                    "Trial completed (s): {}\n Trial init times (up lick):{}",
+                    trial_outcome, sum(trial_outcome[-eval_win:])/eval_win,
+                    sum(trial_outcome[-eval_win:])/eval_win >= percent_correct_required/100, trial_times, entry_times)
 
+        self.presenter.report()
         return trial_outcome, trial_times, entry_times
 
     def init_output(self, motion):
@@ -628,7 +711,7 @@ class TwoAFC:
         # make a text file to save data
         fileName = expInfo['observer'] + expInfo['dateStr']
         dataFile = open(fileName + '.csv', 'w')  # a simple text file with 'comma-separated-values'
-        dataFile.write('targetOri,jumpedOri,motionTime,correct\n')
+        dataFile.write('targetOri,jumpedOri,motionTime,correct,frames,droppedFrames,maxFrameInterval\n')
 
         return expInfo, dataFile, fileName
 
@@ -666,9 +749,10 @@ class TwoAFC:
         # target is rewarded, alternative is not rewarded
         orientation = {'target': 0, 'alternative': 90}
 
-        grating = {sk1: visual.GratingStim(self.win[sk1], sf=self.grating_p['spatial_freq_deg_per_pix'],
-                                           size=self.grating_p['size'][sk1], pos=self.grating_p['pos'][sk1], mask='gauss',
-                                           ori=orientation[k1],) for k1, sk1 in zip(orientation.keys(), self.win.keys())}
+        grating = {sk1: self.visual.GratingStim(self.win[sk1], sf=self.grating_p['spatial_freq_deg_per_pix'],
+                                                size=self.grating_p['size'][sk1], pos=self.grating_p['pos'][sk1],
+                                                ori=orientation[k1], **textures.stim_kwargs('sin', 'gauss'))
+                   for k1, sk1 in zip(orientation.keys(), self.win.keys())}
 
         if not self.windowed:
             for sk1 in self.win.keys():
@@ -678,12 +762,13 @@ class TwoAFC:
                 size2 = [min_size, min_size]
                 grating[sk1].setSize(size2, units='pix')
 
-        from psychopy.tools.monitorunittools import posToPix
-        ptxt = ' '.join([repr(posToPix(grating[gk1])) for gk1 in grating.keys()])
-        print(f"grating positions {ptxt}")
+        if not self.headless:
+            from psychopy.tools.monitorunittools import posToPix
+            ptxt = ' '.join([repr(posToPix(grating[gk1])) for gk1 in grating.keys()])
+            tracer.debug("grating positions {}", ptxt)
     
-        intertrial = {sk1: visual.GratingStim(self.win[sk1], sf=0, color=0, colorSpace='rgb',
-                                              size=self.win[sk1].size[0], tex=None,) for sk1 in self.win.keys()}
+        intertrial = {sk1: self.visual.GratingStim(self.win[sk1], sf=0, color=0, colorSpace='rgb',
+                                                   size=self.win[sk1].size[0], tex=None,) for sk1 in self.win.keys()}
     
         # and some handy clocks to keep track of time
         trial_clock = core.Clock()
@@ -691,10 +776,10 @@ class TwoAFC:
         # display instructions and wait
         if self.show_messages:
             trialtext = 'Hit left key if you think correct pattern is shown on the left side; right key if correct pattern is on right side.'
-            messages = {'pre': visual.TextStim(self.win['left'], pos=[0, +3],
+            messages = {'pre': self.visual.TextStim(self.win['left'], pos=[0, +3],
                                            text='Hit up arrow key to start trial within 3s, q to abort experiment'),
-                    'trial': visual.TextStim(self.win['left'], pos=[0, +3], text=trialtext),
-                    'post': visual.TextStim(self.win['left'], pos=[0, +3], text='Put back animal to stand')}
+                    'trial': self.visual.TextStim(self.win['left'], pos=[0, +3], text=trialtext),
+                    'post': self.visual.TextStim(self.win['left'], pos=[0, +3], text='Put back animal to stand')}
         else:
             messages = None
     
@@ -718,7 +803,7 @@ class TwoAFC:
         for thisIncrement in staircase:
             # Show stimulus and let subject make a choice (mouse/touch screen response)
             time_dict['motion'] = thisIncrement
-            print(f"--------\ntrial {len(staircase.data)}, motion time: {thisIncrement}, staircase trial {staircase.thisTrialN} reversals {len(staircase.reversalIntensities)}")
+            tracer.info("--------\ntrial {}, motion time: {}, staircase trial {} reversals {}", len(staircase.data), thisIncrement, staircase.thisTrialN, len(staircase.reversalIntensities))
 
             result = None  # initialize to non-defined so that staircase is updated only after checking all possible outcomes
 
@@ -734,11 +819,11 @@ class TwoAFC:
                 core.wait(1)
                 continue
     
-            print(f"mouse clicked {mouse_choice}")
+            tracer.info("mouse clicked {}", mouse_choice)
 
             # remove patterns from screen upon jump
             [i1.draw() for i1 in intertrial.values()]
-            [w.flip() for w in self.win.values()]
+            self.flip()
             jump_choice = 'left' if mouse_choice[0] else 'right'
 
             # Provide bridge reward for correct mouse click/touchscreen choice
@@ -746,11 +831,11 @@ class TwoAFC:
                 # if wrong choice, no need to wait for lickometer
                 self.punish()
                 result = 0
-                print(f'\t>>> jumped on wrong side, mouse_clicked --> jump_choice = {mouse_choice} --> {jump_choice}')
+                tracer.info('\t>>> jumped on wrong side, mouse_clicked --> jump_choice = {} --> {}', mouse_choice, jump_choice)
             else: # jumped to correct side
                 self.bridge_reward()
                 lick_choice = self.wait_for_lickometer([jump_choice], time_dict['lick_timeout'])  # now has to lick at same side
-                print(f"licked at {lick_choice} while {jump_choice} was enabled")
+                tracer.info("licked at {} while {} was enabled", lick_choice, jump_choice)
     
                 # evaluate lick response
                 if lick_choice is not None:
@@ -778,15 +863,17 @@ class TwoAFC:
                     if messages: messages['post'].text = f"Correct choice but no lick. No need for food? Hit any key or q to exit"
     
             staircase.addResponse(result)
-            dataFile.write(f"{orientation['target']},{grating[jump_choice].ori},{thisIncrement},{grating[jump_choice].ori == orientation['target']}\n")
-            print(f"left:{grating['left'].ori} right:{grating['right'].ori}")
+            frame_stats = self.frames.trials[-1]
+            dataFile.write(f"{orientation['target']},{grating[jump_choice].ori},{thisIncrement},{grating[jump_choice].ori == orientation['target']},"
+                           f"{frame_stats['frames']},{frame_stats['dropped']},{frame_stats['max_interval']:.5f}\n")
+            tracer.info("left:{} right:{}", grating['left'].ori, grating['right'].ori)
             # blank screen
             [intertrial[sk1].draw() for sk1 in intertrial]
             if messages: messages['post'].draw()
-            [w.flip() for w in self.win.values()]
+            self.flip()
             allKeys = event.waitKeys(maxWait=time_dict['message'])
             if allKeys is not None and 'q' in allKeys:
-                print('user abort')
+                tracer.info('user abort')
                 core.quit()  # manual abort experiment
             event.clearEvents()  # clear other (e.g. mouse) events - they clog the buffer
     
@@ -795,17 +882,19 @@ class TwoAFC:
         staircase.saveAsPickle(fileName)  # special python binary file to save all the info
     
         # give some output to user in the command line in the output window
-        print('reversals:')
-        print(staircase.reversalIntensities)
+        tracer.info('reversals:')
+        tracer.info('{}', staircase.reversalIntensities)
         approxThreshold = numpy.average(staircase.reversalIntensities[-6:])
-        print('mean of final reversals = %.3f' % (approxThreshold))
+        tracer.info('mean of final reversals = {:.3f}', approxThreshold)
     
         # give some on-screen feedback
-        feedback1 = visual.TextStim(self.win['left'], pos=[0,+3], text='mean of final 6 reversals = %.3f' % (approxThreshold))
+        feedback1 = self.visual.TextStim(self.win['left'], pos=[0,+3], text='mean of final 6 reversals = %.3f' % (approxThreshold))
     
         feedback1.draw()
     
-        self.win['left'].flip()
+        # through the presenter: the windows do not wait for the vertical blank themselves (waitBlanking=False)
+        self.flip()
+        self.presenter.report()
         core.wait(1)
         [w.close() for w in self.win.values()]
         core.quit()
@@ -864,6 +953,7 @@ if __name__ == '__main__':
         epilog='written by D Hillier, G Schliszka (c) 2022-2023')
     parser.add_argument('--lickometer','-L', help='Use lickometers', action='store_false')
     parser.add_argument('--windowed', '-W', help='Show stimulus in smaller window, not full screen.', action='store_true')
+    parser.add_argument('--headless', help='Render the stimuli offscreen with NumPy (no display needed).', action='store_true')
     args = parser.parse_args()
     lickemu = not args.lickometer #not args.lickometer
     # teaching task:
@@ -871,7 +961,8 @@ if __name__ == '__main__':
     train_basic_task = False
     n_down = 6 if train_basic_task else 3
     n_up = 2 if train_basic_task else 1
-    experiment = TwoAFC(lickemu=lickemu, touchscreen=True, show_messages=False, windowed=args.windowed)
+    experiment = TwoAFC(lickemu=lickemu, touchscreen=True, show_messages=False, windowed=args.windowed,
+                        headless=args.headless)
     stair_params = {'up_steps': n_up, 'down_steps': n_down}
 
     experiment.train_jumping(jump_within_s=3, percent_correct_required=80, enter_timeout_s=3)
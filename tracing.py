@@ -0,0 +1,164 @@
+"""
+Low-overhead structured tracing for the experiment and Lickometer code.
+
+A trace call only appends a record (time, level, source, message template and its arguments) to an in-memory buffer,
+the message is formatted and written by a background thread. Calls below the level of the tracer return immediately,
+hot paths check the level flags (e.g. tracer.debugging) before building the arguments:
+
+    from tracing import tracer
+
+    tracer.info('Waiting for lick for {} seconds', timeout)
+    if tracer.debugging: tracer.debug('Lickometer.set_size({}, {})', pump_result, size_result, source='lickometer')
+
+The records can also be written as JSON lines (tracer.open_log(path)) for offline analysis, and as the text lines of
+the former logging output (tracer.open_text_log(path)).
+"""
+
+import atexit
+import json
+import sys
+import threading
+import time
+from collections import deque
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+
+
+class Tracer:
+    def __init__(self, level=INFO, stream=sys.stdout, capacity=100000, interval=0.05):
+        """
+        Parameters
+        ----------
+        level : int, optional
+            Records below this level are dropped at the call site.
+        stream : file, optional
+            Formatted output of the records, None: no console output.
+        capacity : int, optional
+            Records kept in the buffer, the oldest ones are dropped if the writer thread falls behind.
+        interval : float, optional
+            Seconds between two drains of the buffer by the writer thread.
+        """
+        self.stream = stream
+        self.interval = interval
+        self.buffer = deque(maxlen=capacity)  # append & popleft are thread-safe
+        self.log = None
+        self.text_log = None
+        self.t0 = time.perf_counter_ns()
+        self.wall0 = time.time()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self.set_level(level)
+
+    def set_level(self, level: int):
+        self.level = level
+        # flags checked by the hot paths
+        self.debugging = level <= DEBUG
+        self.informing = level <= INFO
+
+    def open_log(self, path: str):
+        """
+        Also write every record as a JSON line into path.
+        """
+        self.flush()
+        self.log = open(path, 'a')
+
+    def open_text_log(self, path: str):
+        """
+        Also write every record as a text line '<asctime> : <message>' into path, the format of the logging output
+        (logging.basicConfig(format="%(asctime)s : %(message)s")) the session logs were written with.
+        """
+        self.flush()
+        self.text_log = open(path, 'a')
+
+    def trace(self, level: int, message: str, *args, source=None, **fields):
+        """
+        Record a message, formatted later as message.format(*args, **fields).
+
+        Parameters
+        ----------
+        level : int
+        message : str
+            str.format template.
+        args, fields :
+            Values of the template, fields are also kept by name in the JSON log.
+        source : str, optional
+            Module or device emitting the record.
+        """
+        if level < self.level:
+            return
+        self.buffer.append((time.perf_counter_ns(), level, source, message, args, fields))
+        if self._thread is None:
+            self._start()
+
+    def debug(self, message, *args, **fields):
+        if self.debugging:
+            self.trace(DEBUG, message, *args, **fields)
+
+    def info(self, message, *args, **fields):
+        if self.informing:
+            self.trace(INFO, message, *args, **fields)
+
+    def warning(self, message, *args, **fields):
+        self.trace(WARNING, message, *args, **fields)
+
+    def error(self, message, *args, **fields):
+        self.trace(ERROR, message, *args, **fields)
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='Tracer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """
+        Format and write the buffered records (called by the writer thread, and at exit).
+        """
+        with self._lock:
+            while self.buffer:
+                t, level, source, message, args, fields = self.buffer.popleft()
+                try:
+                    text = message.format(*args, **fields) if args or fields else message
+                except (IndexError, KeyError, ValueError) as e:
+                    text = f'{message} {args} {fields} (format error: {e})'
+                if self.stream is not None:
+                    prefix = '' if level == INFO else f'{LEVEL_NAMES.get(level, level)}: '
+                    self.stream.write(f'{prefix}{text}\n')
+                if self.log is not None:
+                    self.log.write(json.dumps({'t': (t - self.t0) / 1e9, 'level': LEVEL_NAMES.get(level, level),
+                                               'source': source, 'message': text,
+                                               **{k: _jsonable(v) for k, v in fields.items()}}) + '\n')
+                if self.text_log is not None:
+                    self.text_log.write(f'{_asctime(self.wall0 + (t - self.t0) / 1e9)} : {text}\n')
+            if self.stream is not None:
+                self.stream.flush()
+            if self.log is not None:
+                self.log.flush()
+            if self.text_log is not None:
+                self.text_log.flush()
+
+
+def _asctime(wall):
+    # asctime of the logging records, e.g. 2023-02-20 14:03:12,345
+    return f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(wall))},{int(wall % 1 * 1000):03d}"
+
+
+def _jsonable(value):
+    return value if isinstance(value, (bool, int, float, str, type(None))) else repr(value)
+
+
+# Tracer shared by the modules of the project
+tracer = Tracer()
+atexit.register(tracer.flush)
@@ -0,0 +1,206 @@
+"""
+Byte transports of the Lickometer protocol.
+
+Protocol talks to the Lickometer through an object with the part of the serial.Serial interface it uses (port, read,
+in_waiting, write, close), so besides pyserial (serial ports and ptys) it runs over sockets:
+
+    Lickometer(port='tcp://rig-bridge.local:5555')     # Lickometer served by a bridge next to the rig
+    Lickometer(port='unix:///tmp/lickometer.sock')
+    Lickometer(transport=SocketTransport(sock))         # e.g. one end of socket.socketpair() in tests
+
+Reads are bulk (everything available, up to read_size bytes per system call) and every write is sent with a single
+system call; Nagle's algorithm is disabled on TCP so the small orders are not delayed.
+
+Run this module next to the rig to serve the Arduino over TCP:
+
+    python transports.py --serial /dev/ttyACM0 --listen 0.0.0.0:5555
+"""
+
+import fcntl
+import select
+import socket
+import struct
+import termios
+import threading
+
+import serial
+
+
+class SocketTransport:
+    """
+    Connected stream socket with the serial.Serial interface used by Protocol.
+    """
+
+    def __init__(self, sock, port=None, timeout=1, read_size=4096):
+        """
+        Parameters
+        ----------
+        sock : socket.socket
+            Connected stream socket (TCP, Unix or one end of socket.socketpair()).
+        port : str, optional
+            Name of the transport (Default: address of the peer).
+        timeout : float, optional
+            Seconds a read waits for data, None waits forever.
+        read_size : int, optional
+            Maximum bytes returned by one read.
+        """
+        self.sock = sock
+        self.port = port or str(sock.getpeername() or sock.getsockname())
+        self.timeout = timeout
+        self.read_size = read_size
+        self.is_open = True
+        if sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    @property
+    def in_waiting(self):
+        """
+        :return: (int) bytes received and not read yet
+        """
+        try:
+            return struct.unpack('i', fcntl.ioctl(self.sock.fileno(), termios.FIONREAD, b'\0\0\0\0'))[0]
+        except OSError:
+            return 0
+
+    def read(self, size=1):
+        """
+        Wait up to timeout for data and return all the available bytes (at least one and up to max(size, read_size)),
+        b'' on timeout.
+        """
+        if not self.is_open:
+            raise serial.SerialException(f'{self.port} is closed')
+        try:
+            if not select.select([self.sock], [], [], self.timeout)[0]:
+                return b''
+            data = self.sock.recv(max(size, self.read_size))
+        except (OSError, ValueError) as e:
+            # ValueError: socket closed by another thread
+            raise serial.SerialException(f'{self.port}: {e}') from e
+        if not data:
+            raise serial.SerialException(f'{self.port}: connection closed by the peer')
+        return data
+
+    def write(self, data):
+        """
+        Send data with a single system call (the socket is blocking).
+        """
+        self.sock.sendall(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        while select.select([self.sock], [], [], 0)[0]:
+            if not self.sock.recv(self.read_size):
+                break
+
+    def close(self):
+        if self.is_open:
+            self.is_open = False
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+
+    @classmethod
+    def pair(cls, timeout=1):
+        """
+        :return: (SocketTransport, socket.socket) connected transport and its peer, e.g. for an emulated Lickometer
+        """
+        a, b = socket.socketpair()
+        return cls(a, port='socketpair', timeout=timeout), b
+
+
+def open_transport(url, rate=19200, timeout=1):
+    """
+    Open the transport of a Lickometer.
+
+    Parameters
+    ----------
+    url : str
+        'tcp://host:port', 'unix:///path/of/socket' or a serial port (e.g. '/dev/ttyACM0', 'COM3', a pty).
+    rate : int, optional
+        Baud rate of a serial port.
+    timeout : float, optional
+        Seconds a read waits for data.
+
+    Returns
+    -------
+    serial.Serial or SocketTransport
+    """
+    try:
+        if url.startswith('tcp://'):
+            host, port = url[len('tcp://'):].rsplit(':', 1)
+            sock = socket.create_connection((host.strip('[]'), int(port)), timeout=timeout)
+            sock.settimeout(None)
+            return SocketTransport(sock, port=url, timeout=timeout)
+        if url.startswith('unix://'):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(url[len('unix://'):])
+            return SocketTransport(sock, port=url, timeout=timeout)
+    except OSError as e:
+        raise serial.SerialException(f'Could not open {url}: {e}') from e
+    return serial.Serial(url, rate, timeout=timeout)
+
+
+def _forward(source, destination, stop):
+    while not stop.is_set():
+        try:
+            data = source.read(4096)
+        except (serial.SerialException, OSError):
+            break
+        if data:
+            try:
+                destination.write(data)
+            except (serial.SerialException, OSError):
+                break
+    stop.set()
+
+
+def serve_bridge(serial_port, host='0.0.0.0', port=5555, rate=19200):
+    """
+    Serve the Arduino on serial_port to one TCP client at a time. The serial port is opened when a client connects
+    (the Arduino restarts and sends its banner, like when the port is opened locally).
+    """
+    server = socket.create_server((host, port))
+    print(f'Serving {serial_port} on tcp://{host}:{port}')
+    while True:
+        sock, address = server.accept()
+        print(f'Client {address} connected')
+        client = SocketTransport(sock, timeout=0.1)
+        arduino = serial.Serial(serial_port, rate, timeout=0.01)
+        stop = threading.Event()
+        # reads are bulk: everything the Arduino sent since the last read
+        to_client = threading.Thread(target=_forward, args=(_BulkSerial(arduino), client, stop), daemon=True)
+        to_client.start()
+        _forward(client, arduino, stop)
+        to_client.join()
+        arduino.close()
+        client.close()
+        print(f'Client {address} disconnected')
+
+
+class _BulkSerial:
+    def __init__(self, port):
+        self.port = port
+
+    def read(self, size):
+        return self.port.read(max(1, self.port.in_waiting))
+
+    def write(self, data):
+        return self.port.write(data)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='LickometerBridge', description='Serve a Lickometer over TCP')
+    parser.add_argument('--serial', '-s', required=True, help='Serial port of the Lickometer')
+    parser.add_argument('--listen', '-l', default='0.0.0.0:5555', help='host:port to listen on')
+    parser.add_argument('--rate', type=int, default=19200)
+    args = parser.parse_args()
+
+    listen_host, listen_port = args.listen.rsplit(':', 1)
+    serve_bridge(args.serial, listen_host, int(listen_port), args.rate)
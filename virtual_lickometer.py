@@ -0,0 +1,384 @@
+"""
+Software emulation of the Lickometer firmware on a Linux pseudo-terminal.
+
+The host classes of lickometer.py connect to it like to the Arduino, by passing its port explicitly:
+
+    with VirtualLickometer(licks=['010', '100'], latency=0.002) as device:
+        lick_o_meter = Lickometer(port=device.port)
+
+Like the Arduino, the emulator restarts and sends its version & initial values banner whenever the host opens the port.
+"""
+
+import fcntl
+import os
+import pty
+import random
+import select
+import struct
+import termios
+import threading
+import time
+import tty
+
+import numpy
+
+from lickometer import Protocol, SAMPLE_DTYPE, STREAM_END
+
+
+class _Reset(Exception):
+    """ The host (re)opened the port. """
+
+
+class VirtualLickometer:
+    Order = Protocol.Order
+
+    version = 'Lickometer JumpStand version: v1.0:2022-11-24 (virtual)'
+
+    def __init__(self, latency=0.0, licks='100', lick_delay=0.0, drop_rate=0.0, corrupt_rate=0.0, sampling=2000,
+                 lick_threshold=2.5, speed=200, reward=500, seed=None, signal=None, persistent=False,
+                 clock_drift_ppm=0.0):
+        """
+        Parameters
+        ----------
+        latency : float, optional
+            Seconds waited before every reply (USB + firmware processing time).
+        licks : str, list or callable, optional
+            Result of each WFL order ('abc' a: up, b: left, c: right, e.g. '010'). A list is cycled through and a
+            callable is called with the index of the WFL order. (Default: '100', immediate lick into 'up')
+        lick_delay : float, optional
+            Seconds between the WFL order and the lick. If longer than the timeout set by SET_TIMEOUT, '000' is sent
+            when the timeout expires.
+        drop_rate : float, optional
+            Probability of not sending a reply at all.
+        corrupt_rate : float, optional
+            Probability of replying INVALID_ORDER instead of the expected reply.
+        sampling, lick_threshold, speed, reward : optional
+            Initial values reported in the banner.
+        seed : int, optional
+            Seed of the failure injection.
+        signal : callable, optional
+            Raw sensor values streamed in STREAM state: signal(sample_indices) --> (up, left, right) arrays.
+            (Default: lick_signal, 7 Hz licking into 'up' for 1 s every 4 s)
+        persistent : bool, optional
+            Keep the configuration set by the SET_* and CALIBRATE orders when the host reopens the port, like a
+            firmware storing it in EEPROM.
+        clock_drift_ppm : float, optional
+            How much faster the emulated micros() clock runs than the host clock (parts per million).
+        """
+
+        self.latency = latency
+        self.licks = licks
+        self.lick_delay = lick_delay
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self.initial_values = (f'Lickometer_sampling: {sampling} LickFreq_threshold: {lick_threshold:.2f} '
+                               f'Speed: {speed} Reward: {reward}')
+        self.random = random.Random(seed)
+        self.sampling = sampling
+        self.signal = signal if signal is not None else lick_signal(sampling)
+        self.persistent = persistent
+        self.clock_drift_ppm = clock_drift_ppm
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        # packet mode: the master is notified when the host flushes the port on opening it
+        fcntl.ioctl(self.master, termios.TIOCPKT, struct.pack('i', 1))
+        self.port = os.ttyname(self.slave)
+
+        self.received = bytearray()
+        self.n_resets = 0
+        self.orders = []
+        self._buffer = bytearray()
+        self._wfl_count = 0
+        self._running = False
+        self._thread = None
+        self.reset()
+
+    def reset(self):
+        """
+        Restore the firmware state set by the SET_* and CALIBRATE orders (kept if persistent).
+        """
+        if not (self.persistent and self.n_resets):
+            pumps = ['up', 'left', 'right']
+            self.size = {p: 1 for p in pumps}
+            self.calibration = {p: (500, 200) for p in pumps}  # (motor_time ms, motor_speed)
+            self.wash_speed = {p: 200 for p in pumps}
+            self.timeout = 0
+        self.side = None
+        self.rewards = []
+        self.streaming = False
+        self._clock_start = time.perf_counter()  # micros() restarts with the firmware
+        self._stream_start = 0
+        self._stream_index = 0
+        self._buffer.clear()
+
+    # ---- thread ----
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=f'VirtualLickometer({self.port})', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _run(self):
+        while self._running:
+            try:
+                if self.streaming:
+                    self.stream_samples()
+                order = self.read_i8(wait=False)
+                if order is not None:
+                    self.handle(order)
+            except _Reset:
+                if not self._running:
+                    break
+                self.n_resets += 1
+                self.reset()
+                self.send(f'{self.version}\r\n{self.initial_values}\r\n'.encode())
+
+    # ---- byte level I/O ----
+
+    def _receive(self, timeout):
+        if not select.select([self.master], [], [], timeout)[0]:
+            return
+        packet = os.read(self.master, 1024)
+        if packet[0] == termios.TIOCPKT_DATA:
+            self._buffer += packet[1:]
+            self.received += packet[1:]
+        elif packet[0] & termios.TIOCPKT_FLUSHREAD:
+            raise _Reset()
+
+    def _read(self, size, wait=True):
+        while len(self._buffer) < size:
+            if not self._running:
+                raise _Reset()
+            self._receive(0.002 if self.streaming else 0.05)
+            if not wait and not self._buffer:
+                return None
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def read_i8(self, wait=True):
+        data = self._read(1, wait)
+        return None if data is None else struct.unpack('<b', data)[0]
+
+    def read_i16(self):
+        return struct.unpack('<h', self._read(2))[0]
+
+    def read_i32(self):
+        return struct.unpack('<l', self._read(4))[0]
+
+    def send(self, data):
+        os.write(self.master, data)
+
+    def reply(self, data, latency=None):
+        """
+        Send a reply with the configured latency (or the given one) and failure injection.
+        """
+        latency = self.latency if latency is None else latency
+        if latency:
+            time.sleep(latency)
+        if self.drop_rate and self.random.random() < self.drop_rate:
+            return
+        if self.corrupt_rate and self.random.random() < self.corrupt_rate:
+            data = struct.pack('<b', self.Order.INVALID_ORDER.value)
+        self.send(data)
+
+    def reply_i8(self, value):
+        self.reply(struct.pack('<b', value))
+
+    def reply_i16(self, value):
+        self.reply(struct.pack('<h', value))
+
+    def reply_i32(self, value):
+        self.reply(struct.pack('<l', value))
+
+    # ---- firmware ----
+
+    def _pumps(self, pump):
+        if pump == self.Order.ALL.value:
+            return list(self.size.keys())
+        try:
+            return [self.Order(pump).name.lower()]
+        except ValueError:
+            return []
+
+    def handle(self, order):
+        try:
+            order = self.Order(order)
+        except ValueError:
+            self.reply_i8(self.Order.INVALID_ORDER.value)
+            return
+        self.orders.append(order)
+        handler = getattr(self, f'on_{order.name.lower()}', None)
+        if handler is None:
+            self.reply_i8(self.Order.INVALID_ORDER.value)
+        else:
+            handler()
+
+    def on_set_size(self):
+        self.reply_i8(self.Order.SET_SIZE.value)
+        pump = self.read_i8()
+        self.reply_i8(pump)
+        size = self.read_i16()
+        for p in self._pumps(pump):
+            self.size[p] = size
+        self.reply_i16(size)
+
+    def on_set_washspeed(self):
+        self.reply_i8(self.Order.SET_WASHSPEED.value)
+        pump = self.read_i8()
+        self.reply_i8(pump)
+        speed = self.read_i16()
+        for p in self._pumps(pump):
+            self.wash_speed[p] = speed
+        self.reply_i16(speed)
+
+    def on_calibrate(self):
+        self.reply_i8(self.Order.CALIBRATE.value)
+        pump = self.read_i8()
+        self.reply_i8(pump)
+        motor_time = self.read_i32()
+        self.reply_i32(motor_time)
+        motor_speed = self.read_i16()
+        for p in self._pumps(pump):
+            self.calibration[p] = (motor_time, motor_speed)
+        self.reply_i16(motor_speed)
+
+    def on_set_timeout(self):
+        self.reply_i8(self.Order.SET_TIMEOUT.value)
+        self.timeout = self.read_i32()
+        self.reply_i32(self.timeout)
+        # finite timeout?
+        self.reply_i8(self.Order.DONE.value if self.timeout > 0 else self.Order.NONE.value)
+
+    def on_set_side(self):
+        self.reply_i8(self.Order.SET_SIDE.value)
+        side = self.read_i8()
+        self.reply_i8(side)
+        self.side = self._pumps(side)[0] if self._pumps(side) else None
+        self.reply_i8(self.Order.DONE.value)
+
+    def next_licks(self):
+        if callable(self.licks):
+            licks = self.licks(self._wfl_count)
+        elif isinstance(self.licks, str):
+            licks = self.licks
+        else:
+            licks = self.licks[self._wfl_count % len(self.licks)]
+        self._wfl_count += 1
+        return licks
+
+    def on_wfl(self):
+        self.reply_i8(self.Order.WFL.value)
+        licks = self.next_licks()
+        delay = self.lick_delay
+        if self.timeout > 0 and delay > self.timeout / 1000:
+            delay = self.timeout / 1000
+            licks = '000'
+        time.sleep(delay)
+        self.reply_i8(int(licks))
+
+    def on_rew(self):
+        self.reply_i8(self.Order.REW.value)
+        self.rewards.append((self.side, self.size.get(self.side)))
+        self.reply_i8(self.Order.DONE.value)
+
+    def on_rew_side_size(self):
+        side = self.read_i8()
+        size = self.read_i16()
+        self.side = self._pumps(side)[0] if self._pumps(side) else None
+        if self.side is not None:
+            self.size[self.side] = size
+        self.rewards.append((self.side, size))
+        self.reply_i8(self.Order.DONE.value)
+
+    def on_stream(self):
+        # while streaming the stream itself is the reply, STREAM is not echoed
+        if not self.streaming:
+            self.reply_i8(self.Order.STREAM.value)
+        on = self.read_i16()
+        if on:
+            self.reply_i16(on)
+            self._stream_start = time.perf_counter()
+            self._stream_index = 0
+            self.streaming = True
+        else:
+            self.streaming = False
+            end = numpy.zeros(1, dtype=SAMPLE_DTYPE)
+            end['index'] = STREAM_END
+            self.send(end.tobytes())
+
+    def stream_samples(self):
+        """
+        Send the samples due since the start of streaming.
+        """
+        due = int((time.perf_counter() - self._stream_start) * self.sampling)
+        if due <= self._stream_index:
+            return
+        index = numpy.arange(self._stream_index, due, dtype=numpy.int64)
+        samples = numpy.empty(len(index), dtype=SAMPLE_DTYPE)
+        samples['index'] = index % STREAM_END
+        samples['up'], samples['left'], samples['right'] = self.signal(index)
+        self.send(samples.tobytes())
+        self._stream_index = due
+
+    def micros(self):
+        """
+        :return: (int) emulated device clock in us, int32 wrapping around like the Arduino's micros()
+        """
+        ticks = int((time.perf_counter() - self._clock_start) * 1e6 * (1 + self.clock_drift_ppm / 1e6)) & 0xFFFFFFFF
+        return ticks - (1 << 32) if ticks >= 1 << 31 else ticks
+
+    def on_ping(self):
+        # symmetric transit: the clock is read halfway through the latency
+        time.sleep(self.latency / 2)
+        self.reply(struct.pack('<bhl', self.Order.PING.value, 0, self.micros()), self.latency / 2)
+
+    def on_nor(self):
+        self.reply(b'NOR\r\n')
+
+
+def lick_signal(sampling=2000, lick_rate=7, lick_duration=0.04, bout_period=4, bout_duration=1, noise=20, seed=None):
+    """
+    Synthetic raw sensor signal: baseline noise with licking (contacts of lick_duration at lick_rate) into 'up'
+    for bout_duration at the start of every bout_period.
+
+    Returns
+    -------
+    callable: signal(sample_indices) --> (up, left, right) int16 arrays
+    """
+    rng = numpy.random.default_rng(seed)
+
+    def signal(index):
+        t = index / sampling
+        n = len(index)
+        up, left, right = (rng.normal(100, noise, n) for _ in range(3))
+        licking = (t % bout_period < bout_duration) & (t % (1 / lick_rate) < lick_duration)
+        up[licking] += 800
+        return up.astype(numpy.int16), left.astype(numpy.int16), right.astype(numpy.int16)
+
+    return signal
+
+
+if __name__ == '__main__':
+    with VirtualLickometer(licks=['100', '010', '001'], lick_delay=0.5) as device:
+        print(f'Virtual Lickometer running on {device.port}, Ctrl+C to stop')
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
@@ -155,6 +155,8 @@ def vis_stim_experiment_master(stim_type: str, stim_params: dict, experiment_par
                 print("Waiting")
                 time.sleep(0.5)
 
+    stim.presenter.report()  # inter-screen skew of the session
+
     # Saving psychopy log to combined hdf5 output file
     logging.flush()  # To make sure that everything is written to the log file
 
@@ -284,6 +286,8 @@ def one_block_vis_stim_experiment(stim_type: str, stim_params: dict, experiment_
 
             trial_index += 1
 
+    stim.presenter.report()  # inter-screen skew of the session
+
     # Saving psychopy log to combined hdf5 output file
     logging.flush()  # To make sure that everything is written to the log file
 
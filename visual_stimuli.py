@@ -2,13 +2,22 @@ import serial
 from math import sqrt, ceil
 from psychopy.tools import monitorunittools
 from psychopy import monitors, visual, core, event, sound
-from monitors import mymonitors
+from monitors import mymonitors, monitor_calibration
 
 
 import os
 import time
-import logging
-import pyautogui
+from collections import deque
+try:
+    import pyautogui
+except Exception:  # needs a display
+    pyautogui = None
+
+from frame_timing import FrameRecorder
+from gratings import textures
+import headless
+from presenter import DualPresenter
+from tracing import tracer
 
 
 class VisualStimulator:
@@ -26,6 +35,9 @@ class VisualStimulator:
         if port is not None:
             self.port = serial.Serial(port=port, baudrate=9600, timeout=3000)
         self.endExpNow = False  # flag for 'escape' or other condition => quit the exp
+        # headless: offscreen NumPy windows and stimuli instead of psychopy (see headless.py)
+        self.headless = self.params.get('headless', False)
+        self.visual = headless if self.headless else visual
 
         # Set up the psychopy monitor
         self.mon = monitors.Monitor(self.params['monitor'], distance=self.params['distance'],
@@ -33,19 +45,24 @@ class VisualStimulator:
                                     currentCalib={'sizePix': mymonitors[self.params['monitor']]['resolution']})
 
         # Set up the psychopy window
-        self.win = visual.Window(size=mymonitors[self.params['monitor']]['resolution'],
-                                 fullscr=True, screen=1, allowGUI=False, allowStencil=False,
-                                 monitor=self.mon, color=self.params['color_bg'], colorSpace='rgb',
-                                 blendMode='avg', useFBO=True)
-
-        # store frame rate of monitor
-        self.params['framerate'] = self.win.getActualFrameRate(nMaxFrames=500)
-        if self.params['framerate'] is not None:
-            self.frameDur = 1.0 / round(self.params['framerate'])
+        self.win = self.visual.Window(size=mymonitors[self.params['monitor']]['resolution'],
+                                      fullscr=True, screen=1, allowGUI=False, allowStencil=False,
+                                      monitor=self.mon, color=self.params['color_bg'], colorSpace='rgb',
+                                      blendMode='avg', useFBO=True)
+
+        # store frame rate of monitor (measured once per monitor, resolution and screen, then cached)
+        if self.headless:
+            self.calibration = None  # no display to measure
+        else:
+            self.calibration = monitor_calibration(self.win, self.mon, self.params['monitor'], screen=1,
+                                                   remeasure=self.params.get('remeasure_monitor', False))
+        if self.calibration is not None:
+            self.params['framerate'] = self.calibration['framerate']
+            self.frameDur = self.calibration['frame_dur']
         else:
             self.frameDur = 1.0 / 60.0  # couldn't get a reliable measure so set standard 60 Hz
             self.params['framerate'] = 60
-        print(f"Window framerate set to: {self.params['framerate']}")
+        tracer.info('Window framerate set to: {}', self.params['framerate'])
 
         """try:
             self.labjack = U3Wrap()
@@ -64,9 +81,53 @@ class VisualStimulator:
 
         val = self.port.read(2)
         val = int.from_bytes(val, byteorder='little')
-        print(f"Serial message: {val}")
+        tracer.info('Serial message: {}', val)
 
             
+class TrialState:
+    """
+    State machine of a trial, ticked once per frame.
+
+    Input events (e.g. key presses, touches) are queued by post() and handed to the handler of the current state at
+    the next tick(). A handler returns the next state (or None to stay), every transition is timestamped.
+    """
+
+    def __init__(self, handlers: dict, state, final=None):
+        """
+        Parameters
+        ----------
+        handlers : dict
+            {state: handler(inputs)}, inputs is the list of (kind, value) events queued since the last tick.
+        state :
+            Initial state.
+        final : optional
+            The machine is finished once the handler of this state ran.
+        """
+        self.handlers = handlers
+        self.state = state
+        self.final = final
+        self.finished = False
+        self.inputs = deque()
+        self.transitions = []  # (core.getTime(), input time or None, from state, to state)
+
+    def post(self, kind: str, value, t: float = None):
+        self.inputs.append((kind, value, t))
+
+    def tick(self):
+        inputs = []
+        while self.inputs:
+            inputs.append(self.inputs.popleft())
+        state = self.state
+        next_state = self.handlers[state]([(kind, value) for kind, value, _ in inputs])
+        if state == self.final:
+            self.finished = True
+        elif next_state is not None and next_state != state:
+            input_time = inputs[-1][2] if inputs else None
+            self.transitions.append((core.getTime(), input_time, state, next_state))
+            tracer.debug('State: {} --> {}', state, next_state, input_time=input_time)
+            self.state = next_state
+
+
 class StaticGratingDual(VisualStimulator):
     def __init__(self, params: dict, stat_params: dict, port: str = None):
         super(StaticGratingDual, self).__init__(params, port)
@@ -90,59 +151,100 @@ class StaticGratingDual(VisualStimulator):
                                      currentCalib={'sizePix': mymonitors[self.params['monitor2']]['resolution']})
 
         # Set up the 2nd psychopy window
-        self.win2 = visual.Window(size=mymonitors[self.params['monitor2']]['resolution'],
-                                  fullscr=True, screen=2, allowGUI=False, allowStencil=False,
-                                  monitor=self.mon2, color=self.params['color_bg'], colorSpace='rgb',
-                                  blendMode='avg', useFBO=True)      # screen: set to 2 if 3 monitors used
+        self.win2 = self.visual.Window(size=mymonitors[self.params['monitor2']]['resolution'],
+                                       fullscr=True, screen=2, allowGUI=False, allowStencil=False,
+                                       monitor=self.mon2, color=self.params['color_bg'], colorSpace='rgb',
+                                       blendMode='avg', useFBO=True)      # screen: set to 2 if 3 monitors used
 
         # Make win object clear
         self.win_l = self.win2
         self.win_r = self.win
 
+        # flip timestamps of both windows, dropped frames per trial
+        self.frames = FrameRecorder(self.frameDur, ['left', 'right'])
+        # both screens swap at the same vertical blank
+        self.presenter = DualPresenter({'left': self.win_l, 'right': self.win_r}, self.frames)
+
         # Set up mouse and mouse2
-        self.mouse_l = event.Mouse(win=self.win_l)  # old: self.mouse2
-        self.mouse_r = event.Mouse(win=self.win_r)  # old: self.mouse
+        Mouse = headless.Mouse if self.headless else event.Mouse
+        self.mouse_l = Mouse(win=self.win_l)  # old: self.mouse2
+        self.mouse_r = Mouse(win=self.win_r)  # old: self.mouse
 
         self.states = self.params['orders']
 
         # Calculating size of monitor in visual degrees, so stimulation covers it completely
         diagonal_in_pix = sqrt(self.mon.getSizePix()[0]**2 + self.mon.getSizePix()[1]**2)
-        diagonal_in_deg = ceil(monitorunittools.pix2deg(diagonal_in_pix, self.mon, correctFlat=False))
-
-        self.l_stim = visual.GratingStim(win=self.win_l, name='left', units='deg',
-                                         sf=self.params['spatial_frequency'], contrast=self.params['contrast'],
-                                         pos=[0, 0], size=(diagonal_in_deg, diagonal_in_deg), tex='sqr', phase=1, ori=0,
-                                         colorSpace='rgb', opacity=1, interpolate=False)
-
-        self.r_stim = visual.GratingStim(win=self.win_r, name='right', units='deg',
-                                         sf=self.params['spatial_frequency'], contrast=self.params['contrast'],
-                                         pos=[0, 0], size=(diagonal_in_deg, diagonal_in_deg), tex='sqr', phase=1, ori=0,
-                                         colorSpace='rgb', opacity=1, interpolate=False)
-
-        self.l_green = visual.rect.Rect(self.win_l, width=0.1, height=0.1, units='', lineWidth=1.5, lineColor=None,
+        if self.calibration is not None:
+            diagonal_in_deg = ceil(diagonal_in_pix * self.calibration['deg_per_pix'])
+        else:
+            diagonal_in_deg = ceil(monitorunittools.pix2deg(diagonal_in_pix, self.mon, correctFlat=False))
+
+        # both windows share the cached texture arrays
+        self.l_stim = self.visual.GratingStim(win=self.win_l, name='left', units='deg',
+                                              sf=self.params['spatial_frequency'], contrast=self.params['contrast'],
+                                              pos=[0, 0], size=(diagonal_in_deg, diagonal_in_deg), phase=1, ori=0,
+                                              colorSpace='rgb', opacity=1, interpolate=False,
+                                              **textures.stim_kwargs('sqr'))
+
+        self.r_stim = self.visual.GratingStim(win=self.win_r, name='right', units='deg',
+                                              sf=self.params['spatial_frequency'], contrast=self.params['contrast'],
+                                              pos=[0, 0], size=(diagonal_in_deg, diagonal_in_deg), phase=1, ori=0,
+                                              colorSpace='rgb', opacity=1, interpolate=False,
+                                              **textures.stim_kwargs('sqr'))
+
+        self.l_green = self.visual.Rect(self.win_l, width=0.1, height=0.1, units='', lineWidth=1.5, lineColor=None,
                                         lineColorSpace=None, fillColor='green', fillColorSpace=None, pos=(0.0, 0.0),
                                         size=None, anchor=None, ori=0.0, opacity=None, contrast=1.0, depth=-1,
                                         interpolate=True, lineRGB=False, fillRGB=False, name=None, autoLog=None,
                                         autoDraw=False, color=None, colorSpace='rgb')
 
-        self.r_red = visual.rect.Rect(self.win_r, width=0.1, height=0.1, units='', lineWidth=1.5, lineColor=None,
+        self.r_red = self.visual.Rect(self.win_r, width=0.1, height=0.1, units='', lineWidth=1.5, lineColor=None,
                                       lineColorSpace=None, fillColor='red', fillColorSpace=None, pos=(0.0, 0.0),
                                       size=None, anchor=None, ori=0.0, opacity=None, contrast=1.0, depth=-1,
                                       interpolate=True, lineRGB=False, fillRGB=False, name=None, autoLog=None,
                                       autoDraw=False, color=None, colorSpace='rgb')
 
-        # Set up temporary logger
+        # Set up temporary logger (text log as before, and JSON lines of the traces)
         current_dir = os.path.dirname(__file__)
         parent_dir = os.path.split(current_dir)[0]
         path = os.path.join(current_dir, 'JumpStandLog')
 
         name = "Gazsi"
-        logging.basicConfig(filename=f"{path}/log_test_{name}_{time.strftime('%Y_%m_%d_%H_%M_%S', time.localtime())}.txt",
-                            level=logging.DEBUG, format="%(asctime)s : %(message)s")
+        date = time.strftime('%Y_%m_%d_%H_%M_%S', time.localtime())
+        tracer.open_text_log(f"{path}/log_test_{name}_{date}.txt")
+        tracer.open_log(f"{path}/log_test_{name}_{date}.jsonl")
+
+        # one line per trial, same frame columns as the TwoAFC staircase file
+        self.trials = []
+        # each trial is appended and the file closed right away, so an interrupted session keeps its finished trials
+        self.trials_path = f"{path}/trials_{name}_{date}.csv"
+        with open(self.trials_path, 'w') as f:
+            f.write('direction,horizontalSide,response,correct,frames,droppedFrames,maxFrameInterval\n')
+
+        tracer.info(time.strftime('%Y_%m_%d_%H_%M_%S', time.localtime()))
+        tracer.info(self.params['arduino'].version)
+        tracer.info(self.params['arduino'].initial_values)
+
+    def post_inputs(self, machine, trial_components):
+        """
+        Poll the keyboard and the touch screens once and queue their events in the state machine.
+        """
+        keys = event.getKeys(keyList=['escape', 'return'], timeStamped=True)
+        for key, t in keys:
+            # Esc to quit
+            if key == 'escape':
+                tracer.info('Esc is pressed --> quit')
+                try:
+                    self.port.close()
+                except AttributeError:
+                    tracer.warning('No COM port to close.')
+                core.quit()
+            machine.post('key', key, t)
 
-        logging.debug(f"{time.strftime('%Y_%m_%d_%H_%M_%S', time.localtime())}")
-        logging.debug(self.params['arduino'].version)
-        logging.debug(self.params['arduino'].initial_values)
+        if machine.state == self.states.RPI:
+            for mouse, stimulus in zip([self.mouse_l, self.mouse_r], trial_components):
+                if mouse.isPressedIn(stimulus):
+                    machine.post('press', stimulus.name, core.getTime())
 
     def start_stim(self, direction: int):
         """
@@ -156,7 +258,6 @@ class StaticGratingDual(VisualStimulator):
         -------
         None
         """
-        logging.debug("")
         state = self.states.CAT
 
         horizontal_left = (270 - direction == 0)
@@ -170,16 +271,14 @@ class StaticGratingDual(VisualStimulator):
         else:
             self.params['arduino'].write_order(self.states.RIGHT)
         # time.sleep(0.1)
-        print("elotte vok -->>")
-        print(self.params['arduino'].read_order())
+        side_result = self.params['arduino'].read_order()
+        tracer.debug('side order reply: {}', side_result)
 
-        print(f'Horizontal stim on <{side_of_horizontal}> side\nVertical stim on <{side_of_vertical}> side')
-        print(F"Direction: {direction} --> left horizontal? - {horizontal_left}")
+        tracer.info('Horizontal stim on <{}> side\nVertical stim on <{}> side', side_of_horizontal, side_of_vertical)
+        tracer.info('Direction: {} --> left horizontal? - {}', direction, horizontal_left)
 
-        # logging.debug(f"Horizontal on the left side: {horizontal_left}")
         self.stat_params['left'] += 1 if horizontal_left else 0
         self.stat_params['right'] += 1 if not horizontal_left else 0
-        logging.debug(f"Horizontal:<{side_of_horizontal}> Vertical:<{side_of_vertical}>")
 
         self.r_stim.ori = direction
         self.l_stim.ori = 270 - direction
@@ -196,88 +295,91 @@ class StaticGratingDual(VisualStimulator):
         trial_components = [self.l_stim, self.r_stim]
 
         # -------Start Routine "trial"-------
-        for thisComponent in trial_components:
-            if hasattr(thisComponent, "setAutoDraw"):
-                thisComponent.setAutoDraw(True)
-
-        print("Press Enter to show stimuli if the cat is ready to jump!")
-
-        continue_routine = True
-        left_response = ""
+        tracer.info('Press Enter to show stimuli if the cat is ready to jump!')
+
+        def on_off(inputs):    # needed only if IR gate is already implemented
+            if ('key', 'return') in inputs:
+                return self.states.CAT
+
+        def on_cat(inputs):
+            if ('key', 'return') in inputs:   # key press will be replaced with IR gate signal
+                tracer.info('Enter pressed to show stimuli')
+                self.mouse_l.clickReset()
+                self.mouse_r.clickReset()
+                self.mouse_l.setPos([-1.5, -1.5])
+                self.mouse_r.setPos([-1.5, -1.5])
+                event.clearEvents()
+
+                # the gratings are presented from the next frame on
+                for thisComponent in trial_components:
+                    if hasattr(thisComponent, "setAutoDraw"):
+                        thisComponent.setAutoDraw(True)
+                self.frames.start_trial()
+                return self.states.RPI
+
+        def on_rpi(inputs):
+            for kind, response in inputs:
+                if kind != 'press':
+                    continue
+                trial['left_response'] = response
+                frame_stats = self.frames.end_trial()
+                trial.update(correct=side_of_horizontal == response, frames=frame_stats['frames'],
+                             droppedFrames=frame_stats['dropped'], maxFrameInterval=frame_stats['max_interval'])
+                self.stat_params['dropped_frames'] = self.stat_params.get('dropped_frames', 0) + frame_stats['dropped']
+                tracer.info('Frames: {frames}, dropped: {dropped}, max interval: {max_interval:.4f} s', **frame_stats)
+
+                # Correct response
+                tracer.info('Horizontal: {}, Response: {}', side_of_horizontal, response)
+                if side_of_horizontal == response:
+                    tracer.info('--> Good job!', correct=True)
+                    self.stat_params['correct'] += 1
+                    self.stat_params['left_correct'] += 1 if horizontal_left else 0
+                    self.stat_params['right_correct'] += 1 if not horizontal_left else 0
+                    self.c_sound.stop()
+                    self.c_sound.play()
+                    core.wait(0.5)
+                    self.params['arduino'].write_order(self.states.REW)
+                    # self.l_green.setAutoDraw(True)
+                else:
+                    tracer.info('--> Wrong! ', correct=False)
+                    self.stat_params['wrong'] += 1
+                    self.stat_params['left_wrong'] += 1 if horizontal_left else 0
+                    self.stat_params['right_wrong'] += 1 if not horizontal_left else 0
+                    self.w_sound.stop()
+                    self.w_sound.play()
+                    core.wait(0.5)
+                    self.params['arduino'].write_order(self.states.NOR)
+                    # self.r_red.setAutoDraw(True)
+
+                self.presenter.flip()
+                core.wait(1)
+                return self.states.RAC
+
+        def on_rac(inputs):
+            tracer.info('Left response:   {}\nLeft waited: {}\nCorrect:     {}', trial['left_response'],
+                        horizontal_left, horizontal_left == trial['left_response'])
+            return None
+
+        trial = {'direction': direction, 'horizontalSide': side_of_horizontal, 'left_response': "", 'correct': None,
+                 'frames': 0, 'droppedFrames': 0, 'maxFrameInterval': 0.0}
+        machine = TrialState({self.states.OFF: on_off, self.states.CAT: on_cat, self.states.RPI: on_rpi,
+                              self.states.RAC: on_rac}, state, final=self.states.RAC)
         event.clearEvents()
-        while continue_routine:
-            # Esc to quit
-            if event.getKeys(keyList=["escape"]):
-                logging.debug("Esc is pressed --> quit")
-                try:
-                    self.port.close()
-                except AttributeError:
-                    print("No COM port to close.")
-                core.quit()
-
-            # States:
-            if state == self.states.OFF:    # needed only if IR gate is already implemented
-                if event.getKeys(keyList=['return']):
-                    print(f"State: {state} --> {self.states['CAT']}")
-                    state = self.states.CAT
-
-            if state == self.states.CAT:
-                if event.getKeys(keyList=['return']):   # key press will be replaced with IR gate signal
-                    logging.debug("Enter pressed to show stimuli")
-                    state = self.states.RPI
-
-                    self.mouse_l.clickReset()
-                    self.mouse_r.clickReset()
-                    self.mouse_l.setPos([-1.5, -1.5])
-                    self.mouse_r.setPos([-1.5, -1.5])
-
-                    event.clearEvents()
-                    self.win_l.flip()
-                    self.win_r.flip()
-
-            if state == self.states.RPI:
-                for mouse, stimulus in zip([self.mouse_l, self.mouse_r], trial_components):
-                    if mouse.isPressedIn(stimulus):
-                        state = self.states.RAC
-
-                        left_response = stimulus.name
-                        response = stimulus.name
-
-                        # Correct response
-                        print(f"\nHorizontal: {side_of_horizontal}, Response: {response}")
-                        if side_of_horizontal == response:
-                            print('--> Good job!')
-                            logging.debug(f"Correct")
-                            self.stat_params['correct'] += 1
-                            self.stat_params['left_correct'] += 1 if horizontal_left else 0
-                            self.stat_params['right_correct'] += 1 if not horizontal_left else 0
-                            self.c_sound.stop()
-                            self.c_sound.play()
-                            core.wait(0.5)
-                            self.params['arduino'].write_order(self.states.REW)
-                            # self.l_green.setAutoDraw(True)
-                        else:
-                            print('--> Wrong! ')
-                            logging.debug(f"Wrong")
-                            self.stat_params['wrong'] += 1
-                            self.stat_params['left_wrong'] += 1 if horizontal_left else 0
-                            self.stat_params['right_wrong'] += 1 if not horizontal_left else 0
-                            self.w_sound.stop()
-                            self.w_sound.play()
-                            core.wait(0.5)
-                            self.params['arduino'].write_order(self.states.NOR)
-                            # self.r_red.setAutoDraw(True)
-
-                        self.win_l.flip()
-                        self.win_r.flip()
-                        core.wait(1)
-                        break
-
-            if state == self.states.RAC:
-                print(f"Left response:   {left_response}\nLeft waited: {horizontal_left}\nCorrect:     {horizontal_left == left_response}")
-                continue_routine = False
+        # one tick per frame: the presenter blocks until the vertical blank, so the loop is idle in between
+        while not machine.finished:
+            self.post_inputs(machine, trial_components)
+            machine.tick()
+            if not machine.finished:
+                self.presenter.flip()
 
         # -------Ending Routine "trial"-------
+        self.transitions = machine.transitions  # timestamped state transitions of the trial
+        self.trials.append(trial)
+        with open(self.trials_path, 'a') as f:
+            f.write(f"{direction},{side_of_horizontal},{trial['left_response']},{trial['correct']},"
+                    f"{trial['frames']},{trial['droppedFrames']},{trial['maxFrameInterval']}\n")
+        tracer.info('Trial: direction {direction}, response {left_response}, correct {correct}, frames {frames}, '
+                    'dropped {droppedFrames}', **trial)
         for thisComponent in trial_components:
             if hasattr(thisComponent, "setAutoDraw"):
                 thisComponent.setAutoDraw(False)
@@ -288,13 +390,11 @@ class StaticGratingDual(VisualStimulator):
         self.win_l.color = self.params['color_bg']
         self.win_r.color = self.params['color_bg']
 
-        self.win_l.flip()
-        self.win_l.flip()
-        self.win_r.flip()
-        self.win_r.flip()
+        self.presenter.flip()
+        self.presenter.flip()
         event.clearEvents()
-        pyautogui.moveTo(200, 200)
-        print()
+        if pyautogui is not None:
+            pyautogui.moveTo(200, 200)
 
 
 if __name__ == '__main__':